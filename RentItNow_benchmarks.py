@@ -0,0 +1,329 @@
+# Benchmarks and stress tests of RentItNow.
+#
+# Usage: python RentItNow_benchmarks.py <benchmark> [options]
+#   stress    many threads rent cars at the same time: checks that no car is ever given to two rentals
+#   memory    memory used by a big fleet with the different representations of the cars
+#   eventlog  time to open an event log with and without a snapshot (full replay vs replay of the tail)
+#   sharding  rentals per second of the sharded engine with 1 to N worker processes (see RentItNow_sharding)
+#   startup   cold start: time to import the program and latency of the first rental and of its receipt
+import argparse
+import os
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import sys
+import threading
+import time
+import tracemalloc
+from RentItNow_rental_software import RentalService, CarNotAvailableError, CIRCLES, MAX_PASSENGERS, Car, ColumnarFleet
+from RentItNow_eventlog import EventLog
+from RentItNow_sharding import ShardedRentalEngine, MAX_SHARDS
+
+
+# payment failing at random, used to check that the cars given back after a failed payment are allocated correctly
+class PaymentError(Exception):
+    pass
+
+
+# Stress test of the car allocation: `threads` threads rent cars at the same time until the fleet is empty.
+# The payment sleeps for a random short time (and fails with probability failure_rate) to make the threads overlap
+# between the reservation and the commit of the rentals. Every car must be rented exactly once
+def stress_allocation(threads=32, cars=2000, failure_rate=0.05, seed=1):
+    service = RentalService(receipts=False)
+    car_types = list(MAX_PASSENGERS)
+    for number in range(cars):
+        service.add_car(car_types[number % len(car_types)], f"CAR{number:07d}", "Brand", f"Model {number}", CIRCLES[number % len(CIRCLES)])
+    for number in range(threads):
+        service.add_user(f"user{number}", "Surname", "Address", "Card", "License")
+
+    def make_payment(username, total_cost):
+        rng = random.Random()
+        time.sleep(rng.random() / 1000)
+        if rng.random() < failure_rate:
+            raise PaymentError(username)
+    service.make_payment = make_payment
+
+    rented = [[] for _ in range(threads)]
+    failed_payments = [0] * threads
+    start = threading.Barrier(threads)
+
+    def renter(number):
+        rng = random.Random(seed + number)
+        start.wait()
+        sold_out = set()
+        while len(sold_out) < len(car_types):
+            car_type = rng.choice(car_types)
+            try:
+                rental = service.rent(f"user{number}", car_type, 1, rng.choice(CIRCLES), rng.choice(CIRCLES))
+            except CarNotAvailableError:
+                sold_out.add(car_type)
+            except PaymentError:
+                failed_payments[number] += 1
+            else:
+                rented[number].append(rental.car.license_plate)
+
+    workers = [threading.Thread(target=renter, args=(number,)) for number in range(threads)]
+    began = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - began
+
+    plates = [plate for plates in rented for plate in plates]
+    duplicates = len(plates) - len(set(plates))
+    still_available = service.fleet_index.available_total()
+    print(f"{threads} threads, {cars} cars: {len(plates)} rentals, {sum(failed_payments)} failed payments "
+          f"in {elapsed:.2f} s ({len(plates) / elapsed:.0f} rentals/s)")
+    print(f"cars rented twice: {duplicates}, cars never rented: {cars - len(set(plates))}, cars still available: {still_available}")
+    return duplicates == 0 and len(set(plates)) == cars and still_available == 0
+
+
+# the Car class as it was before __slots__, with a __dict__ in every car, used as reference by the memory benchmark
+class DictCar:
+    def __init__(self, car_type, license_plate, brand, name, location):
+        self.car_type = car_type
+        self.license_plate = license_plate
+        self.brand = brand
+        self.name = name
+        self.location = location
+        self.total_distance_travelled = 0
+        self.next_service_time = 1500
+        self.availability = True
+        self.is_in_service = False
+
+
+# Memory used by a fleet of `cars` cars built with each representation, measured with tracemalloc: first the cars
+# alone, then inside a RentalService (cars registry, fleet index and service schedule included).
+# The values of the cars are built as they come from the storage or from the user (a new string for each car),
+# so the benchmark also shows the effect of interning the car types, brands and locations.
+# Some of the cars are rented (their numeric status changes) to check that the representations stay compact
+def fleet_memory(cars=1_000_000):
+    car_types = list(MAX_PASSENGERS)
+    brands = ["Toyota", "Honda", "Mercedes", "Fiat", "Renault"]
+
+    # the cars built by factory, passed one by one to add
+    def build(factory, add):
+        for number in range(cars):
+            car = factory("".join(car_types[number % 3]), f"CAR{number:07d}", "".join(brands[number % 5]),
+                          f"Model {number % 1000}", "".join(CIRCLES[number % 3]))
+            if number % 10 == 0:
+                car.total_distance_travelled += 20
+                car.next_service_time = 1480
+                car.availability = False
+            add(car)
+
+    def build_list(factory):
+        fleet = []
+        build(factory, fleet.append)
+        return fleet
+
+    # only the columns: the views are dropped as soon as the car is built
+    def build_columns():
+        fleet = ColumnarFleet()
+        build(fleet.new_car, lambda car: None)
+        return fleet
+
+    def build_service(car_factory):
+        service = RentalService(receipts=False, car_factory=car_factory)
+        build(car_factory, service.register_car)
+        return service
+
+    results = {}
+    representations = [
+        ("dict Car (before)", lambda: build_list(DictCar)),
+        ("slotted Car", lambda: build_list(Car)),
+        ("ColumnarFleet", build_columns),
+        ("service, slotted Car", lambda: build_service(Car)),
+        ("service, ColumnarFleet", lambda: build_service(ColumnarFleet().new_car)),
+    ]
+
+    for label, function in representations:
+        tracemalloc.start()
+        began = time.perf_counter()
+        fleet = function()
+        elapsed = time.perf_counter() - began
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del fleet
+        results[label] = size
+        print(f"{label:26} {size / 2**20:9.1f} MiB  {size / cars:6.0f} bytes/car  built in {elapsed:.2f} s")
+    return results
+
+
+def event_log_replay(rentals=100_000, cars=1000, tail=1000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rentitnow.events")
+        log = EventLog(path, snapshot_every=cars + 2 * rentals - tail)
+        service = RentalService(receipts=False, event_log=log)
+        car_types = list(MAX_PASSENGERS)
+        for number in range(cars):
+            service.add_car(car_types[number % 3], f"CAR{number:07d}", "Brand", f"Model {number}", CIRCLES[number % 3])
+        for number in range(100):
+            service.add_user(f"user{number}", "Surname", "Address", "Card", "License")
+        rng = random.Random(1)
+        began = time.perf_counter()
+        for number in range(rentals):
+            rental = service.rent(f"user{number % 100}", rng.choice(car_types), 1, rng.choice(CIRCLES), rng.choice(CIRCLES))
+            service.return_car(rental.car.license_plate)
+        elapsed = time.perf_counter() - began
+        # the files are closed without writing a new snapshot, so that the tail is left to replay
+        log.file.close()
+        log.reader.close()
+        print(f"{cars + 2 * rentals} events ({os.path.getsize(path) / 2**20:.1f} MiB) written in {elapsed:.2f} s")
+
+        began = time.perf_counter()
+        log = EventLog(path)
+        with_snapshot = time.perf_counter() - began
+        log.file.close()
+        log.reader.close()
+        os.remove(path + ".snapshot")
+        began = time.perf_counter()
+        log = EventLog(path)
+        full_replay = time.perf_counter() - began
+        print(f"open with snapshot (replay of {tail} events): {with_snapshot * 1000:.1f} ms, "
+              f"full replay: {full_replay * 1000:.1f} ms")
+
+        began = time.perf_counter()
+        for number in range(cars):
+            log.last_rental(f"CAR{number:07d}")
+        print(f"last rental of a car from its position: {(time.perf_counter() - began) / cars * 1e6:.1f} us")
+        log.close()
+    return with_snapshot, full_replay
+
+
+# Scaling of the sharded engine: the same rentals (batches of `batch` rentals, then the return of the rented cars) with
+# 1, 2, ... max_shards worker processes. The speedup is measured against 1 shard; the fleet must have the same number
+# of cars at the end (the cars returned in the circles of other shards are moved, never lost or duplicated)
+def sharding_scaling(cars=30_000, rentals=200_000, batch=2000, max_shards=None, seed=1):
+    max_shards = max_shards or min(os.cpu_count() or 1, MAX_SHARDS)
+    car_types = list(MAX_PASSENGERS)
+    fleet = [(car_types[number % 3], f"CAR{number:07d}", "Brand", f"Model {number}", CIRCLES[number // 3 % 3])
+             for number in range(cars)]
+    print(f"{rentals} rentals in batches of {batch}, {cars} cars, {os.cpu_count()} cpu(s)")
+    print(f"{'shards':>6} {'rentals/s':>10} {'speedup':>8} {'transfers':>10} {'no car':>7}")
+    ok = True
+    first = None
+    for shards in range(1, max_shards + 1):
+        rng = random.Random(seed)
+        with ShardedRentalEngine(shards) as engine:
+            engine.add_cars(fleet)
+            for number in range(100):
+                engine.add_user(f"user{number}", "Surname", "Address", "Card", "License")
+            made = failed = 0
+            began = time.perf_counter()
+            while made + failed < rentals:
+                requests = [(f"user{rng.randrange(100)}", rng.choice(car_types), 1, rng.choice(CIRCLES), rng.choice(CIRCLES))
+                            for _ in range(min(batch, rentals - made - failed))]
+                results = engine.rent_many(requests)
+                plates = [result["license_plate"] for result in results if isinstance(result, dict)]
+                made += len(plates)
+                failed += len(results) - len(plates)
+                engine.return_many(plates)
+            elapsed = time.perf_counter() - began
+            rate = rentals / elapsed
+            first = first or rate
+            total = sum(status["cars"] for status in engine.status())
+            ok = ok and total == cars
+            print(f"{shards:>6} {rate:>10.0f} {rate / first:>7.2f}x {engine.transfers:>10} {failed:>7}"
+                  + ("" if total == cars else f"  FAILED: {total} cars instead of {cars}"))
+    return ok
+
+
+# run in a new interpreter for every measurement, so that nothing is imported yet. The mode is
+#   eager    reportlab is imported together with the program (as it was before the lazy import)
+#   lazy     reportlab is imported by the receipt workers when the first receipt is written
+#   prewarm  lazy, then RentalService.prewarm() before the first rental (not counted in the latencies)
+STARTUP_SCRIPT = '''
+import json, sys, time
+mode, workers = sys.argv[1], int(sys.argv[2])
+began = time.perf_counter()
+if mode == "eager":
+    import reportlab.lib.colors, reportlab.lib.pagesizes, reportlab.lib.styles, reportlab.platypus
+import RentItNow_rental_software as software
+from RentItNow_receipts import ReceiptPipeline
+imported = time.perf_counter() - began
+service = software.RentalService(receipts=ReceiptPipeline(max_workers=workers))
+service.add_test_data()
+began = time.perf_counter()
+if mode == "prewarm":
+    service.prewarm()
+prewarm = time.perf_counter() - began
+began = time.perf_counter()
+rental = service.rent("Federica", "ECO", 1, "Inner Circle", "Outer Circle")
+rented = time.perf_counter() - began
+rental.receipt.result()
+receipt = time.perf_counter() - began
+service.close()
+print(json.dumps({"import": imported, "prewarm": prewarm, "rental": rented, "receipt": receipt}))
+'''
+
+
+# Cold start: each mode is run `repeat` times in a new interpreter (the medians are shown). The receipts are written
+# by `workers` worker processes (0: in the process of the rental, so the first rental also waits for its receipt)
+def startup_latency(repeat=5, workers=2):
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                              environment.get("PYTHONPATH")]))
+    print(f"median of {repeat} runs, receipts written by {workers or 'no'} worker process(es)")
+    print(f"{'mode':>8} {'import':>10} {'prewarm':>10} {'1st rental':>11} {'1st receipt':>12}")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ("eager", "lazy", "prewarm"):
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, mode, str(workers)], cwd=directory,
+                                        env=environment, capture_output=True, text=True, check=True).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+            results[mode] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            times = results[mode]
+            print(f"{mode:>8} {times['import'] * 1000:>8.1f}ms {times['prewarm'] * 1000:>8.1f}ms "
+                  f"{times['rental'] * 1000:>9.1f}ms {times['receipt'] * 1000:>10.1f}ms")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RentItNow benchmarks")
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+    stress = commands.add_parser("stress", help="check that concurrent rentals never get the same car")
+    stress.add_argument("--threads", type=int, default=32)
+    stress.add_argument("--cars", type=int, default=2000)
+    stress.add_argument("--failure-rate", type=float, default=0.05)
+    stress.add_argument("--seed", type=int, default=1)
+    memory = commands.add_parser("memory", help="memory used by the different representations of a big fleet")
+    memory.add_argument("--cars", type=int, default=1_000_000)
+    eventlog = commands.add_parser("eventlog", help="time to open an event log with and without a snapshot")
+    eventlog.add_argument("--rentals", type=int, default=100_000)
+    eventlog.add_argument("--cars", type=int, default=1000)
+    sharding = commands.add_parser("sharding", help="rentals per second of the sharded engine with 1 to N processes")
+    sharding.add_argument("--cars", type=int, default=30_000)
+    sharding.add_argument("--rentals", type=int, default=200_000)
+    sharding.add_argument("--batch", type=int, default=2000, help="rentals sent to the shards at once")
+    sharding.add_argument("--max-shards", type=int, help=f"default: number of cpus (at most {MAX_SHARDS})")
+    startup = commands.add_parser("startup", help="import time and latency of the first rental and receipt")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--workers", type=int, default=2, help="receipt worker processes (0: none)")
+    arguments = parser.parse_args(argv)
+
+    if arguments.benchmark == "stress":
+        ok = stress_allocation(arguments.threads, arguments.cars, arguments.failure_rate, arguments.seed)
+        print("OK" if ok else "FAILED: a car was allocated twice or lost")
+        return 0 if ok else 1
+    if arguments.benchmark == "eventlog":
+        event_log_replay(arguments.rentals, arguments.cars)
+        return 0
+    if arguments.benchmark == "memory":
+        fleet_memory(arguments.cars)
+        return 0
+    if arguments.benchmark == "sharding":
+        ok = sharding_scaling(arguments.cars, arguments.rentals, arguments.batch, arguments.max_shards)
+        return 0 if ok else 1
+    if arguments.benchmark == "startup":
+        startup_latency(arguments.repeat, arguments.workers)
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+# Bulk import and export of cars, users and rental history, in csv or in JSON lines (one JSON object per line).
+# The files are read and written one record at a time, so their size does not matter: a new depot with 50000 cars
+# is onboarded with a single command.
+#
+# Import: every record is checked while it is read (car type, circles, dates, license plate already present, also
+# earlier in the same file) and the wrong ones are rejected and reported with their line number, without stopping the
+# import. The records are saved in batches, each batch in a single transaction of the storage. A progress line with
+# the throughput is printed every --progress records and a report at the end.
+#
+# Files: csv with a header line, or .jsonl. The columns (keys) are
+#   cars:    car_type, license_plate, brand, name, location
+#            (export also: total_distance_travelled, next_service_time, availability, is_in_service)
+#   users:   name, surname, address, credit_card, driving_license
+#   rentals: username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, returned_at
+#            (export also: rental_id). Imported rentals must be finished; distance and total_cost may be empty
+#
+# Usage: python RentItNow_bulk.py import cars depot.csv [--database rentitnow.db] [--event-log rentitnow.events]
+#                                 [--batch-size 1000] [--progress 10000]
+#        python RentItNow_bulk.py export rentals rentals.jsonl [--database rentitnow.db]
+# https://docs.python.org/3/library/csv.html
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+from RentItNow_rental_software import RentalService, RentItNowError
+from RentItNow_eventlog import EventLog
+from RentItNow_storage import SQLiteStorage
+
+CAR_FIELDS = ("car_type", "license_plate", "brand", "name", "location")
+CAR_EXPORT_FIELDS = CAR_FIELDS + ("total_distance_travelled", "next_service_time", "availability", "is_in_service")
+USER_FIELDS = ("name", "surname", "address", "credit_card", "driving_license")
+RENTAL_FIELDS = ("username", "license_plate", "start_circle", "end_circle", "distance", "total_cost", "rented_at", "returned_at")
+RENTAL_EXPORT_FIELDS = RENTAL_FIELDS + ("rental_id",)
+# values that may be missing in an imported record
+OPTIONAL_FIELDS = {"distance", "total_cost"}
+NUMBER_FIELDS = {"distance", "total_cost"}
+# license plates are stored in upper case, as they are typed in the menu
+UPPER_CASE_FIELDS = {"license_plate"}
+
+KINDS = ("cars", "users", "rentals")
+# only the first errors are kept in the report, the others are only counted
+MAX_ERRORS = 100
+
+
+# format of a file from its extension
+def file_format(path, format=None):
+    if format is None:
+        format = "jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv"
+    if format not in ("csv", "jsonl"):
+        raise ValueError(f"Unknown format {format!r}. Please use csv or jsonl")
+    return format
+
+
+# read the records of a file one at a time: (line number, dict of the values)
+def read_records(path, format=None):
+    format = file_format(path, format)
+    with open(path, newline="" if format == "csv" else None, encoding="utf-8") as file:
+        if format == "csv":
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as error:
+                    record = error
+                yield line_number, record
+
+
+# write the rows (tuples with the values in the order of fields) one at a time. Returns the number of rows written
+def write_records(path, fields, rows, format=None):
+    format = file_format(path, format)
+    count = 0
+    with open(path, "w", newline="" if format == "csv" else None, encoding="utf-8") as file:
+        if format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                file.write(json.dumps(dict(zip(fields, row))) + "\n")
+                count += 1
+    return count
+
+
+# values of a record in the order of fields, with the required ones checked. The values of a JSON record can be
+# of any type: numbers are accepted for the text fields (a license plate 123 becomes "123"), lists, objects and
+# booleans are rejected
+def record_values(record, fields):
+    if isinstance(record, Exception):
+        raise ValueError(f"invalid JSON ({record})")
+    if not isinstance(record, dict):
+        raise ValueError("the record is not an object")
+    values = []
+    for field in fields:
+        value = record.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+            raise ValueError(f"invalid {field} {value!r}")
+        if value is not None and field not in NUMBER_FIELDS:
+            value = str(value)
+        if isinstance(value, str):
+            value = value.strip()
+        if value in (None, ""):
+            if field not in OPTIONAL_FIELDS:
+                raise ValueError(f"missing {field}")
+            value = None
+        elif field in NUMBER_FIELDS:
+            value = float(value)
+            value = int(value) if value.is_integer() else value
+        elif field in UPPER_CASE_FIELDS:
+            value = value.upper()
+        values.append(value)
+    return values
+
+
+# counters of an import, printed as progress and at the end
+class ImportReport:
+    def __init__(self, kind):
+        self.kind = kind
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []  # the first MAX_ERRORS: (line number, message)
+        self.started = time.perf_counter()
+        self.elapsed = 0
+
+    def reject(self, line_number, error):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line_number, str(error)))
+
+    def rate(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self.read / self.elapsed if self.elapsed else 0
+
+    def progress(self):
+        return (f"{self.kind}: {self.read} records read, {self.imported} imported, {self.rejected} rejected "
+                f"({self.rate():.0f} records/s)")
+
+    def __str__(self):
+        lines = [f"{self.progress()} in {self.elapsed:.2f} s"]
+        lines.extend(f"  line {line_number}: {message}" for line_number, message in self.errors)
+        if self.rejected > len(self.errors):
+            lines.append(f"  ... and {self.rejected - len(self.errors)} more rejected records")
+        return "\n".join(lines)
+
+
+# import the records of a file: each batch of records is saved in a single transaction.
+# output receives the progress lines (None: nothing is printed)
+def import_file(service, kind, path, format=None, batch_size=1000, progress_every=10000, output=print):
+    if kind == "cars":
+        fields, add = CAR_FIELDS, service.import_car
+    elif kind == "users":
+        fields, add = USER_FIELDS, service.import_user
+    elif kind == "rentals":
+        fields, add = RENTAL_FIELDS, service.import_rental
+    else:
+        raise ValueError(f"Unknown kind {kind!r}. Please use cars, users or rentals")
+    report = ImportReport(kind)
+    records = read_records(path, format)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        with service.storage.batch():
+            for line_number, record in batch:
+                report.read += 1
+                try:
+                    add(**dict(zip(fields, record_values(record, fields))))
+                except (RentItNowError, ValueError, TypeError) as error:
+                    report.reject(line_number, error)
+                else:
+                    report.imported += 1
+                if output is not None and progress_every and report.read % progress_every == 0:
+                    output(report.progress())
+    report.rate()
+    if output is not None:
+        output(str(report))
+    return report
+
+
+# export all the cars, users or rentals to a file. Returns the number of records written
+def export_file(service, kind, path, format=None):
+    if kind == "cars":
+        return write_records(path, CAR_EXPORT_FIELDS, service.iter_car_rows(), format)
+    if kind == "users":
+        return write_records(path, USER_FIELDS, service.iter_user_rows(), format)
+    if kind == "rentals":
+        return write_records(path, RENTAL_EXPORT_FIELDS, service.iter_rental_rows(), format)
+    raise ValueError(f"Unknown kind {kind!r}. Please use cars, users or rentals")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RentItNow bulk import and export of cars, users and rentals")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("path", help="csv or .jsonl file")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="format of the file (default: from the extension)")
+    parser.add_argument("--database", default="rentitnow.db", help="SQLite database file")
+    parser.add_argument("--event-log", help="append the imported records to this event log")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records saved in each transaction")
+    parser.add_argument("--progress", type=int, default=10000, help="print the progress every N records")
+    arguments = parser.parse_args(argv)
+    event_log = EventLog(arguments.event_log, keep_rows=False) if arguments.event_log else None
+    service = RentalService(storage=SQLiteStorage(arguments.database, synchronous="NORMAL"), receipts=False,
+                            event_log=event_log)
+    try:
+        if arguments.action == "import":
+            report = import_file(service, arguments.kind, arguments.path, arguments.format, arguments.batch_size,
+                                 arguments.progress)
+            return 1 if report.rejected else 0
+        began = time.perf_counter()
+        count = export_file(service, arguments.kind, arguments.path, arguments.format)
+        print(f"{count} {arguments.kind} exported to {arguments.path} in {time.perf_counter() - began:.2f} s")
+        return 0
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+# Append-only event log of RentItNow: every rental, return, service and every change of the cars and users is
+# appended to a binary file, so the history of the fleet is never overwritten and the current state can always be
+# rebuilt by replaying the events.
+#
+# Each event is a record: a header (length of the values, crc32, kind of event, time) followed by the values,
+# each one encoded with a 1-byte tag. A record is only valid if its crc matches, so a record left half-written by a
+# crash is detected when the log is opened and cut away.
+#
+# The state rebuilt from the events (active rentals, the position in the file of the last rental of each car and,
+# unless keep_rows=False, the rows of the cars and users) is saved in a snapshot every snapshot_every events: when
+# the log is opened only the events written after the last snapshot are replayed. A program whose storage already
+# keeps the cars and the users (SQLite) opens the log with keep_rows=False, so the log does not hold the whole fleet
+# in memory again. The snapshot is written to the disk without holding the lock of append. The snapshot also keeps the totals of the reports
+# (see RentItNow_reports), so the reports of a service without a persistent storage are not rebuilt from the whole log.
+# https://docs.python.org/3/library/struct.html
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from RentItNow_reports import RentalReports
+
+# kinds of events
+CAR_ADDED = 1
+CAR_UPDATED = 2
+CAR_REMOVED = 3
+CAR_SERVICED = 4
+USER_ADDED = 5
+USER_UPDATED = 6
+USER_REMOVED = 7
+RENTAL_STARTED = 8
+RENTAL_RETURNED = 9
+
+EVENT_NAMES = {CAR_ADDED: "car added", CAR_UPDATED: "car updated", CAR_REMOVED: "car removed", CAR_SERVICED: "car serviced",
+               USER_ADDED: "user added", USER_UPDATED: "user updated", USER_REMOVED: "user removed",
+               RENTAL_STARTED: "rental started", RENTAL_RETURNED: "rental returned"}
+
+# Values of the events:
+#   CAR_ADDED, CAR_UPDATED, CAR_SERVICED: car row, as in the storage
+#       (car_type, license_plate, brand, name, location, total_distance_travelled, next_service_time, availability, is_in_service)
+#   CAR_REMOVED: license_plate
+#   USER_ADDED, USER_UPDATED: old_name, name, surname, address, credit_card, driving_license
+#   USER_REMOVED: name
+#   RENTAL_STARTED: rental_id, username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, *car row
+#   RENTAL_RETURNED: rental_id, license_plate, returned_at, *car row
+
+# header of a record: length of the values, crc32 of the rest of the record, kind, time of the event (epoch seconds)
+HEADER = struct.Struct("<IIBd")
+INT = struct.Struct("<q")
+FLOAT = struct.Struct("<d")
+LENGTH = struct.Struct("<I")
+
+
+def encode_values(values):
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(b"n")
+        elif value is True:
+            parts.append(b"t")
+        elif value is False:
+            parts.append(b"f")
+        elif isinstance(value, int):
+            parts.append(b"i" + INT.pack(value))
+        elif isinstance(value, float):
+            parts.append(b"d" + FLOAT.pack(value))
+        else:
+            data = str(value).encode()
+            parts.append(b"s" + LENGTH.pack(len(data)) + data)
+    return b"".join(parts)
+
+
+def decode_values(data):
+    values = []
+    position = 0
+    while position < len(data):
+        tag = data[position:position + 1]
+        position += 1
+        if tag == b"n":
+            values.append(None)
+        elif tag == b"t":
+            values.append(True)
+        elif tag == b"f":
+            values.append(False)
+        elif tag == b"i":
+            values.append(INT.unpack_from(data, position)[0])
+            position += INT.size
+        elif tag == b"d":
+            values.append(FLOAT.unpack_from(data, position)[0])
+            position += FLOAT.size
+        elif tag == b"s":
+            length = LENGTH.unpack_from(data, position)[0]
+            position += LENGTH.size
+            values.append(data[position:position + length].decode())
+            position += length
+        else:
+            raise ValueError(f"Unknown value tag {tag!r}")
+    return values
+
+
+def encode_record(kind, timestamp, values):
+    payload = encode_values(values)
+    body = HEADER.pack(len(payload), 0, kind, timestamp)[8:] + payload
+    return HEADER.pack(len(payload), zlib.crc32(body), kind, timestamp) + payload
+
+
+# read the record starting at the current position of the file: returns (kind, timestamp, values), or None at the
+# end of the file or when the record is incomplete or corrupted
+def read_record(file):
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length, crc, kind, timestamp = HEADER.unpack(header)
+    payload = file.read(length)
+    if len(payload) < length or zlib.crc32(header[8:] + payload) != crc:
+        return None
+    return kind, timestamp, decode_values(payload)
+
+
+# rentals: license_plate -> [position of the last RENTAL_STARTED of the car, position of its RENTAL_RETURNED or None]
+def empty_state(keep_rows=True):
+    return {"cars": {}, "users": {}, "active": {}, "rentals": {}, "last_rental_id": 0, "keep_rows": keep_rows}
+
+
+class EventLog:
+    def __init__(self, path, snapshot_every=10000, sync=False, keep_rows=True):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.snapshot_every = snapshot_every
+        # with sync=True every event is written to the disk (fsync) before append() returns
+        self.sync = sync
+        # with keep_rows=False the rows of the cars and users are not kept in the state
+        self.keep_rows = keep_rows
+        self.lock = threading.Lock()
+        # only one snapshot is written at a time; snapshot_offset is the position covered by the last one written
+        self.snapshot_lock = threading.Lock()
+        self.state, offset, reports = self.load_snapshot()
+        self.snapshot_offset = offset
+        # totals of the reports of all the rentals of the log, updated by apply
+        self.reports = RentalReports()
+        if reports is not None:
+            self.reports.load_state(reports)
+        elif offset:
+            # snapshot written before the totals were kept in it: they are rebuilt once from the events it covers
+            for _, kind, _, values in self.iter_events(offset):
+                if kind == RENTAL_STARTED:
+                    self.record_rental(values)
+        self.events_since_snapshot = 0
+        # replay the events written after the snapshot; an incomplete record at the end (crash) is cut away
+        with open(path, "ab+") as file:
+            file.seek(offset)
+            while True:
+                record = read_record(file)
+                if record is None:
+                    break
+                self.apply(offset, *record)
+                offset = file.tell()
+                self.events_since_snapshot += 1
+            file.truncate(offset)
+        self.offset = offset
+        self.file = open(path, "ab")
+        self.reader = open(path, "rb")
+
+    # the snapshot is ignored if it is missing or does not match the log (e.g. the log has been deleted)
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return empty_state(self.keep_rows), 0, None
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        state = snapshot.get("state", {})
+        # snapshots of older versions (without the rentals of each car) and snapshots written without the rows that
+        # are now needed are ignored: the whole log is replayed once
+        if snapshot.get("offset", 0) > size or "rentals" not in state or (self.keep_rows and not state.get("keep_rows")):
+            return empty_state(self.keep_rows), 0, None
+        if not self.keep_rows:
+            state["cars"], state["users"], state["keep_rows"] = {}, {}, False
+        return state, snapshot["offset"], snapshot.get("reports")
+
+    # save the state in the snapshot file. The snapshot is written in a temporary file and then renamed,
+    # so a crash during the write never leaves a broken snapshot
+    def snapshot(self):
+        with self.lock:
+            data = self.snapshot_data()
+        self.write_snapshot(data)
+
+    # copy of the state to be saved (the lock must be held). The values of the state are replaced by apply, never
+    # changed in place, so copying the dicts is enough
+    def snapshot_data(self):
+        self.events_since_snapshot = 0
+        state = {name: dict(value) if isinstance(value, dict) else value for name, value in self.state.items()}
+        return {"offset": self.offset, "state": state, "reports": self.reports.state()}
+
+    # write a copy made by snapshot_data, unless a more recent snapshot has already been written
+    def write_snapshot(self, data):
+        with self.snapshot_lock:
+            if data["offset"] < self.snapshot_offset:
+                return
+            temporary = self.snapshot_path + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump(data, file, separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.snapshot_path)
+            self.snapshot_offset = data["offset"]
+
+    # append an event and return its position in the file
+    def append(self, kind, *values):
+        record = encode_record(kind, time.time(), values)
+        with self.lock:
+            offset = self.offset
+            self.file.write(record)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.offset += len(record)
+            self.apply(offset, kind, None, list(values))
+            self.events_since_snapshot += 1
+            data = self.snapshot_data() if self.events_since_snapshot >= self.snapshot_every else None
+        # the copy is taken with the lock, the (slow) write to the disk is done without it
+        if data is not None:
+            self.write_snapshot(data)
+        return offset
+
+    # the storage keeps the cars and the users: their rows are dropped and no longer kept (see keep_rows)
+    def drop_rows(self):
+        with self.lock:
+            self.keep_rows = False
+            self.state["cars"], self.state["users"], self.state["keep_rows"] = {}, {}, False
+
+    # update the state with an event
+    def apply(self, offset, kind, timestamp, values):
+        state = self.state
+        keep_rows = self.keep_rows
+        if kind in (CAR_ADDED, CAR_UPDATED, CAR_SERVICED):
+            if keep_rows:
+                state["cars"][values[1]] = values
+        elif kind == CAR_REMOVED:
+            state["cars"].pop(values[0], None)
+        elif kind in (USER_ADDED, USER_UPDATED):
+            if keep_rows:
+                state["users"].pop(values[0], None)
+                state["users"][values[1]] = values[1:]
+        elif kind == USER_REMOVED:
+            state["users"].pop(values[0], None)
+        elif kind == RENTAL_STARTED:
+            rental_id, username, license_plate, start_circle, end_circle, distance, total_cost, rented_at = values[:8]
+            if keep_rows:
+                state["cars"][license_plate] = values[8:]
+            # active rentals are kept as storage rows
+            state["active"][license_plate] = [username, license_plate, start_circle, end_circle, distance, total_cost,
+                                              rented_at, None, rental_id]
+            if isinstance(rental_id, int):
+                state["last_rental_id"] = max(state["last_rental_id"], rental_id)
+            self.record_rental(values)
+            state["rentals"][license_plate] = [offset, None]
+        elif kind == RENTAL_RETURNED:
+            license_plate = values[1]
+            if keep_rows:
+                state["cars"][license_plate] = values[3:]
+            state["active"].pop(license_plate, None)
+            last = state["rentals"].get(license_plate)
+            if last is not None:
+                state["rentals"][license_plate] = [last[0], offset]
+
+    # add the rental of a RENTAL_STARTED event to the reports; the car type is the one of the car row of the event
+    def record_rental(self, values):
+        rental_id, username, license_plate, start_circle, end_circle, distance, total_cost, rented_at = values[:8]
+        self.reports.record(values[8], license_plate, start_circle, end_circle, distance, total_cost, rented_at)
+
+    # read the event at the given position of the file: (kind, timestamp, values)
+    def read(self, offset):
+        with self.lock:
+            self.reader.seek(offset)
+            return read_record(self.reader)
+
+    # all the events of a car, in order: (kind, timestamp, values). The whole log is read
+    def events_of(self, license_plate):
+        events = []
+        for offset, kind, timestamp, values in self.iter_events(self.offset):
+            if kind in (CAR_ADDED, CAR_UPDATED, CAR_SERVICED):
+                plate = values[1]
+            elif kind in (CAR_REMOVED, RENTAL_RETURNED):
+                plate = values[0] if kind == CAR_REMOVED else values[1]
+            elif kind == RENTAL_STARTED:
+                plate = values[2]
+            else:
+                continue
+            if plate == license_plate:
+                events.append((kind, timestamp, values))
+        return events
+
+    # iterate over the events of the log (all of them, or the ones before the given position), in order:
+    # (offset, kind, timestamp, values)
+    def iter_events(self, end=None):
+        with open(self.path, "rb") as file:
+            while True:
+                offset = file.tell()
+                if end is not None and offset >= end:
+                    return
+                record = read_record(file)
+                if record is None:
+                    return
+                yield (offset,) + record
+
+    # last rental of a car as a storage row (see Storage.load_rentals), or None if the car was never rented.
+    # Only the events of its last rental are read
+    def last_rental(self, license_plate):
+        active = self.state["active"].get(license_plate)
+        if active is not None:
+            return tuple(active)
+        last = self.state["rentals"].get(license_plate)
+        if last is None:
+            return None
+        started, returned = last
+        rental_id, username, license_plate, start_circle, end_circle, distance, total_cost, rented_at = self.read(started)[2][:8]
+        returned_at = self.read(returned)[2][2] if returned is not None else None
+        return (username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, returned_at, rental_id)
+
+    def close(self):
+        with self.lock:
+            data = self.snapshot_data() if self.events_since_snapshot else None
+            self.file.close()
+            self.reader.close()
+        if data is not None:
+            self.write_snapshot(data)
@@ -0,0 +1,75 @@
+# Service schedule of RentItNow: the cars are kept in a heap ordered by the km left before their next service
+# (next_service_time), so the Boss can see which cars are due next without looking at the whole fleet.
+#
+# The km of a car change at every trip: instead of looking for the old entry of the car in the heap, a new entry is
+# pushed and the old one is left behind. Every car has a version number and the entries with an old version are
+# simply skipped (lazy invalidation). When the old entries are more than the cars, the heap is rebuilt from scratch.
+#
+# due(n) walks the heap from its root, always visiting the smallest entry reached so far: only the entries above
+# the n-th car due (plus the old ones met on the way) are visited, so it takes O(n log n) and not O(size of the fleet).
+# https://docs.python.org/3/library/heapq.html
+import heapq
+import itertools
+import threading
+
+# the heap is rebuilt when it holds more than twice as many entries as cars (plus this margin)
+COMPACT_MARGIN = 64
+
+
+class MaintenanceScheduler:
+    def __init__(self):
+        self.heap = []  # (km left, version, license_plate)
+        self.entries = {}  # license_plate -> (km left, version) of the current entry of the car
+        # the km left take only a few hundred different values: all the entries share the same int objects
+        self.numbers = {}
+        self.versions = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, license_plate):
+        return license_plate in self.entries
+
+    # add a car or change its km left before the service
+    def update(self, license_plate, km_left):
+        with self.lock:
+            km_left = self.numbers.setdefault(km_left, km_left)
+            current = self.entries.get(license_plate)
+            if current is not None and current[0] == km_left:
+                return
+            version = next(self.versions)
+            self.entries[license_plate] = (km_left, version)
+            heapq.heappush(self.heap, (km_left, version, license_plate))
+            if len(self.heap) > 2 * len(self.entries) + COMPACT_MARGIN:
+                self.compact()
+
+    def remove(self, license_plate):
+        with self.lock:
+            self.entries.pop(license_plate, None)
+
+    # km left before the service of a car (None if the car is not scheduled)
+    def km_left(self, license_plate):
+        current = self.entries.get(license_plate)
+        return current[0] if current is not None else None
+
+    # rebuild the heap with only the current entries (the lock must be held)
+    def compact(self):
+        self.heap = [(km_left, version, license_plate) for license_plate, (km_left, version) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    # the n cars with the fewest km left, the first due first: [(license_plate, km left)]
+    def due(self, n):
+        with self.lock:
+            heap = self.heap
+            result = []
+            # entries of the heap reached so far, with their position in the heap
+            frontier = [(heap[0], 0)] if heap else []
+            while frontier and len(result) < n:
+                (km_left, version, license_plate), position = heapq.heappop(frontier)
+                if self.entries.get(license_plate, (None, None))[1] == version:
+                    result.append((license_plate, km_left))
+                for child in (2 * position + 1, 2 * position + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child], child))
+            return result
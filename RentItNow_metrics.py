@@ -0,0 +1,206 @@
+# Opt-in metrics of RentItNow: timing histograms of the expensive operations of a RentalService, a snapshot API,
+# a dump in the Prometheus text format and a sampling profiler.
+#
+# The metrics are enabled on a single service with instrument(service): the methods to measure are wrapped on that
+# instance only, so a service that is not instrumented runs exactly the same code as before (no overhead at all).
+#
+#   metrics = instrument(service)
+#   ...
+#   metrics.snapshot()                      # dict with count, sum, errors and buckets of each operation
+#   metrics.write_prometheus("rentitnow.prom")   # e.g. for the textfile collector of the node exporter
+#
+# The HTTP server exposes the same text on GET /metrics when started with --metrics.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+
+# operations measured by default. The rentals read distance and cost from the pricing tables in pay_and_commit
+# (immediate and reserved rentals alike); calculate_distance and calculate_trip_cost are only used by the menus and the simulated quotes
+DEFAULT_OPERATIONS = (
+    "rent", "select_best_car", "reserve_car", "pay_and_commit", "make_payment", "commit_rental", "generate_rental_receipt",
+    "quote", "quote_many", "calculate_distance", "calculate_trip_cost", "return_car", "find_user", "find_car_by_license_plate",
+)
+
+# upper bounds (seconds) of the buckets of the histograms
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+# durations of an operation: number of calls, total time, errors and how many calls ended in each bucket
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        position = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[position] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            values = {"count": self.count, "sum": self.sum, "max": self.max, "errors": self.errors}
+        # cumulative counts, as in Prometheus
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        values["mean"] = values["sum"] / values["count"] if values["count"] else 0.0
+        values["buckets"] = buckets
+        return values
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram(self.buckets))
+        return histogram
+
+    # wrap a function so that each call is measured in the histogram of the given name
+    def timed(self, name, function):
+        histogram = self.histogram(name)
+        clock = time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                histogram.observe(clock() - start, error=True)
+                raise
+            histogram.observe(clock() - start)
+            return result
+        return wrapper
+
+    # values of all the histograms, by operation
+    def snapshot(self):
+        return {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())}
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP rentitnow_operation_seconds Duration of the operations of the rental service.",
+            "# TYPE rentitnow_operation_seconds histogram",
+        ]
+        snapshot = self.snapshot()
+        for name, values in snapshot.items():
+            for bound, count in values["buckets"].items():
+                lines.append(f'rentitnow_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {count}')
+            lines.append(f'rentitnow_operation_seconds_sum{{operation="{name}"}} {values["sum"]:.9f}')
+            lines.append(f'rentitnow_operation_seconds_count{{operation="{name}"}} {values["count"]}')
+        lines.append("# HELP rentitnow_operation_errors_total Operations of the rental service ended with an error.")
+        lines.append("# TYPE rentitnow_operation_errors_total counter")
+        for name, values in snapshot.items():
+            lines.append(f'rentitnow_operation_errors_total{{operation="{name}"}} {values["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    # the file is written in a temporary file and then renamed, so a reader never sees it half-written
+    def write_prometheus(self, path):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary, path)
+        return path
+
+
+# Enable the metrics on a service: the given methods of the service are replaced, on this instance only,
+# by measured versions. Returns the Metrics (also available as service.metrics)
+def instrument(service, operations=DEFAULT_OPERATIONS, metrics=None):
+    if metrics is None:
+        metrics = getattr(service, "metrics", None) or Metrics()
+    for name in operations:
+        # the method of the class, so that instrumenting twice does not measure the same call twice
+        method = getattr(type(service), name).__get__(service)
+        setattr(service, name, metrics.timed(name, method))
+    service.metrics = metrics
+    return metrics
+
+# disable the metrics: the methods of the class are used again
+def uninstrument(service, operations=DEFAULT_OPERATIONS):
+    for name in operations:
+        service.__dict__.pop(name, None)
+    service.metrics = None
+
+
+# Sampling profiler: a background thread looks at the stacks of the other threads every `interval` seconds and
+# counts how many times each stack is seen. The functions seen most often are where the time goes.
+# The stacks can be written in the "collapsed" format read by flame graph tools (one stack per line, with its count)
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = {}
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return self
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="rentitnow-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = tuple(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+                              for entry in traceback.extract_stack(frame, limit=self.max_depth))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    # the n functions found most often at the top of the stacks: (function, share of the samples)
+    def top(self, n=20):
+        leaves = {}
+        total = sum(self.stacks.values()) or 1
+        for stack, count in self.stacks.items():
+            if stack:
+                leaves[stack[-1]] = leaves.get(stack[-1], 0) + count
+        return [(function, count / total) for function, count in sorted(leaves.items(), key=lambda item: -item[1])[:n]]
+
+    def write_collapsed(self, path):
+        with open(path, "w") as file:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                file.write(";".join(stack) + f" {count}\n")
+        return path
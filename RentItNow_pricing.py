@@ -0,0 +1,75 @@
+# Distances and fares of RentItNow. There are only 3 circles and 3 car types, so the distance of every route and
+# the fare of every (car type, route) are computed once when the module is imported and then only looked up.
+# quote_many prices many trips in a single call (pricing page, batch quoting jobs): when NumPy is installed the
+# fares are read from the tables with array indexing, otherwise with plain Python lists. NumPy is only imported the
+# first time trips are quoted, so importing this module (and the rental system) stays fast.
+# https://numpy.org/doc/stable/user/basics.indexing.html#integer-array-indexing
+
+CIRCLES = ["Inner Circle", "Middle Circle", "Outer Circle"]
+CIRCLE_POSITIONS = {"Inner Circle": 1, "Middle Circle": 2, "Outer Circle": 3}
+CAR_TYPES = ["ECO", "MID-CLASS", "DELUXE"]
+# each type of car has its rental price per km
+PRICE_PER_KM = {"ECO": 1, "MID-CLASS": 2, "DELUXE": 5}
+# fixed speed of each type of car (km/h)
+CAR_SPEEDS = {"ECO": 15, "MID-CLASS": 25, "DELUXE": 50}
+
+# 5 km inside the same circle, 10 km for each circle crossed
+def circle_distance(start_circle, end_circle):
+    start_position = CIRCLE_POSITIONS[start_circle]
+    end_position = CIRCLE_POSITIONS[end_circle]
+    if start_position == end_position:
+        return 5
+    return abs(end_position - start_position) * 10
+
+# tables by name: DISTANCES[(start, end)] and FARES[(car_type, start, end)]
+DISTANCES = {(start, end): circle_distance(start, end) for start in CIRCLES for end in CIRCLES}
+FARES = {(car_type, start, end): distance * PRICE_PER_KM[car_type]
+         for (start, end), distance in DISTANCES.items() for car_type in CAR_TYPES}
+
+# the same tables by position, used by quote_many: DISTANCE_TABLE[start][end] and FARE_TABLE[car_type][start][end]
+CIRCLE_CODES = {circle: code for code, circle in enumerate(CIRCLES)}
+CAR_TYPE_CODES = {car_type: code for code, car_type in enumerate(CAR_TYPES)}
+DISTANCE_TABLE = [[DISTANCES[start, end] for end in CIRCLES] for start in CIRCLES]
+FARE_TABLE = [[[FARES[car_type, start, end] for end in CIRCLES] for start in CIRCLES] for car_type in CAR_TYPES]
+# (numpy, DISTANCE_ARRAY, FARE_ARRAY) built on first need by numpy_tables; False when NumPy is not installed
+NUMPY_TABLES = None
+
+def numpy_tables():
+    global NUMPY_TABLES
+    if NUMPY_TABLES is None:
+        try:
+            import numpy
+        except ImportError:
+            NUMPY_TABLES = False
+        else:
+            NUMPY_TABLES = (numpy, numpy.array(DISTANCE_TABLE, dtype=numpy.int64), numpy.array(FARE_TABLE, dtype=numpy.int64))
+    return NUMPY_TABLES
+
+
+# turn the trips (car_type, start_circle, end_circle) into three lists of codes.
+# An unknown car type or circle raises KeyError with the unknown value
+def encode_trips(trips):
+    car_type_codes, start_codes, end_codes = [], [], []
+    for car_type, start_circle, end_circle in trips:
+        car_type_codes.append(CAR_TYPE_CODES[car_type])
+        start_codes.append(CIRCLE_CODES[start_circle])
+        end_codes.append(CIRCLE_CODES[end_circle])
+    return car_type_codes, start_codes, end_codes
+
+# price trips already given as codes (lists or NumPy arrays of the positions in CAR_TYPES and CIRCLES).
+# Returns (distances, costs): NumPy arrays when NumPy is installed, lists otherwise
+def quote_codes(car_type_codes, start_codes, end_codes):
+    tables = numpy_tables()
+    if tables:
+        numpy, DISTANCE_ARRAY, FARE_ARRAY = tables
+        car_type_codes = numpy.asarray(car_type_codes, dtype=numpy.intp)
+        start_codes = numpy.asarray(start_codes, dtype=numpy.intp)
+        end_codes = numpy.asarray(end_codes, dtype=numpy.intp)
+        return DISTANCE_ARRAY[start_codes, end_codes], FARE_ARRAY[car_type_codes, start_codes, end_codes]
+    distances = [DISTANCE_TABLE[start][end] for start, end in zip(start_codes, end_codes)]
+    costs = [FARE_TABLE[car_type][start][end] for car_type, start, end in zip(car_type_codes, start_codes, end_codes)]
+    return distances, costs
+
+# price many trips (car_type, start_circle, end_circle) at once, see quote_codes
+def quote_many(trips):
+    return quote_codes(*encode_trips(trips))
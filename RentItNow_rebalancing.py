@@ -0,0 +1,126 @@
+# Fleet rebalancing of RentItNow. Cars only move when they are rented, so over time they pile up in the circles where
+# the trips end and the users of the other circles get far away cars (or none at all).
+#
+# DemandTracker keeps the recent demand of each car type in each circle: every rental request (also the ones that
+# found no car) counts 1, and old requests count less and less (the count halves every half_life hours).
+# plan_rebalancing splits the available cars of each type between the circles in proportion to the recent demand and
+# computes the moves with the fewest km that reach that split. The circles lie on a line (10 km for each circle
+# crossed, see RentItNow_pricing), and on a line walking the circles in order and sending every surplus car to the
+# first circle that still misses cars is a minimum-cost plan: the moves never cross each other. The plan only depends
+# on the number of cars of each type in each circle (counted by the fleet index, or by the storage for the cars not in
+# memory), so it takes the same time for 100 or for 1 million cars.
+import time
+import threading
+from collections import deque
+from RentItNow_pricing import CIRCLES, CIRCLE_POSITIONS, CAR_TYPES, DISTANCES
+
+# the demand of 2 hours ago counts half of the demand of now
+DEFAULT_HALF_LIFE = 2.0
+
+
+class DemandTracker:
+    def __init__(self, half_life=DEFAULT_HALF_LIFE):
+        self.half_life = half_life
+        self.counts = {}  # (car_type, circle) -> (demand, time of the last update)
+        self.lock = threading.Lock()
+
+    def decay(self, seconds):
+        return 0.5 ** (seconds / (self.half_life * 3600))
+
+    # a rental of the given car type has been requested in the given circle (now: epoch seconds)
+    def record(self, car_type, circle, now=None):
+        now = time.time() if now is None else now
+        key = (car_type, circle)
+        with self.lock:
+            demand, updated = self.counts.get(key, (0.0, now))
+            self.counts[key] = (demand * self.decay(max(now - updated, 0)) + 1, now)
+
+    # demand of each (car_type, circle) at the given time
+    def recent_demand(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return {key: demand * self.decay(max(now - updated, 0)) for key, (demand, updated) in self.counts.items()}
+
+
+# one move of the plan: `cars` cars of the given type go from one circle to another
+class Move:
+    def __init__(self, car_type, from_circle, to_circle, cars):
+        self.car_type = car_type
+        self.from_circle = from_circle
+        self.to_circle = to_circle
+        self.cars = cars
+        self.distance = DISTANCES[from_circle, to_circle]  # km of each car
+
+    def __str__(self):
+        return f"{self.cars} {self.car_type} car(s) from {self.from_circle} to {self.to_circle} ({self.distance} km each)"
+
+
+class RebalancingPlan:
+    def __init__(self, counts, targets, moves):
+        self.counts = counts  # (car_type, circle) -> available cars now
+        self.targets = targets  # (car_type, circle) -> available cars after the plan
+        self.moves = moves
+
+    def total_distance(self):
+        return sum(move.cars * move.distance for move in self.moves)
+
+    def cars_moved(self):
+        return sum(move.cars for move in self.moves)
+
+
+# split `total` cars between the circles in proportion to their weights; the cars left by the rounding go to the
+# circles with the biggest remainders
+def split(total, weights):
+    weight_sum = sum(weights.values())
+    shares = {circle: total * weights.get(circle, 0) / weight_sum for circle in CIRCLES}
+    targets = {circle: int(share) for circle, share in shares.items()}
+    left = total - sum(targets.values())
+    for circle in sorted(CIRCLES, key=lambda circle: targets[circle] - shares[circle])[:left]:
+        targets[circle] += 1
+    return targets
+
+
+# moves with the fewest km that turn counts into targets (same total), see the top of the module.
+# Returns (from_circle, to_circle, cars)
+def line_moves(counts, targets):
+    moves = []
+    surplus = deque()  # [circle, cars] waiting for a circle that misses cars, in the order of the circles
+    missing = deque()  # [circle, cars] waiting for a circle with cars to give
+    for circle in sorted(CIRCLES, key=CIRCLE_POSITIONS.get):
+        difference = counts[circle] - targets[circle]
+        if difference > 0:
+            waiting, other = surplus, missing
+        elif difference < 0:
+            waiting, other = missing, surplus
+        else:
+            continue
+        left = abs(difference)
+        while left and other:
+            entry = other[0]
+            cars = min(left, entry[1])
+            moves.append((circle, entry[0], cars) if difference > 0 else (entry[0], circle, cars))
+            left -= cars
+            entry[1] -= cars
+            if not entry[1]:
+                other.popleft()
+        if left:
+            waiting.append([circle, left])
+    return moves
+
+
+# counts: (car_type, circle) -> available cars; demand: (car_type, circle) -> recent demand (see DemandTracker).
+# Car types without any recent demand are left where they are
+def plan_rebalancing(counts, demand):
+    car_types = list(CAR_TYPES) + sorted({car_type for car_type, _ in counts} - set(CAR_TYPES))
+    targets = dict(counts)
+    moves = []
+    for car_type in car_types:
+        weights = {circle: demand.get((car_type, circle), 0) for circle in CIRCLES}
+        if not sum(weights.values()):
+            continue
+        current = {circle: counts.get((car_type, circle), 0) for circle in CIRCLES}
+        wanted = split(sum(current.values()), weights)
+        for circle in CIRCLES:
+            targets[car_type, circle] = wanted[circle]
+        moves.extend(Move(car_type, from_circle, to_circle, cars) for from_circle, to_circle, cars in line_moves(current, wanted))
+    return RebalancingPlan(counts, targets, moves)
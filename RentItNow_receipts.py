@@ -0,0 +1,220 @@
+# Receipt pipeline: the pdf receipts are generated by a pool of worker processes, so that the rental does not
+# have to wait for the pdf to be written. Receipts waiting to be generated are kept in a bounded queue.
+# reportlab takes a long time to import, so it is only imported when the first receipt is written (in the worker
+# processes) and not when the program starts. prewarm() imports it in advance, for long-running servers.
+# https://www.reportlab.com/docs/reportlab-userguide.pdf
+# https://docs.python.org/3/library/concurrent.futures.html
+import atexit
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# the stylesheet is built only once in each worker process and then reused for all the receipts
+STYLES = None
+
+def get_styles():
+    global STYLES
+    if STYLES is None:
+        from reportlab.lib.styles import getSampleStyleSheet
+        styles = getSampleStyleSheet()
+        STYLES = (styles["Title"], styles["BodyText"])
+    return STYLES
+
+# labels of the information shown in the receipt, in order
+RECEIPT_LABELS = ("Date:", "Car:", "Car Type:", "Start Circle:", "End Circle:", "Distance Travelled (km):", "Total Cost ($):")
+
+# build the list of paragraphs of a receipt
+def receipt_elements(username, date, car_name, car_type, start_circle, end_circle, distance, total_cost):
+    from reportlab.platypus import Paragraph, Spacer
+    title_style, body_style = get_styles()
+    elements = [Paragraph(f"Rental Receipt for {username}", title_style)]
+    values = (date, car_name, car_type, start_circle, end_circle, str(distance), str(total_cost))
+    for label, value in zip(RECEIPT_LABELS, values):
+        elements.append(Paragraph(f"<b>{label}</b> {value}", body_style))
+    elements.append(Spacer(1, 12))
+    return elements
+
+# unique name for the receipt file of a user: the timestamp has microseconds and is followed by the process id
+# and a counter, so two receipts generated in the same minute (or by two programs at the same time) never overwrite each other
+RECEIPT_COUNTER = itertools.count(1)
+
+def receipt_filename(username):
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+    return f"{username}_rental_receipt_{timestamp}_{os.getpid()}-{next(RECEIPT_COUNTER)}.pdf"
+
+# write the receipt in the given file. It runs in the worker processes, so it only receives plain values
+def render_receipt(filename, username, date, car_name, car_type, start_circle, end_circle, distance, total_cost):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+    doc = SimpleDocTemplate(filename, pagesize=letter)
+    doc.build(receipt_elements(username, date, car_name, car_type, start_circle, end_circle, distance, total_cost))
+    return filename
+
+# import reportlab and write a receipt in memory, so that the fonts are loaded too and the first real receipt is
+# as fast as the others. Returns the process id (see ReceiptPipeline.prewarm)
+def prewarm():
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+    SimpleDocTemplate(io.BytesIO(), pagesize=letter).build(receipt_elements("prewarm", "", "", "", "", "", 0, 0))
+    return os.getpid()
+
+
+# Batch rendering: many rentals are written in a single multi-page pdf (one page per rental) or in a zip file
+# with one pdf per rental. Each rental is a tuple with the same values of render_receipt, without the filename:
+# (username, date, car_name, car_type, start_circle, end_circle, distance, total_cost).
+# The rentals are read one by one from any iterable, so thousands of rentals can come directly from the database.
+# In "pdf" mode at most pages_per_file pages are kept in memory: longer batches are split in several volumes
+# (output_part001.pdf, output_part002.pdf, ...). The list of the written files is returned
+def render_receipts_batch(rentals, output, mode="pdf", pages_per_file=500):
+    if mode == "pdf":
+        return render_receipts_pdf(rentals, output, pages_per_file)
+    elif mode == "zip":
+        return [render_receipts_zip(rentals, output)]
+    else:
+        raise ValueError(f"Unknown batch mode {mode!r}: use 'pdf' or 'zip'")
+
+def render_receipts_pdf(rentals, output, pages_per_file):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, PageBreak
+    stem = output[:-4] if output.lower().endswith(".pdf") else output
+    filenames = []
+    rentals = iter(rentals)
+    while True:
+        chunk = list(itertools.islice(rentals, pages_per_file))
+        if not chunk and filenames:
+            break
+        filename = f"{stem}_part{len(filenames) + 1:03d}.pdf"
+        elements = []
+        for rental in chunk:
+            if elements:
+                elements.append(PageBreak())
+            elements.extend(receipt_elements(*rental))
+        if not elements:
+            elements.append(Paragraph("No rentals", get_styles()[1]))
+        SimpleDocTemplate(filename, pagesize=letter).build(elements)
+        filenames.append(filename)
+        if len(chunk) < pages_per_file:
+            break
+    # a batch written in a single volume takes the name of the output
+    if len(filenames) == 1:
+        os.replace(filenames[0], f"{stem}.pdf")
+        filenames = [f"{stem}.pdf"]
+    return filenames
+
+# each receipt is written in memory and then added to the zip file, so only one receipt at a time is in memory
+def render_receipts_zip(rentals, output):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for number, rental in enumerate(rentals, start=1):
+            username, date = rental[0], rental[1]
+            buffer = io.BytesIO()
+            SimpleDocTemplate(buffer, pagesize=letter).build(receipt_elements(*rental))
+            safe_date = str(date).replace(" ", "_").replace(":", "-")
+            archive.writestr(f"{username}_rental_receipt_{safe_date}_{number:06d}.pdf", buffer.getvalue())
+    return output
+
+
+# Handle of a receipt being generated: the filename is known immediately, the file is ready when done() is True
+class Receipt:
+    def __init__(self, filename, future):
+        self.filename = filename
+        self.future = future
+
+    def done(self):
+        return self.future.done()
+
+    # wait for the receipt to be written and return its filename (raises the error of the worker, if any)
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+# start method of the worker processes. The pool is usually started from a thread of the server, and forking a process
+# with several threads can leave the child stuck on a lock held by another thread: the workers are forked by a
+# separate single-threaded server process instead (or started from scratch where forkserver is not available)
+def worker_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+# Pool of processes generating the receipts. When max_pending receipts are already waiting, submit() waits
+# until one of them is done. With max_workers=0 the receipts are generated directly in the calling process.
+# on_error(filename, error) is called when a receipt written in the background fails (default: logged)
+class ReceiptPipeline:
+    def __init__(self, max_workers=2, max_pending=64, on_error=None):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=worker_context()) if max_workers else None
+        self.on_error = on_error
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        # receipts still in the queue are written before the program exits
+        atexit.register(self.shutdown)
+
+    def submit(self, filename, username, date, car_name, car_type, start_circle, end_circle, distance, total_cost):
+        if self.closed:
+            raise RuntimeError("The receipt pipeline has been shut down")
+        details = (filename, username, date, car_name, car_type, start_circle, end_circle, distance, total_cost)
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(render_receipt(*details))
+            except Exception as error:
+                future.set_exception(error)
+            return Receipt(filename, future)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(render_receipt, *details)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(lambda future: self.receipt_done(filename, future))
+        return Receipt(filename, future)
+
+    # start the worker processes and import reportlab in all of them now, instead of at the first receipt
+    def prewarm(self):
+        if self.executor is None:
+            prewarm()
+            return
+        wait([self.executor.submit(prewarm) for _ in range(self.max_workers)])
+
+    def receipt_done(self, filename, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+        if future.cancelled() or future.exception() is None:
+            return
+        self.report_error(filename, future.exception())
+
+    # a receipt could not be generated (or not even submitted): on_error is called, or the error is logged
+    def report_error(self, filename, error):
+        if self.on_error is not None:
+            self.on_error(filename, error)
+        else:
+            logger.error("Rental receipt %s could not be generated: %s", filename, error)
+
+    # wait until all the receipts submitted so far are written
+    def flush(self, timeout=None):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending, timeout=timeout)
+
+    # write the receipts still in the queue and stop the worker processes
+    def shutdown(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.executor is not None:
+            self.flush()
+            self.executor.shutdown(wait=True)
+        atexit.unregister(self.shutdown)
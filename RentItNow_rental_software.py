@@ -1,18 +1,44 @@
 # Import packages
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from datetime import datetime
+import argparse
+import heapq
+import itertools
+import sys
+import threading
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from RentItNow_storage import Storage, SQLiteStorage
+from RentItNow_wait_time import WaitTimeEstimator, WaitEstimate
+from RentItNow_eventlog import (EventLog, CAR_ADDED, CAR_UPDATED, CAR_REMOVED, CAR_SERVICED, USER_ADDED, USER_UPDATED,
+                                USER_REMOVED, RENTAL_STARTED, RENTAL_RETURNED)
+from RentItNow_pricing import CIRCLES, CIRCLE_POSITIONS, PRICE_PER_KM, CAR_SPEEDS, DISTANCES, FARES, quote_many
+from RentItNow_maintenance import MaintenanceScheduler
+from RentItNow_rebalancing import DemandTracker, plan_rebalancing
+from RentItNow_reports import RentalReports, REPORT_TITLES
+from RentItNow_reservations import Reservation, ReservationBook, parse_time, TIME_FORMAT
+from RentItNow_receipts import ReceiptPipeline, receipt_filename, render_receipts_batch
 
-# Class car creation: A car has (at least) a type, a license plate, a brand, a name. The location is present as well to track the default location of the car
+# maximum number of passengers for each type of car: ECO for max 2 persons, MID-CLASS for max 4 persons, DELUXE for max 7 persons
+MAX_PASSENGERS = {"ECO": 2, "MID-CLASS": 4, "DELUXE": 7}
+
+# car types, brands and locations are repeated by thousands of cars: they are interned so that all the cars share
+# the same string objects
+def intern_string(value):
+    return sys.intern(value) if type(value) is str else value
+
+# Class car creation: A car has (at least) a type, a license plate, a brand, a name. The location is present as well to track the default location of the car.
+# The attributes are stored in slots instead of a per-car __dict__, to keep big fleets small in memory
 class Car: 
+    __slots__ = ("car_type", "license_plate", "brand", "name", "location", "total_distance_travelled", "next_service_time",
+                 "availability", "is_in_service")
+
     def __init__(self, car_type, license_plate, brand, name, location):
-        self.car_type = car_type
+        self.car_type = intern_string(car_type)
         self.license_plate = license_plate
-        self.brand = brand
+        self.brand = intern_string(brand)
         self.name = name
-        self.location = location
+        self.location = intern_string(location)
         self.total_distance_travelled = 0  # total distance travelled is by default equal to 0
         self.next_service_time = 1500  # next service time is by default programmed in 1500 km
         self.availability = True  # availability is by default set to true
@@ -23,17 +49,426 @@ class Car:
 
     # define the maximum number of passengers for each type of car
     def get_max_passengers(self):  
-        if self.car_type == "ECO":
-            return 2
-        elif self.car_type == "MID-CLASS":
-            return 4
-        elif self.car_type == "DELUXE":
-            return 7
+        return MAX_PASSENGERS.get(self.car_type)
+
+# rebuild a car from the row loaded from the storage (car_factory builds the car, see RentalService)
+def car_from_row(row, car_factory=Car):
+    car_type, license_plate, brand, name, location, total_distance_travelled, next_service_time, availability, is_in_service = row
+    car = car_factory(car_type, license_plate, brand, name, location)
+    car.total_distance_travelled = total_distance_travelled
+    car.next_service_time = next_service_time
+    car.availability = bool(availability)
+    car.is_in_service = bool(is_in_service)
+    return car
+
+# row of a car, as saved in the storage and in the event log
+def car_row(car):
+    return (car.car_type, car.license_plate, car.brand, car.name, car.location, car.total_distance_travelled,
+            car.next_service_time, car.availability, car.is_in_service)
+
+# Columnar fleet: the cars of a very big fleet (e.g. a simulation with millions of cars) are kept in a few arrays,
+# one per attribute, instead of one object per car. Distances are integer km in array("i"), availability and
+# service flags are bytes, car types and locations are small codes into a shared table of strings and brands are interned.
+# new_car() adds a car and returns a CarView, which has the same attributes and methods of a Car, so the fleet can
+# be used by the RentalService: RentalService(car_factory=fleet.new_car). The service then keeps only the row of each
+# car (see ColumnarCars) and the views are created when a car is looked up, so there is no Python object per car.
+# Removed cars are not taken out of the arrays (their rows are simply no longer used)
+class ColumnarFleet:
+    def __init__(self):
+        self.car_types = array("H")
+        self.license_plates = []
+        self.brands = []
+        self.names = []
+        self.locations = array("H")
+        self.total_distance_travelled = array("i")
+        self.next_service_time = array("i")
+        self.availability = bytearray()
+        self.is_in_service = bytearray()
+        # shared table of the car types and locations: codes[string] is the position of the string in strings
+        self.strings = []
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.license_plates)
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(string)
+                if code is None:
+                    code = len(self.strings)
+                    self.strings.append(intern_string(string))
+                    self.codes[string] = code
+        return code
+
+    # same arguments and defaults of Car
+    def new_car(self, car_type, license_plate, brand, name, location):
+        car_type_code = self.code(car_type)
+        location_code = self.code(location)
+        with self.lock:
+            index = len(self.license_plates)
+            self.car_types.append(car_type_code)
+            self.license_plates.append(license_plate)
+            self.brands.append(intern_string(brand))
+            self.names.append(name)
+            self.locations.append(location_code)
+            self.total_distance_travelled.append(0)
+            self.next_service_time.append(1500)
+            self.availability.append(1)
+            self.is_in_service.append(0)
+        return CarView(self, index)
+
+    # view of the car in the given row
+    def car(self, index):
+        if not 0 <= index < len(self.license_plates):
+            raise IndexError(index)
+        return CarView(self, index)
+
+
+# attribute of a CarView stored in a column of the fleet (convert is applied to the values set)
+def fleet_column(column, convert=None):
+    def get(self):
+        return getattr(self.fleet, column)[self.index]
+    def set(self, value):
+        getattr(self.fleet, column)[self.index] = convert(value) if convert is not None else value
+    return property(get, set)
+
+def fleet_flag(column):
+    def get(self):
+        return bool(getattr(self.fleet, column)[self.index])
+    def set(self, value):
+        getattr(self.fleet, column)[self.index] = 1 if value else 0
+    return property(get, set)
+
+def fleet_string(column):
+    def get(self):
+        return self.fleet.strings[getattr(self.fleet, column)[self.index]]
+    def set(self, value):
+        getattr(self.fleet, column)[self.index] = self.fleet.code(value)
+    return property(get, set)
+
+
+# Lightweight view of a car of a ColumnarFleet: it only holds the fleet and the row of the car.
+# Two views of the same row are equal, so they can be used in place of each other as keys of dicts and sets
+class CarView:
+    __slots__ = ("fleet", "index")
+
+    car_type = fleet_string("car_types")
+    license_plate = fleet_column("license_plates")
+    brand = fleet_column("brands", intern_string)
+    name = fleet_column("names")
+    location = fleet_string("locations")
+    total_distance_travelled = fleet_column("total_distance_travelled")
+    next_service_time = fleet_column("next_service_time")
+    availability = fleet_flag("availability")
+    is_in_service = fleet_flag("is_in_service")
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CarView) and self.fleet is other.fleet and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.fleet), self.index))
+
+    def __str__(self):
+        return f"{self.name} ({self.car_type})"
+
+    def get_max_passengers(self):
+        return MAX_PASSENGERS.get(self.car_type)
+
+
+# Cars of a RentalService kept in a ColumnarFleet: works like the dict license_plate -> car of the service, but only
+# stores the row of each car. A new CarView is returned every time a car is looked up
+class ColumnarCars:
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.rows = {}  # license_plate -> row of the car in the fleet
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, license_plate):
+        return license_plate in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, license_plate):
+        return CarView(self.fleet, self.rows[license_plate])
+
+    def get(self, license_plate, default=None):
+        index = self.rows.get(license_plate)
+        return CarView(self.fleet, index) if index is not None else default
+
+    def __setitem__(self, license_plate, car):
+        if not isinstance(car, CarView) or car.fleet is not self.fleet:
+            raise TypeError("Only the cars of the fleet can be added")
+        self.rows[license_plate] = car.index
+
+    def __delitem__(self, license_plate):
+        del self.rows[license_plate]
+
+    def values(self):
+        return (CarView(self.fleet, index) for index in list(self.rows.values()))
+
+
+# Fleet index: cars are grouped in buckets keyed by (car_type, location), and each bucket keeps the available
+# and the not available cars separately, so that the best car can be picked without scanning the whole fleet.
+# Buckets are OrderedDicts used as ordered sets: the first available car of a bucket is retrieved in O(1) and a car
+# is added or removed in O(1). A plain dict would not do: after many cars are taken from the front of a dict, iterating
+# it has to skip all their deleted slots, so emptying a bucket one car at a time would take quadratic time.
+# Each bucket has its own lock, so rentals of different car types or in different circles never wait for each other,
+# and reserve() takes a car out of the available ones atomically: two rentals can never get the same car.
+# The buckets only hold the license plates (resolve gives back the car of a license plate), so the index adds no
+# object per car: this matters for a ColumnarFleet, whose cars are only views created when needed.
+# The available cars with reservations in advance (booked) are kept apart from the others: an available car without
+# reservations is free in any future period, so a reservation takes the first one in O(1) and only the booked cars
+# and the cars on rent have to be checked against their calendar (see find)
+class FleetIndex:
+    def __init__(self, resolve):
+        self.resolve = resolve  # license_plate -> car
+        self.available = {}  # (car_type, location) -> OrderedDict {license_plate: None} of the available cars without reservations
+        self.booked = {}  # (car_type, location) -> OrderedDict {license_plate: None} of the available cars with reservations
+        self.unavailable = {}  # (car_type, location) -> OrderedDict {license_plate: None} of the cars currently not available
+        self.positions = {}  # license_plate -> (key, availability, booked) under which the car is currently indexed
+        self.booked_plates = set()  # cars with reservations in advance (indexed or not)
+        # (key, availability, booked) -> the same tuple, shared by all the positions instead of a new tuple for each car
+        self.shared_positions = {}
+        self.locks = {}  # (car_type, location) -> lock of the bucket
+        self.locks_lock = threading.Lock()
+
+    def bucket_lock(self, key):
+        lock = self.locks.get(key)
+        if lock is None:
+            with self.locks_lock:
+                lock = self.locks.setdefault(key, threading.Lock())
+        return lock
+
+    # lock the buckets of the given keys, always in the same order to avoid deadlocks
+    @contextmanager
+    def locked(self, *keys):
+        locks = [self.bucket_lock(key) for key in sorted(set(keys), key=str)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def buckets(self, availability, booked):
+        if not availability:
+            return self.unavailable
+        return self.booked if booked else self.available
+
+    def insert(self, license_plate, key, availability):
+        booked = availability and license_plate in self.booked_plates
+        buckets = self.buckets(availability, booked)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = OrderedDict()
+        bucket[license_plate] = None
+        position = (key, availability, booked)
+        self.positions[license_plate] = self.shared_positions.setdefault(position, position)
+
+    def delete(self, license_plate, position):
+        key, availability, booked = position
+        buckets = self.buckets(availability, booked)
+        bucket = buckets.get(key)
+        if bucket is not None:
+            bucket.pop(license_plate, None)
+            if not bucket:
+                del buckets[key]
+        del self.positions[license_plate]
+
+    # add a car to the bucket matching its current type, location and availability
+    def add(self, car):
+        key = (car.car_type, car.location)
+        with self.locked(key):
+            self.insert(car.license_plate, key, car.availability)
+
+    # remove a car from the bucket it was indexed in
+    def remove(self, car):
+        license_plate = car.license_plate
+        while True:
+            position = self.positions.get(license_plate)
+            if position is None:
+                return
+            with self.locked(position[0]):
+                # the car may have been moved by another thread in the meantime
+                if self.positions.get(license_plate) == position:
+                    self.delete(license_plate, position)
+                    return
+
+    # move a car to the right bucket after its type, location or availability has been changed
+    # (cars removed from the index are not added back)
+    def update(self, car):
+        license_plate = car.license_plate
+        while True:
+            position = self.positions.get(license_plate)
+            if position is None:
+                return
+            key = (car.car_type, car.location)
+            if position[0] == key and position[1] == car.availability:
+                return
+            with self.locked(position[0], key):
+                if self.positions.get(license_plate) == position:
+                    self.delete(license_plate, position)
+                    self.insert(license_plate, key, car.availability)
+                    return
+
+    # change the availability of a car and move it to the right bucket
+    def set_availability(self, car, availability):
+        license_plate = car.license_plate
+        while True:
+            position = self.positions.get(license_plate)
+            if position is None:
+                car.availability = availability
+                return
+            with self.locked(position[0]):
+                if self.positions.get(license_plate) == position:
+                    car.availability = availability
+                    self.delete(license_plate, position)
+                    self.insert(license_plate, position[0], availability)
+                    return
+
+    # first available car of a bucket accepted by accept, the cars without reservations first
+    # (the lock of the bucket must be held)
+    def pick(self, key, accept):
+        for buckets in (self.available, self.booked):
+            bucket = buckets.get(key)
+            if bucket:
+                if accept is None:
+                    return self.resolve(next(iter(bucket)))
+                for license_plate in bucket:
+                    car = self.resolve(license_plate)
+                    if accept(car):
+                        return car
+        return None
+
+    # return the first available car of the given type in the given circle (or None).
+    # When accept is given, only the cars for which accept(car) is True are considered
+    def first_available(self, car_type, location, accept=None):
+        key = (car_type, location)
+        with self.locked(key):
+            return self.pick(key, accept)
+
+    # take the first available car of the given type in the given circle out of the available cars and return it
+    # (or None): the check and the update are done while holding the lock of the bucket
+    def reserve(self, car_type, location, accept=None):
+        key = (car_type, location)
+        with self.locked(key):
+            car = self.pick(key, accept)
+            if car is None:
+                return None
+            self.delete(car.license_plate, self.positions[car.license_plate])
+            car.availability = False
+            self.insert(car.license_plate, key, False)
+            return car
+
+    # take the given car out of the available cars: returns False if the car is not available
+    def take(self, car):
+        def take_car(car):
+            position = self.positions.get(car.license_plate)
+            if position is None or not position[1]:
+                return False
+            car.availability = False
+            self.delete(car.license_plate, position)
+            self.insert(car.license_plate, position[0], False)
+            return True
+        return self.with_car_locked(car, take_car)
+
+    # number of available cars of the given type in the given circle
+    def available_count(self, car_type, location):
+        key = (car_type, location)
+        return len(self.available.get(key, ())) + len(self.booked.get(key, ()))
+
+    # number of available cars of the whole fleet
+    def available_total(self):
+        return sum(len(bucket) for buckets in (self.available, self.booked) for bucket in buckets.values())
+
+    # all the cars (available or not) of the given type in the given circle
+    def cars(self, car_type, location):
+        key = (car_type, location)
+        with self.locked(key):
+            return [self.resolve(license_plate) for buckets in (self.available, self.booked, self.unavailable)
+                    for license_plate in buckets.get(key, ())]
+
+    # available cars without reservations in advance of the given type in the given circle (at most limit)
+    def unbooked_cars(self, car_type, location, limit=None):
+        key = (car_type, location)
+        with self.locked(key):
+            plates = list(itertools.islice(self.available.get(key, ()), limit))
+        return [self.resolve(license_plate) for license_plate in plates]
+
+    # booked and not available cars of the given type in the given circle: the ones that unbooked_cars leaves out
+    def booked_or_unavailable_cars(self, car_type, location):
+        key = (car_type, location)
+        with self.locked(key):
+            plates = list(self.booked.get(key, ())) + list(self.unavailable.get(key, ()))
+        return [self.resolve(license_plate) for license_plate in plates]
+
+    # call function(car) on the cars of the given type in the given circle (available without reservations first,
+    # then booked, then not available) while holding the lock of the bucket, and stop at the first result that is not
+    # None. The cars are not copied: the search ends as soon as a car fits
+    def find(self, car_type, location, function):
+        key = (car_type, location)
+        with self.locked(key):
+            for buckets in (self.available, self.booked, self.unavailable):
+                for license_plate in buckets.get(key, ()):
+                    result = function(self.resolve(license_plate))
+                    if result is not None:
+                        return result
+        return None
+
+    # the car has (booked=True) or has no longer reservations in advance: it is moved to the right bucket
+    # (the lock of the bucket of the car must be held)
+    def rebook(self, license_plate, booked):
+        if booked:
+            self.booked_plates.add(license_plate)
         else:
-            return None
+            self.booked_plates.discard(license_plate)
+        position = self.positions.get(license_plate)
+        if position is not None and position[1] and position[2] != booked:
+            self.delete(license_plate, position)
+            self.insert(license_plate, position[0], True)
+
+    # same as rebook, taking the lock of the bucket of the car. booked() tells whether the car has reservations
+    # and is called while holding the lock, so that it sees the reservations made in the meantime
+    def update_booked(self, license_plate, booked):
+        while True:
+            position = self.positions.get(license_plate)
+            if position is None:
+                self.rebook(license_plate, booked())
+                # the car may have been indexed in the meantime
+                if self.positions.get(license_plate) is None:
+                    return
+                continue
+            with self.locked(position[0]):
+                if self.positions.get(license_plate) == position:
+                    self.rebook(license_plate, booked())
+                    return
+
+    # call function(car) while holding the lock of the bucket the car is indexed in, so that the car is not
+    # reserved or moved by other threads in the meantime
+    def with_car_locked(self, car, function):
+        while True:
+            position = self.positions.get(car.license_plate)
+            if position is None:
+                return function(car)
+            with self.locked(position[0]):
+                if self.positions.get(car.license_plate) == position:
+                    return function(car)
 
 # Class User creation: User has (at least) name, surname, address, credit card, driving license
 class User:
+    __slots__ = ("name", "surname", "address", "credit_card", "driving_license")
+
     def __init__(self, name, surname, address, credit_card, driving_license):
         self.name = name
         self.surname = surname
@@ -41,54 +476,1062 @@ class User:
         self.credit_card = credit_card
         self.driving_license = driving_license
 
-# Class RentItNow creation to manage the rental process
-class RentItNow:
-    def __init__(self):
-        # initialize empty lists to store cars and users in database and currently rented cars
-        self.cars = [] 
-        self.users = []
-        self.rented_cars = []
+# for each start circle, the circles sorted from the closest to the farthest one
+# (the circles, the distances and the fares are defined in RentItNow_pricing)
+CIRCLES_BY_DISTANCE = {
+    start: sorted(CIRCLES, key=lambda circle: abs(CIRCLE_POSITIONS[circle] - CIRCLE_POSITIONS[start]))
+    for start in CIRCLES
+}
+
+# number of returned rentals kept in memory by the RentalService
+RENTAL_HISTORY_SIZE = 1000
+# the totals of the reports are saved in a persistent storage every REPORT_TOTALS_EVERY rentals (and at close)
+REPORT_TOTALS_EVERY = 10000
+
+# Errors raised by the RentalService: every error is a RentItNowError, so a front end can catch them all together
+class RentItNowError(Exception):
+    pass
+
+# a value given to the service is not valid (unknown car type or circle, too many passengers, ...)
+class InvalidInputError(RentItNowError, ValueError):
+    pass
+
+# the requested car, user or rental is not present in the database
+class NotFoundError(RentItNowError, LookupError):
+    pass
+
+# a car with the same license plate or a user with the same name is already present in the database
+class AlreadyExistsError(RentItNowError):
+    pass
+
+# no car of the requested type is available: waiting_time is the expected waiting time in hours and estimate the
+# WaitEstimate it comes from (when and where the next car should be free, see RentItNow_wait_time).
+# waiting_time is None when no car can be reserved in the requested period
+class CarNotAvailableError(RentItNowError):
+    def __init__(self, car_type, waiting_time=None, estimate=None):
+        if estimate is not None:
+            waiting_time = estimate.hours
+            super().__init__(str(estimate))
+        elif waiting_time is None:
+            super().__init__(f"Sorry, no {car_type} car is free in the requested period")
+        else:
+            super().__init__(f"Sorry, the requested {car_type} car is not available. "
+                             f"The maximum waiting time is approximately {waiting_time:.2f} hours")
+        self.car_type = car_type
+        self.waiting_time = waiting_time
+        self.estimate = estimate
+
 
-    # method to generate a receipt after the rental and the payment details are confirmed
-    # https://www.reportlab.com/docs/reportlab-userguide.pdf
+# Class Rental creation: a rental stores who rented which car, the route, the distance, the cost and when it was made.
+# The receipt is the Receipt returned by the receipt pipeline (None when no receipt was generated)
+class Rental:
+    def __init__(self, rental_id, username, car, start_circle, end_circle, distance, total_cost, rented_at, receipt=None):
+        self.rental_id = rental_id
+        self.username = username
+        self.car = car
+        self.start_circle = start_circle
+        self.end_circle = end_circle
+        self.distance = distance
+        self.total_cost = total_cost
+        self.rented_at = rented_at
+        self.receipt = receipt
+        self.returned_at = None  # set when the car is returned
+
+    def __str__(self):
+        return f"{self.car} from {self.start_circle} to {self.end_circle}"
+
+
+# Class RentalService creation: it holds the cars, users and rentals and implements all the operations of RentItNow
+# without asking anything to the user. Every method takes its values as arguments, returns the result
+# (a Car, a User, a Rental, ...) and raises a RentItNowError when the operation cannot be done.
+# The interactive menus of RentItNow and any other front end are built on top of it
+class RentalService:
+    def __init__(self, storage=None, receipts=None, car_factory=Car, event_log=None):
+        # initialize the registries of cars (by license plate) and users (by name) in database and of the currently rented cars (by license plate).
+        # With the car_factory of a ColumnarFleet the cars stay in the columns of the fleet (see ColumnarCars)
+        fleet = getattr(car_factory, "__self__", None)
+        self.cars = ColumnarCars(fleet) if isinstance(fleet, ColumnarFleet) else {}
+        self.users = {}
+        self.rented_cars = {}
+        # last returned rentals (the older ones are only kept in the storage)
+        self.rental_history = deque(maxlen=RENTAL_HISTORY_SIZE)
+        # index of the cars by type, location and availability used to select the best car
+        self.fleet_index = FleetIndex(lambda license_plate: self.cars[license_plate])
+        # cars ordered by the km left before their next service
+        self.maintenance = MaintenanceScheduler()
+        # cars on rent ordered by the time their trip ends, to estimate the waiting times
+        self.wait_times = WaitTimeEstimator()
+        # storage where cars, users and rentals are saved (by default they are only kept in memory).
+        # Cars and users are loaded from the storage only when needed: loaded_buckets tracks the (car_type, location)
+        # buckets of the fleet index already loaded
+        self.storage = storage if storage is not None else Storage()
+        self.loaded_buckets = set()
+        # pool of worker processes generating the pdf receipts (receipts=False disables the receipts)
+        if receipts is None:
+            receipts = ReceiptPipeline()
+        self.receipts = receipts or None
+        # function building the cars: Car, or ColumnarFleet.new_car to keep the whole fleet in a few arrays
+        self.car_factory = car_factory
+        # identifiers of the rentals and reservations made when the storage does not assign them
+        self.rental_ids = itertools.count(1)
+        self.reservation_ids = itertools.count(1)
+        # reservations of cars in advance, with the calendar of each reserved car
+        self.reservations = ReservationBook()
+        for row in self.storage.load_reservations():
+            reservation_id, username, license_plate, car_type, start_circle, end_circle, start, end = row
+            self.reservations.add(Reservation(reservation_id, username, license_plate, car_type, start_circle, end_circle,
+                                              parse_time(start), parse_time(end)))
+            self.fleet_index.booked_plates.add(license_plate)
+        # the service can be used by several threads at the same time (e.g. by the HTTP server):
+        # the lock protects the registries of cars and users, while the cars are allocated with the locks
+        # of the fleet index buckets
+        self.lock = threading.RLock()
+        # append-only log of the rentals, returns, services and changes of cars and users (None: no log)
+        self.event_log = event_log
+        if event_log is not None:
+            if self.storage.persistent:
+                event_log.drop_rows()
+            elif not event_log.keep_rows:
+                raise InvalidInputError("Without a persistent storage the event log must keep the rows of the cars and users")
+            self.restore_from_event_log()
+        # totals of the rentals used by the reports, updated at every rental. Without a persistent storage the event
+        # log keeps them (and saves them in its snapshot)
+        self.rentals_since_report_totals = 0
+        self.last_reported_rental = 0
+        if event_log is not None and not self.storage.persistent:
+            self.reports = event_log.reports
+        else:
+            self.reports = RentalReports()
+            self.load_reports()
+        # recent rental requests of each car type in each circle, used to rebalance the fleet
+        self.demand = DemandTracker()
+        # timing metrics of the operations, set by RentItNow_metrics.instrument (None: metrics disabled)
+        self.metrics = None
+
+    # add a car kept in memory to the fleet index and to the service schedule
+    def index_car(self, car):
+        self.fleet_index.add(car)
+        self.maintenance.update(car.license_plate, car.next_service_time)
+
+    # append an event to the event log (if any)
+    def log_event(self, kind, *values):
+        if self.event_log is not None:
+            self.event_log.append(kind, *values)
+
+    # events about a car end with the row of the car after the change
+    def log_car(self, kind, car, *values):
+        if self.event_log is not None:
+            self.event_log.append(kind, *values, *car_row(car))
+
+    # rebuild the state kept in memory from the event log: the active rentals and, when the storage does not keep
+    # the data between two runs, also the cars and the users
+    def restore_from_event_log(self):
+        state = self.event_log.state
+        if not self.storage.persistent:
+            for row in state["cars"].values():
+                car = car_from_row(row, self.car_factory)
+                self.cars[car.license_plate] = car
+                self.index_car(car)
+            for name, row in state["users"].items():
+                self.users[name] = User(*row)
+        for license_plate, row in state["active"].items():
+            car = self.find_car_by_license_plate(license_plate)
+            if car is not None:
+                rental = self.rental_from_row(row, car)
+                self.rented_cars[license_plate] = rental
+                self.track_rental(rental)
+        self.rental_ids = itertools.count(state["last_rental_id"] + 1)
+
+    # the totals of the reports are loaded at startup from the storage, and only the rentals made after they were
+    # saved are added to them
+    def load_reports(self):
+        saved = self.storage.load_report_totals()
+        if saved is not None:
+            self.last_reported_rental, totals = saved
+            self.reports.load_state(totals)
+        for row in self.storage.iter_rental_history(self.last_reported_rental):
+            self.reports.record(*row[:7])
+            self.last_reported_rental = row[7]
+            self.rentals_since_report_totals += 1
+
+    # add a committed rental to the reports (when the event log keeps them, it records the rental itself).
+    # It is called in the storage batch that saves the rental, so the totals saved in the storage include exactly
+    # the rentals up to last_reported_rental
+    def record_rental(self, rental_id, car, start_circle, end_circle, distance, total_cost, rented_at):
+        if self.event_log is not None and not self.storage.persistent:
+            return
+        self.reports.record(car.car_type, car.license_plate, start_circle, end_circle, distance, total_cost, rented_at)
+        if self.storage.persistent:
+            self.last_reported_rental = rental_id
+            self.rentals_since_report_totals += 1
+            if self.rentals_since_report_totals >= REPORT_TOTALS_EVERY:
+                self.save_report_totals()
+
+    def save_report_totals(self):
+        with self.storage.batch():
+            self.storage.save_report_totals(self.last_reported_rental, self.reports.state())
+            self.rentals_since_report_totals = 0
+
+    # reports on the rental trends, by name: each one is (header, rows), see RentItNow_reports
+    def rental_reports(self):
+        return self.reports.tables()
+
+    # export the reports as csv files (<output>_<report>.csv) or as a single pdf (<output>.pdf)
+    def export_reports(self, output, mode="pdf"):
+        if mode == "csv":
+            return self.reports.export_csv(output)
+        if mode == "pdf":
+            return [self.reports.export_pdf(f"{output}.pdf")]
+        raise InvalidInputError(f"Invalid mode {mode!r}. Please enter csv or pdf")
+
+    # check the values given to the service
+    def check_car_type(self, car_type):
+        if car_type not in MAX_PASSENGERS:
+            raise InvalidInputError(f"Invalid car type {car_type!r}. Please enter ECO, MID-CLASS, or DELUXE")
+
+    def check_circle(self, circle):
+        if circle not in CIRCLE_POSITIONS:
+            raise InvalidInputError(f"Invalid circle {circle!r}. Please enter Inner Circle, Middle Circle, or Outer Circle")
+
+    def check_passengers(self, car_type, num_passengers):
+        if not isinstance(num_passengers, int) or num_passengers < 1:
+            raise InvalidInputError(f"Invalid number of passengers {num_passengers!r}")
+        if num_passengers > MAX_PASSENGERS[car_type]:
+            raise InvalidInputError(f"Maximum number of passengers for {car_type} car is {MAX_PASSENGERS[car_type]}.")
+
+    # method to check if the user is present in the database based on his/her name
+    # (if the user is not in memory yet it is loaded from the storage)
+    def find_user(self, username):
+        with self.lock:
+            user = self.users.get(username)
+            if user is None:
+                row = self.storage.load_user(username)
+                if row is not None:
+                    user = User(*row)
+                    self.users[username] = user
+            return user
+
+    # same as find_user, but raises NotFoundError if the user is not present
+    def get_user(self, username):
+        user = self.find_user(username)
+        if user is None:
+            raise NotFoundError(f"User {username!r} not found. Please enter an existing user")
+        return user
+
+    # store a user in the database. The name identifies the user, so it has to be unique
+    def register_user(self, user):
+        with self.lock:
+            if self.find_user(user.name):
+                return False
+            self.users[user.name] = user
+            self.storage.save_user(user)
+            self.log_event(USER_ADDED, user.name, user.name, user.surname, user.address, user.credit_card, user.driving_license)
+            return True
+
+    def add_user(self, name, surname, address, credit_card, driving_license):
+        user = User(name, surname, address, credit_card, driving_license)
+        if not self.register_user(user):
+            raise AlreadyExistsError(f"A user with name {name!r} is already present")
+        return user
+
+    # update the details of a user: only the given values are changed. The user can also change name
+    def update_user(self, username, name=None, surname=None, address=None, credit_card=None, driving_license=None):
+        with self.lock:
+            user = self.get_user(username)
+            if name is not None and name != username:
+                if self.find_user(name):
+                    raise AlreadyExistsError(f"A user with name {name!r} is already present")
+                # the user is stored by name, so the registry is updated as well
+                del self.users[username]
+                self.users[name] = user
+                user.name = name
+            if surname is not None:
+                user.surname = surname
+            if address is not None:
+                user.address = address
+            if credit_card is not None:
+                user.credit_card = credit_card
+            if driving_license is not None:
+                user.driving_license = driving_license
+            self.storage.save_user(user, old_name=username)
+            self.log_event(USER_UPDATED, username, user.name, user.surname, user.address, user.credit_card, user.driving_license)
+            return user
+
+    def remove_user(self, username):
+        with self.lock:
+            user = self.get_user(username)
+            del self.users[user.name]
+            self.storage.delete_user(user.name)
+            self.log_event(USER_REMOVED, user.name)
+            return user
+
+    # (if the car is not in memory yet it is loaded from the storage)
+    def find_car_by_license_plate(self, license_plate):
+        with self.lock:
+            car = self.cars.get(license_plate)
+            if car is None:
+                row = self.storage.load_car(license_plate)
+                if row is not None:
+                    car = car_from_row(row, self.car_factory)
+                    self.cars[license_plate] = car
+                    self.index_car(car)
+            return car
+
+    # same as find_car_by_license_plate, but raises NotFoundError if the car is not present
+    def get_car(self, license_plate):
+        car = self.find_car_by_license_plate(license_plate)
+        if car is None:
+            raise NotFoundError(f"Car {license_plate!r} not found. Please enter an existing license plate")
+        return car
+
+    # store a car in the database and in the fleet index. The license plate identifies the car, so it has to be unique
+    def register_car(self, car):
+        with self.lock:
+            if self.find_car_by_license_plate(car.license_plate):
+                return False
+            self.cars[car.license_plate] = car
+            self.index_car(car)
+            self.storage.save_car(car)
+            self.log_car(CAR_ADDED, car)
+            return True
+
+    def add_car(self, car_type, license_plate, brand, name, location):
+        self.check_car_type(car_type)
+        self.check_circle(location)
+        car = self.car_factory(car_type, license_plate, brand, name, location)
+        if not self.register_car(car):
+            raise AlreadyExistsError(f"A car with license plate {license_plate!r} is already present")
+        return car
+
+    # update the details of a car: only the given values are changed
+    def update_car(self, license_plate, car_type=None, brand=None, name=None, location=None):
+        with self.lock:
+            car = self.get_car(license_plate)
+            if car_type is not None:
+                self.check_car_type(car_type)
+            if location is not None:
+                self.check_circle(location)
+                car.location = location
+            if car_type is not None:
+                car.car_type = car_type
+            if brand is not None:
+                car.brand = brand
+            if name is not None:
+                car.name = name
+            # type and location may have changed, so the car is moved to the right bucket
+            self.fleet_index.update(car)
+            self.storage.save_car(car)
+            self.log_car(CAR_UPDATED, car)
+            return car
+
+    def remove_car(self, license_plate):
+        with self.lock:
+            car = self.get_car(license_plate)
+            # the car leaves the index first, so the index never holds a license plate missing from self.cars
+            self.fleet_index.remove(car)
+            del self.cars[car.license_plate]
+            self.maintenance.remove(car.license_plate)
+            self.storage.delete_car(car.license_plate)
+            self.log_event(CAR_REMOVED, car.license_plate)
+            return car
+
+    # Bulk import (see RentItNow_bulk): same checks as add_car and add_user, but with a persistent storage the new cars
+    # and users are only saved, not kept in memory (a car is kept if the cars of its type and circle are already
+    # loaded), so importing a big fleet does not fill the memory. They are loaded from the storage when needed
+    def import_car(self, car_type, license_plate, brand, name, location):
+        self.check_car_type(car_type)
+        self.check_circle(location)
+        if not license_plate:
+            raise InvalidInputError("The license plate cannot be empty")
+        with self.lock:
+            if self.find_car_by_license_plate(license_plate):
+                raise AlreadyExistsError(f"A car with license plate {license_plate!r} is already present")
+            keep = not self.storage.persistent or (car_type, location) in self.loaded_buckets
+            car = (self.car_factory if keep else Car)(car_type, license_plate, brand, name, location)
+            if keep:
+                self.cars[license_plate] = car
+                self.index_car(car)
+            self.storage.save_car(car)
+            self.log_car(CAR_ADDED, car)
+            return car
+
+    def import_user(self, name, surname, address, credit_card, driving_license):
+        if not name:
+            raise InvalidInputError("The name of the user cannot be empty")
+        with self.lock:
+            if self.find_user(name):
+                raise AlreadyExistsError(f"A user with name {name!r} is already present")
+            user = User(name, surname, address, credit_card, driving_license)
+            if not self.storage.persistent:
+                self.users[name] = user
+            self.storage.save_user(user)
+            self.log_event(USER_ADDED, name, name, surname, address, credit_card, driving_license)
+            return user
+
+    # import a finished rental of the past (e.g. the history of another depot): the rental is saved and added to the
+    # reports, the car is not changed. Distance and cost are computed from the route when they are not given
+    def import_rental(self, username, license_plate, start_circle, end_circle, rented_at, returned_at,
+                      distance=None, total_cost=None):
+        self.check_circle(start_circle)
+        self.check_circle(end_circle)
+        car = self.get_car(license_plate)
+        try:
+            rented_at = parse_time(rented_at).strftime(TIME_FORMAT)
+            returned_at = parse_time(returned_at).strftime(TIME_FORMAT)
+        except (TypeError, ValueError):
+            raise InvalidInputError("Invalid date. Please enter the dates as YYYY-MM-DD HH:MM")
+        if returned_at < rented_at:
+            raise InvalidInputError("The return of the rental cannot be before its start")
+        distance = DISTANCES[start_circle, end_circle] if distance is None else distance
+        total_cost = FARES[car.car_type, start_circle, end_circle] if total_cost is None else total_cost
+        with self.storage.batch():
+            rental_id = self.storage.save_rental(username, car, start_circle, end_circle, distance, total_cost, rented_at)
+            if rental_id is None:
+                rental_id = next(self.rental_ids)
+            else:
+                self.storage.finish_rental(rental_id, returned_at)
+            self.record_rental(rental_id, car, start_circle, end_circle, distance, total_cost, rented_at)
+        self.log_car(RENTAL_STARTED, car, rental_id, username, license_plate, start_circle, end_circle, distance,
+                     total_cost, rented_at)
+        self.log_car(RENTAL_RETURNED, car, rental_id, license_plate, returned_at)
+        rental = Rental(rental_id, username, car, start_circle, end_circle, distance, total_cost, rented_at)
+        rental.returned_at = returned_at
+        return rental
+
+    # Bulk export: rows of all the cars, users and rentals (as car_row, User and Storage.load_rentals), read a few at
+    # a time from a persistent storage, or taken from memory when the storage does not keep them
+    def iter_car_rows(self):
+        if self.storage.persistent:
+            return self.storage.iter_cars()
+        with self.lock:
+            cars = list(self.cars.values())
+        return map(car_row, cars)
+
+    def iter_user_rows(self):
+        if self.storage.persistent:
+            return self.storage.iter_users()
+        with self.lock:
+            users = list(self.users.values())
+        return ((user.name, user.surname, user.address, user.credit_card, user.driving_license) for user in users)
+
+    # without a persistent storage only the active rentals and the last finished ones are in memory
+    def iter_rental_rows(self):
+        if self.storage.persistent:
+            return self.storage.iter_all_rentals()
+        with self.lock:
+            rentals = sorted(list(self.rental_history) + list(self.rented_cars.values()), key=lambda rental: rental.rental_id or 0)
+        return ((rental.username, rental.car.license_plate, rental.start_circle, rental.end_circle, rental.distance,
+                 rental.total_cost, rental.rented_at, rental.returned_at, rental.rental_id) for rental in rentals)
+
+    # rentals of a day as receipt rows (see Storage.iter_rentals), from the storage or from the rentals in memory
+    def iter_receipt_rows(self, day):
+        if self.storage.persistent:
+            return self.storage.iter_rentals(day)
+        with self.lock:
+            rentals = [rental for rental in list(self.rental_history) + list(self.rented_cars.values())
+                       if rental.rented_at and rental.rented_at.startswith(day)]
+        rentals.sort(key=lambda rental: (rental.rented_at, rental.rental_id or 0))
+        return ((rental.username, rental.rented_at, rental.car.name, rental.car.car_type, rental.start_circle,
+                 rental.end_circle, rental.distance, rental.total_cost) for rental in rentals)
+
+    # status of a car: location, total distance travelled, next service time, availability and service status
+    def car_status(self, license_plate):
+        with self.lock:
+            car = self.get_car(license_plate)
+            return {
+                "license_plate": car.license_plate,
+                "car_type": car.car_type,
+                "brand": car.brand,
+                "name": car.name,
+                "location": car.location,
+                "total_distance_travelled": car.total_distance_travelled,
+                "next_service_time": car.next_service_time,
+                "availability": car.availability,
+                "is_in_service": car.is_in_service,
+            }
+
+    # The software select the best car for the user based on the following metric:
+    # it selects the closest car to the start circle selected by the user (so the user will always get the closest car to him/her)
+    # if the closest car is not available it selects another car (keeping the same specifications: car type, number of passengers, start and end circles).
+    # The car is only looked up: use reserve_car to take it. When the end circle is given, cars with fewer km left
+    # before their service than the distance of the trip are skipped
+    def select_best_car(self, car_type, num_passengers, start_circle, end_circle=None):
+        # the cars of a given type have all the same maximum number of passengers, so it is checked only once
+        max_passengers = MAX_PASSENGERS.get(car_type)
+        if max_passengers is not None and max_passengers >= num_passengers:
+            # walk the circles from the start circle outwards and take the first available car found:
+            # this is the closest car to the start circle selected by the user
+            accept = self.immediate_rental_filter(car_type, DISTANCES.get((start_circle, end_circle)))
+            for circle in CIRCLES_BY_DISTANCE.get(start_circle, CIRCLES):
+                self.load_bucket(car_type, circle)
+                car = self.fleet_index.first_available(car_type, circle, accept)
+                if car is not None:
+                    return car
+        return None
+
+    # same as select_best_car, but the car is also taken out of the available cars, atomically: two rentals running
+    # at the same time never get the same car. The reservation ends with commit_rental or release_car
+    def reserve_car(self, car_type, num_passengers, start_circle, end_circle=None):
+        max_passengers = MAX_PASSENGERS.get(car_type)
+        if max_passengers is not None and max_passengers >= num_passengers:
+            accept = self.immediate_rental_filter(car_type, DISTANCES.get((start_circle, end_circle)))
+            for circle in CIRCLES_BY_DISTANCE.get(start_circle, CIRCLES):
+                self.load_bucket(car_type, circle)
+                car = self.fleet_index.reserve(car_type, circle, accept)
+                if car is not None:
+                    return car
+        return None
+
+    # Cars reserved in advance can still be rented now, but only if the trip ends before their next reservation starts.
+    # The longest trip lasts waiting_time hours, so a car is skipped if it is reserved in the next waiting_time hours.
+    # When the distance of the trip is given, the cars that would go past their service during the trip are skipped too.
+    # Without reservations and distance every car is accepted (None)
+    def immediate_rental_filter(self, car_type, distance=None):
+        if not self.reservations:
+            if distance is None:
+                return None
+            return lambda car: car.next_service_time >= distance
+        now = datetime.now()
+        until = now + timedelta(hours=self.waiting_time(car_type))
+        if distance is None:
+            return lambda car: self.reservations.is_free(car.license_plate, now, until)
+        return lambda car: car.next_service_time >= distance and self.reservations.is_free(car.license_plate, now, until)
+
+    # give back a reserved car (e.g. when the payment fails): the car is available again
+    def release_car(self, car):
+        self.fleet_index.set_availability(car, True)
+
+    # when a car of the given type should be free in the given circle (WaitEstimate): from the cars on rent, or the
+    # worst case (waiting_time) when no car of the type is on rent
+    def estimate_wait(self, car_type, start_circle):
+        estimate = self.wait_times.estimate(car_type, start_circle)
+        if estimate is None and car_type in CAR_SPEEDS:
+            estimate = WaitEstimate(car_type, start_circle, self.waiting_time(car_type))
+        return estimate
+
+    # the cars on rent that will be free at the end of their trip are tracked by the waiting time estimator
+    # (the cars going to service are not)
+    def track_rental(self, rental):
+        if not rental.car.is_in_service:
+            started = datetime.strptime(rental.rented_at, TIME_FORMAT).timestamp() if rental.rented_at else None
+            self.wait_times.start(rental.car.license_plate, rental.car.car_type, rental.start_circle, rental.end_circle, started)
+
+    # Calculate waiting time when no car of the requested type is available
+    def waiting_time(self, car_type):
+        # Maximum distance for a car: going from Inner to Outer Circle and viceversa (4 hops = 5*4 = 20 km). 
+        max_distance = 20 
+        # Fixed Speed of each type of car (CAR_SPEEDS)
+        if car_type in CAR_SPEEDS:
+            # calculate the maximum waiting time based on the distance and the car's speed 
+            return max_distance / CAR_SPEEDS[car_type]
+        return None
+
+    # load from the storage the cars of the given type located in the given circle (only the first time they are needed)
+    def load_bucket(self, car_type, location):
+        key = (car_type, location)
+        if key in self.loaded_buckets:
+            return
+        with self.lock:
+            if key in self.loaded_buckets:
+                return
+            for row in self.storage.load_cars(car_type, location):
+                # cars already in memory are more recent than the ones in the storage
+                if row[1] not in self.cars:
+                    car = car_from_row(row, self.car_factory)
+                    self.cars[car.license_plate] = car
+                    self.index_car(car)
+            self.loaded_buckets.add(key)
+
+    # method to manage the rental process: reserve the best car, process the payment and commit the rental.
+    # The receipt is generated in the background once the rental is committed
+    def rent(self, username, car_type, num_passengers, start_circle, end_circle):
+        # only registered users can rent a car
+        self.get_user(username)
+        self.check_car_type(car_type)
+        self.check_passengers(car_type, num_passengers)
+        self.check_circle(start_circle)
+        self.check_circle(end_circle)
+        self.demand.record(car_type, start_circle)
+        selected_car = self.reserve_car(car_type, num_passengers, start_circle, end_circle)
+        if selected_car is None:
+            raise CarNotAvailableError(car_type, estimate=self.estimate_wait(car_type, start_circle))
+        return self.pay_and_commit(username, selected_car, start_circle, end_circle)
+
+    # process the payment of a reserved car and commit the rental (the car is given back if the payment fails)
+    def pay_and_commit(self, username, selected_car, start_circle, end_circle):
+        try:
+            # distance and trip cost are read from the precomputed tables
+            distance = DISTANCES[start_circle, end_circle]
+            trip_cost = FARES[selected_car.car_type, start_circle, end_circle]
+            # process the payment (no lock is held, so a slow payment does not block the other rentals)
+            self.make_payment(username, trip_cost)
+        except BaseException:
+            # if the payment fails the car is given back
+            self.release_car(selected_car)
+            raise
+        rental = self.commit_rental(username, selected_car, start_circle, end_circle, distance, trip_cost)
+        # once the rental is committed the receipt is generated in the background
+        rental.receipt = self.generate_rental_receipt(username, selected_car, start_circle, end_circle, distance, trip_cost)
+        return rental
+
+    # complete the rental of a reserved car: update the car, save the car and the rental and return the Rental
+    def commit_rental(self, username, selected_car, start_circle, end_circle, distance, trip_cost):
+        # new location of the car will be equal to the end circle
+        selected_car.location = end_circle  
+        self.drive(selected_car, distance)
+        # the car is moved to the bucket of its new location
+        self.fleet_index.update(selected_car)
+        rented_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+        # the new status of the car and the rental are saved together
+        with self.storage.batch():
+            self.storage.save_car(selected_car)
+            rental_id = self.storage.save_rental(username, selected_car, start_circle, end_circle, distance, trip_cost, rented_at)
+            if rental_id is None:
+                rental_id = next(self.rental_ids)
+            self.record_rental(rental_id, selected_car, start_circle, end_circle, distance, trip_cost, rented_at)
+        rental = Rental(rental_id, username, selected_car, start_circle, end_circle, distance, trip_cost, rented_at)
+        self.log_car(RENTAL_STARTED, selected_car, rental.rental_id, username, selected_car.license_plate, start_circle,
+                     end_circle, distance, trip_cost, rented_at)
+        # the rental is added to the active rentals previously initialized 
+        self.rented_cars[selected_car.license_plate] = rental
+        self.track_rental(rental)
+        return rental
+
+    # add the km of a trip to a car
+    def drive(self, car, distance):
+        # new distance of the car will be the original total distance + the one selected for the rental
+        car.total_distance_travelled += distance  
+
+        # Update the next service time in terms of kilometers. It is given by the default service distance (1500 km) - the  one selected for the rental
+        car.next_service_time = 1500 - car.total_distance_travelled
+
+        if car.total_distance_travelled >= 1500:  
+            car.is_in_service = True
+            car.total_distance_travelled = 0  
+        self.maintenance.update(car.license_plate, car.next_service_time)
+
+    # method to process the payment
+    def make_payment(self, username, total_cost):
+        pass
+
+    # method to generate a receipt after the rental and the payment details are confirmed.
+    # The pdf is written by the receipt pipeline in the background: the returned Receipt gives the filename
+    # immediately and can be waited for with receipt.result() (None when there are no receipts or it could not be submitted)
     def generate_rental_receipt(self, username, car, start_circle, end_circle, distance, total_cost):
+        if self.receipts is None:
+            return None
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-        filename = f"{username}_rental_receipt_{timestamp}.pdf"
+        filename = receipt_filename(username)
+        try:
+            return self.receipts.submit(filename, username, timestamp, car.name, car.car_type, start_circle, end_circle,
+                                        distance, total_cost)
+        except Exception as error:
+            # the rental is already paid and committed: a receipt that cannot be submitted (pipeline shut down,
+            # broken worker pool) is only reported, and the rental has no receipt
+            self.receipts.report_error(filename, error)
+            return None
+
+    # method to generate the receipts of all the rentals of a day (for the end-of-day accounting) in a single pdf
+    # with one page per rental ("pdf") or in a zip file with one pdf per rental ("zip")
+    def generate_receipts_batch(self, day, output, mode="pdf"):
+        if mode not in ("pdf", "zip"):
+            raise InvalidInputError(f"Invalid mode {mode!r}. Please enter pdf or zip")
+        return render_receipts_batch(self.iter_receipt_rows(day), output, mode)
+
+    # find the last rental of a car: first among the active rentals, then among the last returned ones, then in the storage
+    def find_rental(self, license_plate):
+        rental = self.rented_cars.get(license_plate)
+        if rental is not None:
+            return rental
+        # the event log indexes the events of every car, so the last rental is found without scanning the others
+        if self.event_log is not None:
+            row = self.event_log.last_rental(license_plate)
+            car = self.find_car_by_license_plate(license_plate) if row is not None else None
+            return self.rental_from_row(row, car) if car is not None else None
+        with self.lock:
+            for rental in reversed(self.rental_history):
+                if rental.car.license_plate == license_plate:
+                    return rental
+            rows = self.storage.load_rentals(license_plate)
+            car = self.find_car_by_license_plate(license_plate)
+            if rows and car:
+                return self.rental_from_row(rows[0], car)
+            return None
+
+    # rebuild a rental from the row loaded from the storage
+    def rental_from_row(self, row, car):
+        username, _, start_circle, end_circle, distance, total_cost, rented_at, returned_at, rental_id = row
+        rental = Rental(rental_id, username, car, start_circle, end_circle, distance, total_cost, rented_at)
+        rental.returned_at = returned_at
+        return rental
+
+    # method to return a rented car at the end of the rental: the rental is moved from the active rentals to the history
+    # and the car is available again, unless it needs a service (is_in_service): in that case it stays not available
+    # until the service is completed. If username is given, the car must have been rented by that user
+    def return_car(self, license_plate, username=None):
+        with self.lock:
+            rental = self.rented_cars.get(license_plate)
+            if rental is None:
+                # the rental may have been made before the program was restarted
+                rows = self.storage.load_rentals(license_plate)
+                car = self.find_car_by_license_plate(license_plate)
+                if rows and car and rows[0][7] is None and not car.availability:
+                    rental = self.rental_from_row(rows[0], car)
+            if rental is None or (username is not None and rental.username != username):
+                raise NotFoundError(f"No active rental found for car {license_plate!r}")
+            self.rented_cars.pop(license_plate, None)
+            self.wait_times.finish(license_plate)
+            rental.returned_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+            self.rental_history.append(rental)
+        car = rental.car
+        if not car.is_in_service:
+            self.fleet_index.set_availability(car, True)
+        with self.storage.batch():
+            self.storage.save_car(car)
+            if rental.rental_id is not None:
+                self.storage.finish_rental(rental.rental_id, rental.returned_at)
+        self.log_car(RENTAL_RETURNED, car, rental.rental_id, license_plate, rental.returned_at)
+        return rental
+
+    # Fleet rebalancing (see RentItNow_rebalancing): plan the moves of the available cars towards the circles with the
+    # most recent demand. Only the number of available cars of each bucket is used: the buckets in memory are counted by
+    # the fleet index, the others by the storage, so no car is loaded
+    def rebalancing_plan(self, now=None):
+        stored = self.storage.count_available_cars() if self.storage.persistent else {}
+        counts = {}
+        for car_type in MAX_PASSENGERS:
+            for circle in CIRCLES:
+                if not self.storage.persistent or (car_type, circle) in self.loaded_buckets:
+                    counts[car_type, circle] = self.fleet_index.available_count(car_type, circle)
+                else:
+                    counts[car_type, circle] = stored.get((car_type, circle), 0)
+        return plan_rebalancing(counts, self.demand.recent_demand(now))
+
+    # move an available car to another circle: the car is taken out of the available cars while it is moved,
+    # so it cannot be rented in the meantime
+    def reposition(self, license_plate, circle):
+        self.check_circle(circle)
+        car = self.get_car(license_plate)
+        if not self.fleet_index.take(car):
+            raise InvalidInputError(f"Car {license_plate!r} is not available and cannot be moved")
+        self.move_taken_car(car, circle)
+        return car
+
+    # the km of the move are added to the car; if the car reaches its service it stays not available
+    def move_taken_car(self, car, circle):
+        distance = DISTANCES[car.location, circle]
+        car.location = circle
+        self.drive(car, distance)
+        self.fleet_index.update(car)
+        if not car.is_in_service:
+            self.fleet_index.set_availability(car, True)
+        self.storage.save_car(car)
+        self.log_car(CAR_UPDATED, car)
+
+    # carry out a rebalancing plan: the cars of each move are the first available ones without a reservation
+    # starting soon. Returns the moved cars: (license_plate, from_circle, to_circle)
+    def apply_rebalancing(self, plan):
+        moved = []
+        for move in plan.moves:
+            # the cars to move are taken from the fleet index
+            self.load_bucket(move.car_type, move.from_circle)
+            accept = self.immediate_rental_filter(move.car_type)
+            for _ in range(move.cars):
+                car = self.fleet_index.reserve(move.car_type, move.from_circle, accept)
+                if car is None:
+                    # the cars have been rented since the plan was made
+                    break
+                self.move_taken_car(car, move.to_circle)
+                moved.append((car.license_plate, move.from_circle, move.to_circle))
+        return moved
+
+    # method to complete the service of a car: the distance travelled since the last service is set back to 0,
+    # the next service is programmed in 1500 km and the car is available again
+    def complete_service(self, license_plate):
+        car = self.get_car(license_plate)
+        # a car on rent (or being rented right now) cannot be serviced
+        if license_plate in self.rented_cars or not (car.is_in_service or car.availability):
+            raise InvalidInputError(f"Car {license_plate!r} is still on rent. Return the car before servicing it")
+        car.is_in_service = False
+        car.total_distance_travelled = 0
+        car.next_service_time = 1500
+        self.maintenance.update(license_plate, car.next_service_time)
+        self.fleet_index.set_availability(car, True)
+        self.storage.save_car(car)
+        self.log_car(CAR_SERVICED, car)
+        return car
 
-        doc = SimpleDocTemplate(filename, pagesize=letter)
-        elements = []
+    # the n cars with the fewest km left before their service (the cars that went past 1500 km first):
+    # [(car, km left)]. The cars in memory come from the service schedule; with a persistent storage they are merged
+    # with the first n cars not in memory read from the storage in order of km left, so the fleet is never loaded
+    def cars_due_for_service(self, n=10):
+        due = self.maintenance.due(n)
+        if self.storage.persistent:
+            stored = []
+            for row in self.storage.iter_cars_by_service():
+                if len(stored) >= n:
+                    break
+                # the cars in memory are in the schedule, with their current km
+                if row[1] not in self.cars:
+                    stored.append((row[1], row[6]))
+            due = heapq.nsmallest(n, due + stored, key=lambda entry: entry[1])
+        cars = []
+        for license_plate, km_left in due:
+            car = self.find_car_by_license_plate(license_plate)
+            if car is not None:
+                cars.append((car, km_left))
+        return cars
+
+    # send an available car to its service before it reaches 1500 km (e.g. one of the cars due soon): the car is not
+    # available until the service is completed with complete_service
+    def send_to_service(self, license_plate):
+        car = self.get_car(license_plate)
+        if car.is_in_service:
+            raise InvalidInputError(f"Car {license_plate!r} is already waiting for its service")
+        # the car is taken out of the available cars, so it cannot be rented in the meantime
+        if not self.fleet_index.take(car):
+            raise InvalidInputError(f"Car {license_plate!r} is still on rent. Return the car before servicing it")
+        car.is_in_service = True
+        self.storage.save_car(car)
+        self.log_car(CAR_UPDATED, car)
+        return car
+
+    # Reservations in advance. The reserved period can last several days; the car is picked (the closest free car to
+    # the start circle, as for an immediate rental) when the reservation is made and is rented with rent_reserved_car
+    # once the reserved period has started.
+    # start and end are datetimes or "YYYY-MM-DD HH:MM" strings
+    def check_period(self, start, end):
+        try:
+            start = parse_time(start).replace(second=0, microsecond=0)
+            end = parse_time(end).replace(second=0, microsecond=0)
+        except (TypeError, ValueError):
+            raise InvalidInputError("Invalid date. Please enter the dates as YYYY-MM-DD HH:MM")
+        if end <= start:
+            raise InvalidInputError("The end of the reservation must be after its start")
+        if start < datetime.now().replace(second=0, microsecond=0):
+            raise InvalidInputError("The start of the reservation cannot be in the past")
+        return start, end
+
+    # a car can be reserved in a period if it is not in service, if it will be back (when rented now) before the
+    # period starts and if it has no other reservation overlapping the period
+    def can_be_reserved(self, car, start, end, now):
+        if car.is_in_service:
+            return False
+        if not car.availability and start < now + timedelta(hours=self.waiting_time(car.car_type)):
+            return False
+        return self.reservations.is_free(car.license_plate, start, end)
+
+    # cars of the given type free in the given period, from the closest to the start circle to the farthest (at most
+    # limit cars). The available cars without reservations are free in any period and are taken without checking
+    # them: only the cars with reservations and the cars on rent or in service are checked
+    def free_cars(self, car_type, start_circle, start, end, limit=None):
+        self.check_car_type(car_type)
+        self.check_circle(start_circle)
+        start, end = self.check_period(start, end)
+        if limit is not None and limit < 0:
+            raise InvalidInputError("The limit cannot be negative")
+        now = datetime.now()
+        free = []
+        for circle in CIRCLES_BY_DISTANCE[start_circle]:
+            if limit is not None and len(free) >= limit:
+                break
+            self.load_bucket(car_type, circle)
+            free.extend(self.fleet_index.unbooked_cars(car_type, circle, None if limit is None else limit - len(free)))
+            if limit is not None and len(free) >= limit:
+                break
+            for car in self.fleet_index.booked_or_unavailable_cars(car_type, circle):
+                if limit is not None and len(free) >= limit:
+                    break
+                if self.can_be_reserved(car, start, end, now):
+                    free.append(car)
+        return free
+
+    # reserve the closest free car for the given period and return the Reservation
+    def make_reservation(self, username, car_type, num_passengers, start_circle, end_circle, start, end):
+        self.get_user(username)
+        self.check_car_type(car_type)
+        self.check_passengers(car_type, num_passengers)
+        self.check_circle(start_circle)
+        self.check_circle(end_circle)
+        start, end = self.check_period(start, end)
+        self.expire_reservations()
+        now = datetime.now()
+
+        # the car is checked and booked while holding the lock of its bucket, so that it cannot be rented
+        # or reserved by another thread in the meantime
+        def book(car):
+            if not self.can_be_reserved(car, start, end, now):
+                return None
+            reservation_id = self.storage.save_reservation(username, car, start_circle, end_circle,
+                                                           start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))
+            if reservation_id is None:
+                reservation_id = next(self.reservation_ids)
+            reservation = Reservation(reservation_id, username, car.license_plate, car.car_type, start_circle, end_circle, start, end)
+            self.reservations.add(reservation)
+            self.fleet_index.rebook(car.license_plate, True)
+            return reservation
+
+        # the first car that fits is booked: an available car without reservations, if there is one, is the first
+        for circle in CIRCLES_BY_DISTANCE[start_circle]:
+            self.load_bucket(car_type, circle)
+            reservation = self.fleet_index.find(car_type, circle, book)
+            if reservation is not None:
+                return reservation
+        raise CarNotAvailableError(car_type)
+
+    # a reservation has been removed: the car goes back with the cars without reservations if it has no other one
+    def unbook(self, license_plate):
+        self.fleet_index.update_booked(license_plate, lambda: self.reservations.has_reservations(license_plate))
+
+    # return a reservation (of the given user, if any), raising NotFoundError if there is none
+    def get_reservation(self, reservation_id, username=None):
+        reservation = self.reservations.get(reservation_id)
+        if reservation is None or (username is not None and reservation.username != username):
+            raise NotFoundError(f"Reservation {reservation_id!r} not found")
+        return reservation
+
+    def user_reservations(self, username):
+        return self.reservations.of_user(username)
+
+    def cancel_reservation(self, reservation_id, username=None):
+        reservation = self.get_reservation(reservation_id, username)
+        if self.reservations.remove(reservation_id) is None:
+            raise NotFoundError(f"Reservation {reservation_id!r} not found")
+        self.unbook(reservation.license_plate)
+        self.storage.delete_reservation(reservation_id)
+        return reservation
+
+    # reservations never picked up are deleted once their period is over
+    def expire_reservations(self):
+        for reservation in self.reservations.expired(datetime.now()):
+            if self.reservations.remove(reservation.reservation_id) is not None:
+                self.unbook(reservation.license_plate)
+                self.storage.delete_reservation(reservation.reservation_id)
+
+    # rent the car of a reservation: the reserved period must have started. The reservation is used up by the rental
+    def rent_reserved_car(self, reservation_id, username=None):
+        reservation = self.get_reservation(reservation_id, username)
+        now = datetime.now()
+        if not reservation.start <= now < reservation.end:
+            raise InvalidInputError(f"Reservation {reservation_id} can only be used from {reservation.start.strftime(TIME_FORMAT)} "
+                                    f"to {reservation.end.strftime(TIME_FORMAT)}")
+        car = self.get_car(reservation.license_plate)
+        # the car may still be on rent (returned late) or in service
+        if not self.fleet_index.take(car):
+            estimate = self.wait_times.estimate_car(car.license_plate, reservation.start_circle)
+            raise CarNotAvailableError(car.car_type, self.waiting_time(car.car_type), estimate)
+        rental = self.pay_and_commit(reservation.username, car, reservation.start_circle, reservation.end_circle)
+        if self.reservations.remove(reservation_id) is not None:
+            self.unbook(reservation.license_plate)
+            self.storage.delete_reservation(reservation_id)
+        return rental
+
+    # same as find_rental, but raises NotFoundError if the car was never rented
+    def rented_car_status(self, license_plate):
+        rental = self.find_rental(license_plate)
+        if rental is None:
+            raise NotFoundError(f"Rented car {license_plate!r} not found. Please enter an existing license plate in rental")
+        return rental
+
+    # calculate the final trip costs 
+    def calculate_trip_cost(self, car_type, distance):
+        rental_price_per_km = self.get_rental_price_per_km(car_type)
+        if rental_price_per_km is not None:
+            return distance * rental_price_per_km
+        else:
+            return None
+
+    # each type of car has its rental price per km
+    def get_rental_price_per_km(self, car_type):
+        return PRICE_PER_KM.get(car_type)
+
+    # The distance is calculated based on hops: an hop is 5km; an hops is going from one circle to the next one.
+    # (e.g. travelling from Inner Circle to Middle Circle is 2 hops, not 1 hop). Travelling in the same circle is 1 hop.
+    def calculate_distance(self, start_circle, end_circle):
+        return DISTANCES.get((start_circle, end_circle))
+
+    # distance and cost of a trip, without renting a car
+    def quote(self, car_type, start_circle, end_circle):
+        self.check_car_type(car_type)
+        self.check_circle(start_circle)
+        self.check_circle(end_circle)
+        return DISTANCES[start_circle, end_circle], FARES[car_type, start_circle, end_circle]
+
+    # distances and costs of many trips (car_type, start_circle, end_circle) computed in a single call,
+    # as NumPy arrays when NumPy is installed (lists otherwise)
+    def quote_many(self, trips):
+        try:
+            return quote_many(trips)
+        except KeyError as error:
+            raise InvalidInputError(f"Invalid car type or circle {error.args[0]!r}")
+        except (TypeError, ValueError):
+            raise InvalidInputError("Each trip must be (car_type, start_circle, end_circle)")
+
+    def add_test_data(self):
+        # Test data - Add some cars
+        self.register_car(self.car_factory("ECO", "ABC123", "Toyota", "Yaris", "Inner Circle"))
+        self.register_car(self.car_factory("MID-CLASS", "XYZ456", "Honda", "Accord", "Middle Circle"))
+        self.register_car(self.car_factory("DELUXE", "DEF789", "Mercedes", "S-Class", "Outer Circle"))
+        self.register_car(self.car_factory("ECO", "ABC1234", "Toyota", "Yaris_2", "Outer Circle"))
+        self.register_car(self.car_factory("MID-CLASS", "ABC1235", "Honda", "Accord_2", "Outer Circle"))
+
+        # Test data - Add some users
+        self.register_user(User("Federica", "Ferrari", "Via A", "ABC", "DEF"))
+        self.register_user(User("Giulia", "Bianchi", "Via B", "GHI", "LMN"))
+        self.register_user(User("Martina", "Rossi", "Via C", "OPQ", "RST"))
+
+    # for long-running programs: import reportlab and start the receipt workers now, so the first rental is not slower
+    def prewarm(self):
+        if self.receipts is not None:
+            self.receipts.prewarm()
 
-        styles = getSampleStyleSheet()
-        title_style = styles["Title"]
-        body_style = styles["BodyText"]
+    # write the receipts still in the queue and close the storage
+    def close(self):
+        if self.receipts is not None:
+            self.receipts.shutdown()
+        if self.event_log is not None:
+            self.event_log.close()
+        if self.storage.persistent and self.rentals_since_report_totals:
+            self.save_report_totals()
+        self.storage.close()
 
-        title_text = f"Rental Receipt for {username}"
-        title = Paragraph(title_text, title_style)
-        elements.append(title)
 
-        # information to show in the receipt
-        data = [
-            ("Date:", datetime.now().strftime("%Y-%m-%d %H:%M")),
-            ("Car:", car.name),
-            ("Car Type:", car.car_type),
-            ("Start Circle:", start_circle),
-            ("End Circle:", end_circle),
-            ("Distance Travelled (km):", str(distance)),
-            ("Total Cost ($):", str(total_cost)),
-        ]
+# Class RentItNow creation: interactive menus of the rental system. All the operations are done by the RentalService,
+# RentItNow only asks the values to the user and prints the results
+class RentItNow:
+    def __init__(self, storage=None, receipts=None, service=None, event_log=None):
+        self.service = service if service is not None else RentalService(storage, receipts, event_log=event_log)
+
+    # cars, users and rentals are held by the service
+    @property
+    def cars(self):
+        return self.service.cars
+
+    @property
+    def users(self):
+        return self.service.users
+
+    @property
+    def rented_cars(self):
+        return self.service.rented_cars
+
+    def find_user(self, username):
+        return self.service.find_user(username)
 
-        for item in data:
-            item_text = f"<b>{item[0]}</b> {item[1]}"
-            item_paragraph = Paragraph(item_text, body_style)
-            elements.append(item_paragraph)
+    def find_car_by_license_plate(self, license_plate):
+        return self.service.find_car_by_license_plate(license_plate)
 
-        elements.append(Spacer(1, 12))
+    def calculate_distance(self, start_circle, end_circle):
+        return self.service.calculate_distance(start_circle, end_circle)
 
-        doc.build(elements)
+    def calculate_trip_cost(self, car_type, distance):
+        return self.service.calculate_trip_cost(car_type, distance)
 
-        print(f"Rental receipt coorectly generated and saved as: {filename}")
+    def get_rental_price_per_km(self, car_type):
+        return self.service.get_rental_price_per_km(car_type)
 
-        return filename
+    def select_best_car(self, car_type, num_passengers, start_circle, end_circle=None):
+        return self.service.select_best_car(car_type, num_passengers, start_circle, end_circle)
 
     # method to let the user/Boss to login in the program. There is also the possibility to register a new account 
     def login_or_register(self):
@@ -111,11 +1554,14 @@ class RentItNow:
                 address = input("Enter your address: ")
                 credit_card = input("Enter your credit card number: ")
                 driving_license = input("Enter your driving license number: ")
-                user = User(name, surname, address, credit_card, driving_license)
-                # the user is now added to the list of users in database previously initialized 
-                self.users.append(user)
-                print("Account registered successfully")
-                return "user"
+                # the user is now added to the users in database
+                try:
+                    self.service.add_user(name, surname, address, credit_card, driving_license)
+                except AlreadyExistsError:
+                    print("A user with this name is already registered. Please login or choose another name")
+                else:
+                    print("Account registered successfully")
+                    return "user"
             elif choice == "exit":
                 return None  
             else:
@@ -123,28 +1569,108 @@ class RentItNow:
                 # warning and lets the user insert again the value
                 print("Invalid choice, enter login, register, or exit.") 
 
-    # After the login as a user, the user can choose among 3 different actions:
-    # start a rental process and rent a car, manage the account (update or delete it) or exit the program
+    # After the login as a user, the user can choose among 5 different actions:
+    # start a rental process and rent a car, return a rented car, manage the reservations in advance,
+    # manage the account (update or delete it) or exit the program
     def manage_account(self, username):
         print("Account management options:")
         print("1. Proceed with rental")
-        print("2. Manage account")
-        print("3. Exit")
+        print("2. Return a car")
+        print("3. Reservations")
+        print("4. Manage account")
+        print("5. Exit")
         while True:
             option = input("Enter your choice or select 'back' to go back to the login menu: ")
             if option == "1":
                 self.process_rental(username)
             elif option == "2":
-                self.manage_user_account(username)
+                self.return_car(username)
             elif option == "3":
+                self.manage_reservations(username)
+            elif option == "4":
+                self.manage_user_account(username)
+            elif option == "5":
                 print("Exiting the program")
                 return  
             elif option.lower() == "back":  
                 return None  
             else:
-                # if the user inserts a value different from 1,2,3 or "back"
+                # if the user inserts a value different from 1,2,3,4,5 or "back"
                 # it gives a warning and lets the user choose the corect value
-                print("Invalid choice. Please enter 1, 2, 3, or 'back' to go back to the menu.") 
+                print("Invalid choice. Please enter 1, 2, 3, 4, 5, or 'back' to go back to the menu.") 
+
+    # the user can reserve a car in advance for a period of time, see the reservations made,
+    # rent the car of a reservation once the reserved period has started or cancel a reservation
+    def manage_reservations(self, username):
+        print("Reservation options:")
+        print("1. Reserve a car in advance")
+        print("2. Show my reservations")
+        print("3. Rent a reserved car")
+        print("4. Cancel a reservation")
+        print("5. Exit")
+        option = input("Select 'back' to go back in the menu: ")
+        if option == "1":
+            self.make_reservation(username)
+        elif option == "2":
+            reservations = self.service.user_reservations(username)
+            if not reservations:
+                print("You have no reservations")
+            for reservation in reservations:
+                print(reservation)
+        elif option == "3":
+            self.rent_reserved_car(username)
+        elif option == "4":
+            reservation_id = self.reservation_selection()
+            try:
+                self.service.cancel_reservation(reservation_id, username)
+            except NotFoundError:
+                print("Reservation not found. Please enter the number of one of your reservations")
+            else:
+                print("Reservation cancelled.")
+        elif option == "5" or option.lower() == "back":
+            return None
+        else:
+            print("Invalid choice. Please enter 1, 2, 3, 4, 5, or 'back'")
+
+    def make_reservation(self, username):
+        car_type, num_passengers = self.car_selection()
+        if car_type is None:
+            return None
+        start_circle = self.circle_selection("Enter starting circle (Inner Circle, Middle Circle, Outer Circle): ")
+        end_circle = self.circle_selection("Enter ending circle (Inner Circle, Middle Circle, Outer Circle): ")
+        start = input("Enter the start of the reservation (YYYY-MM-DD HH:MM): ")
+        end = input("Enter the end of the reservation (YYYY-MM-DD HH:MM): ")
+        try:
+            reservation = self.service.make_reservation(username, car_type, num_passengers, start_circle, end_circle, start, end)
+        except RentItNowError as error:
+            print(f"Reservation failed: {error}")
+            return None
+        print(f"{reservation} confirmed.")
+        return reservation
+
+    def rent_reserved_car(self, username):
+        reservation_id = self.reservation_selection()
+        try:
+            rental = self.service.rent_reserved_car(reservation_id, username)
+        except NotFoundError:
+            print("Reservation not found. Please enter the number of one of your reservations")
+            return None
+        except RentItNowError as error:
+            print(f"Rental failed: {error}")
+            return None
+        print(f"Payment of ${rental.total_cost} processed for user {username}")
+        print(f"Trip completed with {rental.car} from {rental.start_circle} to {rental.end_circle}.")
+        if rental.receipt is not None:
+            print(f"Rental receipt is being generated and will be saved as: {rental.receipt.filename}")
+        return rental
+
+    # the reservations are identified by their number
+    def reservation_selection(self):
+        while True:
+            reservation_id = input("Enter the number of the reservation: ")
+            if reservation_id.isdigit():
+                return int(reservation_id)
+            print("Invalid input. Please enter a number")
 
     # if the user chooses to manage his/her account, it has the possibility to update, delete it (or exit the program)
     def manage_user_account(self, username):
@@ -173,27 +1699,25 @@ class RentItNow:
         address = input("Enter your address: ")
         credit_card = input("Enter your credit card number: ")
         driving_license = input("Enter your driving license number: ")
-        user = self.find_user(username)
-        if user:
-            user.name = name
-            user.surname = surname
-            user.address = address
-            user.credit_card = credit_card
-            user.driving_license = driving_license
-            print("Account details updated successfully")
-        else:
+        try:
+            self.service.update_user(username, name, surname, address, credit_card, driving_license)
+        except NotFoundError:
             print("User not found. Please enter an existing user")
+        except AlreadyExistsError:
+            print("A user with this name is already registered. Please choose another name")
+        else:
+            print("Account details updated successfully")
 
     # the user can also delete his/her account if the user is present in the database
     def delete_user_account(self, username):
         confirm = input("Are you sure you want to delete your account? (yes/no): ").lower()
         if confirm == "yes":
-            user = self.find_user(username)
-            if user:
-                self.users.remove(user)
-                print("Account deleted successfully")
-            else:
+            try:
+                self.service.remove_user(username)
+            except NotFoundError:
                 print("User not found. Please insert an existing user")
+            else:
+                print("Account deleted successfully")
         elif confirm == "no":
             print("Account deletion cancelled")
         elif confirm.lower() == "exit":  
@@ -201,123 +1725,54 @@ class RentItNow:
         else:
             print("Invalid choice.")
 
-    # method to check if the user is present in the database based on his/her name
-    def find_user(self, username):
-        for user in self.users:
-            if user.name == username:
-                return user
-        return None
-
     # method to manage the rental process
     def process_rental(self, username):
         # car type and number of passangers have to be coherent with the selected car
         car_type, num_passengers = self.car_selection() 
-        while True:
-            # input the start circle
-            start_circle = input("Enter starting circle (Inner Circle, Middle Circle, Outer Circle): ").title()
-            # check if the start circle is correctly inserted 
-            if start_circle in ["Inner Circle", "Middle Circle", "Outer Circle"]:
-                break
-            else:
-                # if the input is not among the accepted values the program give a warning and lets the user choose the correct value
-                print("Invalid input. Please enter Inner Circle, Middle Circle, or Outer Circle")
-
-        selected_car = self.select_best_car(car_type, num_passengers, start_circle)  
-        if selected_car:
-            # Check if the car is available
-            if selected_car.availability:  
-                while True:
-                    # input the end circle
-                    end_circle = input("Enter ending circle (Inner Circle, Middle Circle, Outer Circle): ").title()
-                    # check if the end circle is correctly inserted 
-                    if end_circle in ["Inner Circle", "Middle Circle", "Outer Circle"]:
-                        break
-                    else:
-                        # if the input is not among the accepted values the program give a warning and lets the user choose the correct value
-                        print("Invalid input. Please enter Inner Circle, Middle Circle, or Outer Circle")
-
-                # distance is calculated from the start to the end circle
-                distance = self.calculate_distance(start_circle, end_circle)
-                # retrieve the trip cost
-                trip_cost = self.calculate_trip_cost(selected_car.car_type, distance)
-                if trip_cost:
-                    # process the payment 
-                    self.make_payment(username, trip_cost)  
-                    print(f"Trip completed with {selected_car} from {start_circle} to {end_circle}.")
-                    receipt_filename = self.generate_rental_receipt(username, selected_car, start_circle, end_circle, distance, trip_cost)
-                    print(f"Rental receipt coorectly saved as: {receipt_filename}")
-                    # new location of the car will be equal to the end circle
-                    selected_car.location = end_circle  
-                    # new distance of the car will be the original total distance + the one selected for the rental
-                    selected_car.total_distance_travelled += distance  
-
-                    # Update the next service time in terms of kilometers. It is given by the default service distance (1500 km) - the  one selected for the rental
-                    selected_car.next_service_time = 1500 - selected_car.total_distance_travelled
-
-                    if selected_car.total_distance_travelled >= 1500:  
-                        selected_car.is_in_service = True
-                        selected_car.total_distance_travelled = 0  
-                        print(f"Car {selected_car.name} ({selected_car.car_type}) requires service!")
-                    # Consequently, the availability of the car will be set to False
-                    selected_car.availability = False  
-                    # the car is added to the rented_cars list previously initialized 
-                    self.rented_cars.append((selected_car, start_circle, end_circle))  # Memorizza anche la tratta
-                else:
-                    print("Failed to calculate trip cost")
-            else:
-                print("The selected car is not available for rental. Please, select another car")
-        else:
-            print("No available car found")
-
-    # The software select the best car for the user based on the following metric:
-    # it selects the closest car to the start circle selected by the user (so the user will always get the closest car to him/her)
-    # if the closest car is not available it selects another car (keeping the same specifications: car type, number of passengers, start and end circles)
-    def select_best_car(self, car_type, num_passengers, start_circle):
-        # checks the available cars
-        available_cars = [car for car in self.cars if car.car_type == car_type and car.availability]
-        # check the correct number of passengers
-        suitable_cars = [car for car in available_cars if car.get_max_passengers() >= num_passengers]
-        if suitable_cars:
-            # if a car is available the program calculates the distance from the current location of the car and the start circle selected by the user
-            distances = {car: self.calculate_distance(car.location, start_circle) for car in suitable_cars}
-            # order the cars based on the closest distance to the start circle
-            sorted_cars = sorted(distances.keys(), key=lambda car: distances[car])
-            # return the first closest car
-            return sorted_cars[0]  
-        else:
-            # Calculate waiting time
-            # Maximum distance for a car: going from Inner to Outer Circle and viceversa (4 hops = 5*4 = 20 km). 
-            max_distance = 20 
-            # Fixed Speed of each type of car
-            car_speeds = {"ECO": 15, "MID-CLASS": 25, "DELUXE": 50} 
-            if car_type in car_speeds:
-                # calculate the maximum waiting time based on the distance and the car's speed 
-                waiting_time = max_distance / car_speeds[car_type]
-                print(f"Sorry, the requested {car_type} car is not available. The maximum waiting time is approximately {waiting_time:.2f} hours")
-            else:
-                print("No suitable car is available")
+        if car_type is None:
+            return None
+        start_circle = self.circle_selection("Enter starting circle (Inner Circle, Middle Circle, Outer Circle): ")
+        end_circle = self.circle_selection("Enter ending circle (Inner Circle, Middle Circle, Outer Circle): ")
+        # the service selects the best car and rents it in one step: if there is none, the expected waiting time is shown
+        try:
+            rental = self.service.rent(username, car_type, num_passengers, start_circle, end_circle)
+        except CarNotAvailableError as error:
+            print(error)
+            print("No available car found. Please, select another car type or try again later")
+            return None
+        except RentItNowError as error:
+            print(f"Rental failed: {error}")
             return None
+        print(f"Payment of ${rental.total_cost} processed for user {username}")
+        print(f"Trip completed with {rental.car} from {start_circle} to {end_circle}.")
+        if rental.car.is_in_service:
+            print(f"Car {rental.car.name} ({rental.car.car_type}) requires service!")
+        if rental.receipt is not None:
+            print(f"Rental receipt is being generated and will be saved as: {rental.receipt.filename}")
+        return rental.receipt
 
-    # method to process the payment
-    def make_payment(self, username, total_cost):
-        print(f"Payment of ${total_cost} processed for user {username}")
+    # method to return a rented car at the end of the rental. The Boss can return any car (username None)
+    def return_car(self, username=None):
+        license_plate = input("Enter license plate of the rented car: ").upper()
+        try:
+            rental = self.service.return_car(license_plate, username)
+        except NotFoundError:
+            print("Rented car not found. Please enter the license plate of a car on rent")
+            return None
+        print(f"Car {rental.car} returned in {rental.end_circle}.")
+        if rental.car.is_in_service:
+            print(f"Car {rental.car.name} ({rental.car.car_type}) has been sent to service")
+        return rental
 
-    # method to let the Boss check the currently rented cars status 
-    def check_rented_car_status(self): 
-        print("Checking currently rented car status:")
-        # the Boss has to input the license plate of the car to see its status
-        license_plate = input("Enter license plate of the rented car: ")
-        for car in self.rented_cars:
-            # the car has to be present in the rented cars list
-            if car.license_plate == license_plate:
-                print(f"Rented car {car.name} ({car.car_type}) status:")
-                print(f"Location: {car.location}")
-                print(f"Total distance traveled: {car.total_distance_travelled} km")
-                print(f"Next service time: {car.next_service_time} km")
-                print(f"Service status: {'In Service' if car.is_in_service else 'Not in Service'}")
-                break
-        else:
-            print("Rented car not found. Please, enter an existing license plate")
+    # method to check the correct insertion of a circle
+    def circle_selection(self, prompt):
+        while True:
+            circle = input(prompt).title()
+            # check if the circle is correctly inserted 
+            if circle in CIRCLES:
+                return circle
+            # if the input is not among the accepted values the program give a warning and lets the user choose the correct value
+            print("Invalid input. Please enter Inner Circle, Middle Circle, or Outer Circle")
 
     # method to check the correct insertion of car types
     def car_selection(self):
@@ -351,52 +1806,10 @@ class RentItNow:
 
         return car_type, num_passengers
 
-    # calculate the final trip costs 
-    def calculate_trip_cost(self, car_type, distance):
-        rental_price_per_km = self.get_rental_price_per_km(car_type)
-        if rental_price_per_km is not None:
-            return distance * rental_price_per_km
-        else:
-            return None
-
-    # each type of car has its rental price per km
-    def get_rental_price_per_km(self, car_type):
-        if car_type == "ECO":
-            return 1
-        elif car_type == "MID-CLASS":
-            return 2
-        elif car_type == "DELUXE":
-            return 5
-        else:
-            return None
-
-    # The distance is calculated based on hops: an hop is 5km; an hops is going from one circle to the next one.
-    # (e.g. travelling from Inner Circle to Middle Circle is 2 hops, not 1 hop). Travelling in the same circle is 1 hop.
-    def calculate_distance(self, start_circle, end_circle):
-        circle_positions = {"Inner Circle": 1, "Middle Circle": 2, "Outer Circle": 3}
-        start_position = circle_positions.get(start_circle)
-        end_position = circle_positions.get(end_circle)
-        if start_position is not None and end_position is not None:
-            if start_position == end_position:
-                distance = 5  # same circle
-            else:
-                distance = abs(end_position - start_position) * 10  # Different circles
-            return distance
-        else:
-            return None
-
     def main(self):
-        # Test data - Add some cars
-        self.cars.append(Car("ECO", "ABC123", "Toyota", "Yaris", "Inner Circle"))
-        self.cars.append(Car("MID-CLASS", "XYZ456", "Honda", "Accord", "Middle Circle"))
-        self.cars.append(Car("DELUXE", "DEF789", "Mercedes", "S-Class", "Outer Circle"))
-        self.cars.append(Car("ECO", "ABC1234", "Toyota", "Yaris_2", "Outer Circle"))
-        self.cars.append(Car("MID-CLASS", "ABC1234", "Honda", "Accord_2", "Outer Circle"))
-
-        # Test data - Add some users
-        self.users.append(User("Federica", "Ferrari", "Via A", "ABC", "DEF"))
-        self.users.append(User("Giulia", "Bianchi", "Via B", "GHI", "LMN"))
-        self.users.append(User("Martina", "Rossi", "Via C", "OPQ", "RST"))
+        # Test data (cars and users already saved in the storage are not added again)
+        with self.service.storage.batch():
+            self.service.add_test_data()
 
         # users have their actions, and Boss has its own functions
         while True:
@@ -409,6 +1822,8 @@ class RentItNow:
                 print(f"\nWelcome in the RentItNow service, {username}!")
                 self.manage_account(username)
             else:
+                # wait for the receipts still being generated before exiting
+                self.service.close()
                 print("Exiting the program")
                 break
 
@@ -426,7 +1841,13 @@ class RentItNow:
             print("6. Update user")
             print("7. Remove user")
             print("8. Check rented car status")  
-            print("9. Exit")
+            print("9. Generate receipts of a day")
+            print("10. Return a car")
+            print("11. Complete car service")
+            print("12. Rental reports")
+            print("13. Rebalance the fleet")
+            print("14. Service schedule")
+            print("15. Exit")
             choice = input("Enter your choice: ")
             if choice == "1":
                 self.add_car()
@@ -445,18 +1866,119 @@ class RentItNow:
             elif choice == "8":
                 self.check_rented_car_status()
             elif choice == "9":
+                self.daily_receipts()
+            elif choice == "10":
+                self.return_car()
+            elif choice == "11":
+                self.complete_service()
+            elif choice == "12":
+                self.rental_reports()
+            elif choice == "13":
+                self.rebalance_fleet()
+            elif choice == "14":
+                self.service_schedule()
+            elif choice == "15":
                 print("Exiting the program")
                 return  
             else:
-                print("Invalid choice. Please enter a number from 1 to 9")
+                print("Invalid choice. Please enter a number from 1 to 15")
 
     # define in more details all the functions of the Boss
+    def daily_receipts(self):
+        day = input("Enter the day of the rentals (YYYY-MM-DD): ")
+        try:
+            datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            print("Invalid date. Please enter the day as YYYY-MM-DD")
+            return
+        mode = input("Save the receipts in a single pdf or in a zip file? (pdf/zip): ").lower()
+        try:
+            filenames = self.service.generate_receipts_batch(day, f"rental_receipts_{day}.{mode}", mode)
+        except InvalidInputError:
+            print("Invalid choice. Please enter pdf or zip")
+        else:
+            print(f"Receipts of {day} correctly saved as: {', '.join(filenames)}")
+
+    # the reports are printed and can then be saved as csv files or as a pdf
+    def rental_reports(self):
+        summary = self.service.reports.summary()
+        print(f"Rentals: {summary['rentals']}, distance: {summary['distance']} km, revenue: ${summary['revenue']}")
+        for name, (header, rows) in self.service.rental_reports().items():
+            # the rows of the cars and of the hours can be thousands: only the last ones are shown
+            if name in ("cars", "hourly") and len(rows) > 10:
+                print(f"\n{REPORT_TITLES[name]} (last 10 of {len(rows)}):")
+                rows = rows[-10:]
+            else:
+                print(f"\n{REPORT_TITLES[name]}:")
+            print(" | ".join(str(value) for value in header))
+            for row in rows:
+                print(" | ".join(str(value) for value in row))
+        mode = input("Save the reports as csv files or as a pdf? (csv/pdf/no): ").lower()
+        if mode in ("csv", "pdf"):
+            output = f"rental_report_{datetime.now().strftime('%Y-%m-%d')}"
+            filenames = self.service.export_reports(output, mode)
+            print(f"Reports saved as: {', '.join(filenames)}")
+
+    # the plan is shown and carried out only if the Boss confirms it
+    def rebalance_fleet(self):
+        plan = self.service.rebalancing_plan()
+        if not plan.moves:
+            print("The available cars are already where the recent demand is. Nothing to move")
+            return
+        print("Rebalancing plan:")
+        for move in plan.moves:
+            print(f"- {move}")
+        print(f"{plan.cars_moved()} cars to move, {plan.total_distance()} km in total")
+        if input("Move the cars now? (yes/no): ").lower() == "yes":
+            moved = self.service.apply_rebalancing(plan)
+            print(f"{len(moved)} cars moved")
+
+    # the cars due for service next; one of them can be sent to its service right away
+    def service_schedule(self):
+        number = input("How many cars do you want to see? (default 10): ")
+        number = int(number) if number.isdigit() else 10
+        for car, km_left in self.service.cars_due_for_service(number):
+            if car.is_in_service:
+                status = "waiting for service"
+            elif car.license_plate in self.service.rented_cars:
+                status = "on rent"
+            else:
+                status = "available"
+            print(f"{car.license_plate} {car}: {km_left} km left ({status})")
+        license_plate = input("Enter the license plate of a car to send to service (or no): ").upper()
+        if license_plate in ("", "NO"):
+            return
+        try:
+            car = self.service.send_to_service(license_plate)
+        except NotFoundError:
+            print("Car not found. Please enter an existing license plate")
+        except InvalidInputError as error:
+            print(error)
+        else:
+            print(f"Car {car} sent to service. Complete the service to make it available again")
+
+    def complete_service(self):
+        license_plate = input("Enter license plate of the serviced car: ").upper()
+        try:
+            car = self.service.complete_service(license_plate)
+        except NotFoundError:
+            print("Car not found. Please enter an existing license plate")
+        except InvalidInputError as error:
+            print(error)
+        else:
+            print(f"Service of car {car} completed. The car is available again")
+
     def add_car(self):
         print("Adding a new car:")
         car_type, license_plate, brand, name, location = self.get_car_details_from_user()
-        new_car = Car(car_type, license_plate, brand, name, location)
-        self.cars.append(new_car)
-        print("Car added successfully.")
+        try:
+            self.service.add_car(car_type, license_plate, brand, name, location)
+        except AlreadyExistsError:
+            print("A car with this license plate is already present. Please enter a new license plate")
+        except InvalidInputError as error:
+            print(error)
+        else:
+            print("Car added successfully.")
 
     def get_car_details_from_user(self):
         car_type = input("Enter car type (ECO, MID-CLASS, DELUXE): ").upper()
@@ -470,56 +1992,61 @@ class RentItNow:
         print("Updating car details:")
         license_plate = input("Enter license plate of the car to update: ").upper()
         # car has to be present in the database
-        car = self.find_car_by_license_plate(license_plate)
-        if car:
+        if self.find_car_by_license_plate(license_plate):
             car_type, _, brand, name, location = self.get_car_details_from_user()
-            car.car_type = car_type
-            car.brand = brand
-            car.name = name
-            car.location = location
-            print("Car details updated successfully!")
+            try:
+                self.service.update_car(license_plate, car_type, brand, name, location)
+            except InvalidInputError as error:
+                print(error)
+            else:
+                print("Car details updated successfully!")
         else:
             print("Car not found. Please enter an existing license plate")
 
-    def find_car_by_license_plate(self, license_plate):
-        for car in self.cars:
-            if car.license_plate == license_plate:
-                return car
-        return None
-
     def remove_car(self):
         print("Removing a car:")
         license_plate = input("Enter license plate of the car to remove: ").upper()
         # car has to be present in the database
-        car = self.find_car_by_license_plate(license_plate)
-        if car:
-            self.cars.remove(car)
-            print("Car removed successfully!")
+        try:
+            self.service.remove_car(license_plate)
+        except NotFoundError:
+            print("Car not found. Please enter an existing license plate")
         else:
+            print("Car removed successfully!")
+
+    # method to let the Boss check the status of a car: location, total distance traveled, next service time and availability
+    def check_car_status(self):
+        print("Checking car status:")
+        license_plate = input("Enter license plate of the car: ").upper()
+        try:
+            status = self.service.car_status(license_plate)
+        except NotFoundError:
             print("Car not found. Please enter an existing license plate")
+            return
+        print(f"Car {status['name']} ({status['car_type']}) status:")
+        print(f"Location: {status['location']}")
+        print(f"Total distance traveled: {status['total_distance_travelled']} km")
+        print(f"Next service time: {status['next_service_time']} km")
+        print(f"Availability: {'Available' if status['availability'] else 'Not available'}")
+        print(f"Service status: {'In Service' if status['is_in_service'] else 'Not in Service'}")
 
     def check_rented_car_status(self): 
         print("Checking rented car status:")
         license_plate = input("Enter license plate of the rented car: ")
-        for car, start_circle, end_circle in self.rented_cars:  
-            # when checking the rented car status the location is shown as "start circle - end circle"
-            if car.license_plate == license_plate:
-                print(f"Rented car {car.name} ({car.car_type}) status:")
-                if start_circle in ["Inner Circle", "Middle Circle", "Outer Circle"]:
-                    print(f"Start Circle: {start_circle}")  
-                else:
-                    print(f"Start Circle: {start_circle}") 
-                if end_circle in ["Inner Circle", "Middle Circle", "Outer Circle"]:
-                    print(f"End Circle: {end_circle}") 
-                else:
-                    print(f"End Circle: {end_circle}") 
-                # then show total distance travelled, next service time (1500 km - total distance travelled) and service status
-                print(f"Total distance traveled: {car.total_distance_travelled} km")
-                print(f"Next service time: {car.next_service_time} km")
-                print(f"Service status: {'In Service' if car.is_in_service else 'Not in Service'}")
-                break
-        else:
+        try:
+            rental = self.service.rented_car_status(license_plate)
+        except NotFoundError:
             print("Rented car not found. Please enter an existing license plate in rental")
+            return
+        car = rental.car
+        # when checking the rented car status the location is shown as "start circle - end circle"
+        print(f"Rented car {car.name} ({car.car_type}) status:")
+        print(f"Start Circle: {rental.start_circle}")  
+        print(f"End Circle: {rental.end_circle}") 
+        # then show total distance travelled, next service time (1500 km - total distance travelled) and service status
+        print(f"Total distance traveled: {car.total_distance_travelled} km")
+        print(f"Next service time: {car.next_service_time} km")
+        print(f"Service status: {'In Service' if car.is_in_service else 'Not in Service'}")
 
     def add_user(self):
         print("Adding a new user:")
@@ -528,24 +2055,23 @@ class RentItNow:
         address = input("Enter address: ")
         credit_card = input("Enter credit card number: ")
         driving_license = input("Enter driving license number: ")
-        new_user = User(name, surname, address, credit_card, driving_license)
-        self.users.append(new_user)
-        print("User added successfully!")
+        try:
+            self.service.add_user(name, surname, address, credit_card, driving_license)
+        except AlreadyExistsError:
+            print("A user with this name is already present. Enter a new user")
+        else:
+            print("User added successfully!")
 
     def update_user(self):
         print("Updating user details:")
         name = input("Enter name of the user to update: ")
         # user has to be present in the database
-        user = self.find_user(name)
-        if user:
+        if self.find_user(name):
             surname = input("Enter surname: ")
             address = input("Enter address: ")
             credit_card = input("Enter credit card number: ")
             driving_license = input("Enter driving license number: ")
-            user.surname = surname
-            user.address = address
-            user.credit_card = credit_card
-            user.driving_license = driving_license
+            self.service.update_user(name, surname=surname, address=address, credit_card=credit_card, driving_license=driving_license)
             print("User details updated successfully!")
         else:
             print("User not found. Enter an existing user")
@@ -554,12 +2080,30 @@ class RentItNow:
         print("Removing a user:")
         name = input("Enter name of the user to remove: ")
         # user has to be present in the database
-        user = self.find_user(name)
-        if user:
-            self.users.remove(user)
-            print("User removed successfully.")
-        else:
+        try:
+            self.service.remove_user(name)
+        except NotFoundError:
             print("User not found. Enter an existing user")
+        else:
+            print("User removed successfully.")
+
+# interactive rental system: python RentItNow_rental_software.py [options]. Cars, users and rentals are saved in the
+# database (rentitnow.db by default), so they are kept between two runs. Importing this module does not start it
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RentItNow car rental system")
+    parser.add_argument("--database", default="rentitnow.db", help="SQLite database file")
+    parser.add_argument("--event-log", default="rentitnow.events", help="event log of the rentals and of the changes")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="import reportlab and start the receipt workers before the first rental")
+    arguments = parser.parse_args(argv)
+    # the database keeps the cars and the users: the event log does not keep their rows too
+    event_log = EventLog(arguments.event_log, keep_rows=False)
+    rental_system = RentItNow(storage=SQLiteStorage(arguments.database), event_log=event_log)
+    if arguments.prewarm:
+        rental_system.service.prewarm()
+    rental_system.main()
+    return 0
+
 
-rental_system = RentItNow()
-rental_system.main()
+if __name__ == "__main__":
+    sys.exit(main())
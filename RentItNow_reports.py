@@ -0,0 +1,197 @@
+# Reports on the rental trends. The totals are updated every time a rental is committed (record), so a report
+# is read from the totals, in time proportional to the number of rows of the report and not to the number of rentals.
+# Totals kept:
+#   - rentals, km and revenue per car type
+#   - rentals and revenue per route (start circle -> end circle), shown as a start x end heatmap
+#   - rentals, km, revenue and hours on rent per car, and the same per start circle (with the drop-offs per end circle)
+#   - rentals and revenue per hour and per day
+# The hours on rent of a trip are its distance divided by the speed of the car type.
+# Reports can be exported as csv files or as a pdf (reportlab is only imported when a pdf is exported).
+# https://docs.python.org/3/library/csv.html
+# https://www.reportlab.com/docs/reportlab-userguide.pdf
+import csv
+import threading
+from datetime import datetime
+from RentItNow_pricing import CIRCLES, CAR_TYPES, CAR_SPEEDS
+
+RENTED_AT_FORMAT = "%Y-%m-%d %H:%M"
+
+# titles of the report tables, in the order they are exported
+REPORT_TITLES = {
+    "car_types": "Revenue per car type",
+    "routes": "Rentals per route (start circle in rows, end circle in columns)",
+    "circles": "Utilisation per circle",
+    "cars": "Utilisation per car",
+    "daily": "Rentals per day",
+    "hourly": "Rentals per hour",
+}
+
+
+class RentalReports:
+    def __init__(self):
+        self.car_types = {}  # car_type -> [rentals, km, revenue]
+        self.routes = {}  # (start_circle, end_circle) -> [rentals, revenue]
+        self.cars = {}  # license_plate -> [car_type, rentals, km, revenue, hours]
+        self.circles = {}  # circle -> [pickups, drop-offs, hours on rent of the trips starting in the circle]
+        self.hours = {}  # "YYYY-MM-DD HH" -> [rentals, revenue]
+        self.days = {}  # "YYYY-MM-DD" -> [rentals, revenue]
+        self.first_rental = None  # "YYYY-MM-DD HH:MM" of the first rental recorded
+        self.lock = threading.Lock()
+
+    # add a committed rental to the totals
+    def record(self, car_type, license_plate, start_circle, end_circle, distance, total_cost, rented_at):
+        hours = distance / CAR_SPEEDS[car_type] if car_type in CAR_SPEEDS else 0
+        with self.lock:
+            totals = self.car_types.setdefault(car_type, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += distance
+            totals[2] += total_cost
+            totals = self.routes.setdefault((start_circle, end_circle), [0, 0])
+            totals[0] += 1
+            totals[1] += total_cost
+            totals = self.cars.setdefault(license_plate, [car_type, 0, 0, 0, 0])
+            totals[0] = car_type
+            totals[1] += 1
+            totals[2] += distance
+            totals[3] += total_cost
+            totals[4] += hours
+            totals = self.circles.setdefault(start_circle, [0, 0, 0])
+            totals[0] += 1
+            totals[2] += hours
+            self.circles.setdefault(end_circle, [0, 0, 0])[1] += 1
+            totals = self.hours.setdefault(rented_at[:13], [0, 0])
+            totals[0] += 1
+            totals[1] += total_cost
+            totals = self.days.setdefault(rented_at[:10], [0, 0])
+            totals[0] += 1
+            totals[1] += total_cost
+            if self.first_rental is None or rented_at < self.first_rental:
+                self.first_rental = rented_at
+
+    # Totals as plain lists and dicts, copied so that they can be saved as json (the event log snapshot, the
+    # report_totals table of the storage) while rentals are recorded; load_state puts them back
+    def state(self):
+        with self.lock:
+            return {
+                "car_types": {car_type: list(totals) for car_type, totals in self.car_types.items()},
+                "routes": [[start, end, *totals] for (start, end), totals in self.routes.items()],
+                "cars": {license_plate: list(totals) for license_plate, totals in self.cars.items()},
+                "circles": {circle: list(totals) for circle, totals in self.circles.items()},
+                "hours": {hour: list(totals) for hour, totals in self.hours.items()},
+                "days": {day: list(totals) for day, totals in self.days.items()},
+                "first_rental": self.first_rental,
+            }
+
+    def load_state(self, state):
+        with self.lock:
+            self.car_types = state["car_types"]
+            self.routes = {(start, end): totals for start, end, *totals in state["routes"]}
+            self.cars = state["cars"]
+            self.circles = state["circles"]
+            self.hours = state["hours"]
+            self.days = state["days"]
+            self.first_rental = state["first_rental"]
+
+    # hours from the first rental recorded to now: the utilisation is the share of these hours spent on rent
+    def period_hours(self, now=None):
+        if self.first_rental is None:
+            return 0
+        now = now or datetime.now()
+        return max((now - datetime.strptime(self.first_rental, RENTED_AT_FORMAT)).total_seconds() / 3600, 1)
+
+    def summary(self):
+        with self.lock:
+            rentals = sum(totals[0] for totals in self.car_types.values())
+            distance = sum(totals[1] for totals in self.car_types.values())
+            revenue = sum(totals[2] for totals in self.car_types.values())
+        return {"rentals": rentals, "distance": distance, "revenue": revenue, "first_rental": self.first_rental}
+
+    # Each report is a table: (header, rows)
+    def car_type_report(self):
+        with self.lock:
+            rows = [[car_type, *self.car_types.get(car_type, [0, 0, 0])] for car_type in CAR_TYPES]
+            rows.extend([car_type, *totals] for car_type, totals in sorted(self.car_types.items()) if car_type not in CAR_TYPES)
+        return ["Car type", "Rentals", "Km", "Revenue ($)"], rows
+
+    def route_heatmap(self):
+        with self.lock:
+            rows = [[start, *(self.routes.get((start, end), [0, 0])[0] for end in CIRCLES)] for start in CIRCLES]
+        return ["From \\ To", *CIRCLES], rows
+
+    # the cars move from circle to circle, so the utilisation of a circle is its share of all the hours on rent
+    def circle_report(self):
+        with self.lock:
+            total_hours = sum(totals[2] for totals in self.circles.values())
+            rows = []
+            for circle in CIRCLES:
+                pickups, dropoffs, hours = self.circles.get(circle, [0, 0, 0])
+                rows.append([circle, pickups, dropoffs, round(hours, 2), round(hours / total_hours, 4) if total_hours else 0])
+        return ["Circle", "Pick-ups", "Drop-offs", "Hours on rent", "Share of hours"], rows
+
+    # utilisation of a car: share of the hours since the first rental spent on rent
+    def car_report(self, now=None):
+        period = self.period_hours(now)
+        with self.lock:
+            rows = [[license_plate, car_type, rentals, distance, revenue, round(hours, 2), round(hours / period, 4) if period else 0]
+                    for license_plate, (car_type, rentals, distance, revenue, hours) in sorted(self.cars.items())]
+        return ["License plate", "Car type", "Rentals", "Km", "Revenue ($)", "Hours on rent", "Utilisation"], rows
+
+    def daily_report(self):
+        with self.lock:
+            rows = [[day, *totals] for day, totals in sorted(self.days.items())]
+        return ["Day", "Rentals", "Revenue ($)"], rows
+
+    # rentals per hour, of a single day ("YYYY-MM-DD") or of all the days
+    def hourly_report(self, day=None):
+        with self.lock:
+            rows = [[hour + ":00", *totals] for hour, totals in sorted(self.hours.items()) if day is None or hour.startswith(day)]
+        return ["Hour", "Rentals", "Revenue ($)"], rows
+
+    # all the reports, by name (see REPORT_TITLES)
+    def tables(self, now=None):
+        return {
+            "car_types": self.car_type_report(),
+            "routes": self.route_heatmap(),
+            "circles": self.circle_report(),
+            "cars": self.car_report(now),
+            "daily": self.daily_report(),
+            "hourly": self.hourly_report(),
+        }
+
+    # one csv file for each report: <prefix>_<name>.csv. The list of the written files is returned
+    def export_csv(self, prefix):
+        filenames = []
+        for name, (header, rows) in self.tables().items():
+            filename = f"{prefix}_{name}.csv"
+            with open(filename, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                writer.writerows(rows)
+            filenames.append(filename)
+        return filenames
+
+    # all the reports in a single pdf, one table after the other
+    def export_pdf(self, filename):
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+        styles = getSampleStyleSheet()
+        summary = self.summary()
+        elements = [
+            Paragraph("RentItNow rental report", styles["Title"]),
+            Paragraph(f"Generated on {datetime.now().strftime(RENTED_AT_FORMAT)}. {summary['rentals']} rentals, "
+                      f"{summary['distance']} km, revenue ${summary['revenue']}", styles["BodyText"]),
+        ]
+        for name, (header, rows) in self.tables().items():
+            elements.append(Spacer(1, 12))
+            elements.append(Paragraph(REPORT_TITLES[name], styles["Heading2"]))
+            table = Table([header] + rows, repeatRows=1)
+            table.setStyle(TableStyle([
+                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+                ("FONTSIZE", (0, 0), (-1, -1), 8),
+            ]))
+            elements.append(table)
+        SimpleDocTemplate(filename, pagesize=A4).build(elements)
+        return filename
@@ -0,0 +1,134 @@
+# Reservations of cars in advance, for a period of time that can last several days.
+# Every car has a calendar with its reservations sorted by start time. The reservations of a car never overlap,
+# so checking whether a car is free in a period is a binary search in its calendar (O(log n) in the number of
+# reservations of the car), whatever the number of reservations of the whole fleet.
+# Periods are half-open: a reservation from 10:00 to 12:00 does not overlap one from 12:00 to 14:00.
+# https://docs.python.org/3/library/bisect.html
+import bisect
+import heapq
+import threading
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# accept a datetime or a "YYYY-MM-DD HH:MM" string (raises ValueError or TypeError for anything else)
+def parse_time(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, TIME_FORMAT)
+
+
+# Class Reservation creation: a reservation stores who reserved which car, the route and the reserved period
+class Reservation:
+    def __init__(self, reservation_id, username, license_plate, car_type, start_circle, end_circle, start, end):
+        self.reservation_id = reservation_id
+        self.username = username
+        self.license_plate = license_plate
+        self.car_type = car_type
+        self.start_circle = start_circle
+        self.end_circle = end_circle
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return (f"Reservation {self.reservation_id}: {self.car_type} car {self.license_plate} from "
+                f"{self.start.strftime(TIME_FORMAT)} to {self.end.strftime(TIME_FORMAT)} ({self.start_circle} - {self.end_circle})")
+
+
+# reservations of a single car: starts, ends and ids are parallel lists sorted by start time
+class CarCalendar:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    # the car is free if the last reservation starting before the end of the period ends before its start
+    def is_free(self, start, end):
+        position = bisect.bisect_left(self.starts, end)
+        return position == 0 or self.ends[position - 1] <= start
+
+    # the period must be free (see is_free)
+    def add(self, start, end, reservation_id):
+        position = bisect.bisect_left(self.starts, end)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.ids.insert(position, reservation_id)
+
+    def remove(self, start, reservation_id):
+        position = bisect.bisect_left(self.starts, start)
+        while self.ids[position] != reservation_id:
+            position += 1
+        del self.starts[position]
+        del self.ends[position]
+        del self.ids[position]
+
+
+# All the reservations, with the calendar of each reserved car (by license plate)
+class ReservationBook:
+    def __init__(self):
+        self.calendars = {}
+        self.reservations = {}
+        # (end, reservation_id) of the reservations, smallest end first: the expired ones are found without scanning
+        # all the reservations (entries of reservations already removed are skipped)
+        self.ends = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.reservations)
+
+    def get(self, reservation_id):
+        return self.reservations.get(reservation_id)
+
+    def is_free(self, license_plate, start, end):
+        calendar = self.calendars.get(license_plate)
+        if calendar is None:
+            return True
+        with self.lock:
+            return calendar.is_free(start, end)
+
+    def has_reservations(self, license_plate):
+        return license_plate in self.calendars
+
+    # add the reservation if its car is free in the reserved period: returns False otherwise
+    def add(self, reservation):
+        with self.lock:
+            calendar = self.calendars.get(reservation.license_plate)
+            if calendar is None:
+                calendar = self.calendars[reservation.license_plate] = CarCalendar()
+            if not calendar.is_free(reservation.start, reservation.end):
+                return False
+            calendar.add(reservation.start, reservation.end, reservation.reservation_id)
+            self.reservations[reservation.reservation_id] = reservation
+            heapq.heappush(self.ends, (reservation.end, reservation.reservation_id))
+            return True
+
+    # remove a reservation and return it (None if there is no reservation with the given id)
+    def remove(self, reservation_id):
+        with self.lock:
+            reservation = self.reservations.pop(reservation_id, None)
+            if reservation is None:
+                return None
+            calendar = self.calendars[reservation.license_plate]
+            calendar.remove(reservation.start, reservation_id)
+            if not calendar:
+                del self.calendars[reservation.license_plate]
+            return reservation
+
+    # reservations of a user, sorted by start time
+    def of_user(self, username):
+        with self.lock:
+            reservations = [reservation for reservation in self.reservations.values() if reservation.username == username]
+        return sorted(reservations, key=lambda reservation: reservation.start)
+
+    # reservations already ended (never picked up). They are only returned once: the caller removes them
+    def expired(self, now):
+        expired = []
+        with self.lock:
+            while self.ends and self.ends[0][0] <= now:
+                reservation = self.reservations.get(heapq.heappop(self.ends)[1])
+                if reservation is not None:
+                    expired.append(reservation)
+        return expired
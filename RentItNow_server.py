@@ -0,0 +1,451 @@
+# HTTP/JSON server of RentItNow, meant to run on localhost behind the company gateway.
+# The server is built on asyncio: the connections are handled by a single event loop, while the operations of the
+# RentalService (which may wait for the payment, the database or the receipt queue) run in a pool of threads,
+# so a slow request never blocks the other clients.
+# Connections are kept alive (HTTP/1.1) and requests sent one after the other on the same connection without
+# waiting for the responses (pipelining) are answered in order.
+#
+# Endpoints (bodies and responses are JSON):
+#   POST   /rentals            {"username", "car_type", "num_passengers", "start_circle", "end_circle"}
+#   GET    /rentals/<plate>     status of the last rental of a car
+#   POST   /rentals/<plate>/return   {"username"} (optional) end the rental of a car
+#   POST   /cars               {"car_type", "license_plate", "brand", "name", "location"}
+#   GET    /cars/<plate>        status of a car
+#   PUT    /cars/<plate>        {"car_type", "brand", "name", "location"} (only the given values are changed)
+#   DELETE /cars/<plate>
+#   POST   /cars/<plate>/service     complete the service of a car
+#   POST   /users              {"name", "surname", "address", "credit_card", "driving_license"}
+#   GET    /users/<name>
+#   PUT    /users/<name>        {"name", "surname", "address", "credit_card", "driving_license"} (only the given values)
+#   DELETE /users/<name>
+#   POST   /reservations       {"username", "car_type", "num_passengers", "start_circle", "end_circle", "start", "end"}
+#                               reserve a car in advance (times as "YYYY-MM-DD HH:MM")
+#   POST   /reservations/search {"car_type", "start_circle", "start", "end"} cars free in a period
+#   GET    /reservations/<id>
+#   POST   /reservations/<id>/rent   {"username"} (optional) rent the car of a reservation
+#   DELETE /reservations/<id>
+#   POST   /quotes             {"trips": [[car_type, start_circle, end_circle], ...]} distances and costs of many trips
+#   GET    /reports            reports on the rental trends (revenue per car type, routes, utilisation, per day and hour)
+#   POST   /reports            {"mode": "csv" or "pdf"} export the reports
+#   GET    /maintenance[/<n>]  the n (default 20) cars with the fewest km left before their service
+#   POST   /maintenance        {"license_plate"} send a car to its service (completed with POST /cars/<plate>/service)
+#   GET    /rebalancing        plan of the moves of the available cars towards the recent demand
+#   POST   /rebalancing        compute the plan and move the cars
+#   POST   /receipts           {"day": "YYYY-MM-DD", "mode": "pdf" or "zip"} receipts of all the rentals of a day
+#   GET    /metrics            timing metrics of the operations, in the Prometheus text format (needs --metrics)
+#   GET    /health
+#
+# Usage: python RentItNow_server.py [--host 127.0.0.1] [--port 8080] [--max-concurrency 64] [--database rentitnow.db]
+#                                  [--event-log rentitnow.events] [--metrics] [--metrics-file rentitnow.prom]
+#                                  [--profile rentitnow.stacks]
+# --max-concurrency is the maximum number of requests processed at the same time (and the size of the thread pool):
+# further requests wait until one of them is done.
+# --metrics measures the duration of the expensive operations of the service (see RentItNow_metrics); with
+# --metrics-file the metrics are also written to that file when the server stops. --profile samples the stacks of the
+# threads while the server runs and writes them to the given file in the collapsed format of the flame graph tools.
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import unquote, urlsplit
+from RentItNow_rental_software import (RentalService, RentItNowError, InvalidInputError, NotFoundError,
+                                       AlreadyExistsError, CarNotAvailableError)
+from RentItNow_eventlog import EventLog
+from RentItNow_metrics import instrument, SamplingProfiler
+from RentItNow_reservations import TIME_FORMAT
+from RentItNow_storage import SQLiteStorage
+
+DEFAULT_MAX_CONCURRENCY = 64
+# requests with a bigger body are refused
+MAX_BODY_SIZE = 1024 * 1024
+
+# fields of the request bodies and their types
+RENTAL_FIELDS = {"username": str, "car_type": str, "num_passengers": int, "start_circle": str, "end_circle": str}
+CAR_FIELDS = {"car_type": str, "license_plate": str, "brand": str, "name": str, "location": str}
+CAR_UPDATE_FIELDS = {"car_type": str, "brand": str, "name": str, "location": str}
+USER_FIELDS = {"name": str, "surname": str, "address": str, "credit_card": str, "driving_license": str}
+RESERVATION_FIELDS = {**RENTAL_FIELDS, "start": str, "end": str}
+SEARCH_FIELDS = {"car_type": str, "start_circle": str, "start": str, "end": str}
+USERNAME_FIELDS = {"username": str}
+TYPE_NAMES = {str: "a string", int: "an integer"}
+
+STATUS_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                  409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+# error answered with the given HTTP status
+class HTTPError(Exception):
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+# values of a request body checked against its fields (name -> type): unknown fields, missing fields and values of
+# the wrong type are answered with 400 before the service is called. With required=False the fields may be missing
+def body_values(data, fields, required=True):
+    unknown = sorted(set(data) - set(fields))
+    if unknown:
+        raise HTTPError(400, f"Unknown field(s): {', '.join(unknown)}")
+    values = {}
+    for name, kind in fields.items():
+        value = data.get(name)
+        if value is None:
+            if required:
+                raise HTTPError(400, f"Missing field {name!r}")
+            continue
+        # True and False are ints for Python, not for the clients
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise HTTPError(400, f"Field {name!r} must be {TYPE_NAMES[kind]}")
+        values[name] = value
+    return values
+
+
+def rental_to_dict(rental):
+    return {
+        "rental_id": rental.rental_id,
+        "username": rental.username,
+        "license_plate": rental.car.license_plate,
+        "car": str(rental.car),
+        "start_circle": rental.start_circle,
+        "end_circle": rental.end_circle,
+        "distance": rental.distance,
+        "total_cost": rental.total_cost,
+        "rented_at": rental.rented_at,
+        "returned_at": rental.returned_at,
+        "receipt": rental.receipt.filename if rental.receipt is not None else None,
+    }
+
+# when and where the next car should be free (license_plate is None for the worst case, when no car is on rent)
+def estimate_to_dict(estimate):
+    return {
+        "car_type": estimate.car_type,
+        "start_circle": estimate.start_circle,
+        "hours": round(estimate.hours, 4),
+        "available_at": estimate.available_at.strftime(TIME_FORMAT),
+        "license_plate": estimate.license_plate,
+        "from_circle": estimate.from_circle,
+    }
+
+def plan_to_dict(plan):
+    return {
+        "moves": [{"car_type": move.car_type, "from_circle": move.from_circle, "to_circle": move.to_circle,
+                   "cars": move.cars, "distance": move.distance} for move in plan.moves],
+        "cars_moved": plan.cars_moved(),
+        "total_distance": plan.total_distance(),
+        "available": [{"car_type": car_type, "circle": circle, "now": count, "target": plan.targets[car_type, circle]}
+                      for (car_type, circle), count in plan.counts.items()],
+    }
+
+def reservation_to_dict(reservation):
+    return {
+        "reservation_id": reservation.reservation_id,
+        "username": reservation.username,
+        "license_plate": reservation.license_plate,
+        "car_type": reservation.car_type,
+        "start_circle": reservation.start_circle,
+        "end_circle": reservation.end_circle,
+        "start": reservation.start.strftime(TIME_FORMAT),
+        "end": reservation.end.strftime(TIME_FORMAT),
+    }
+
+# the credit card number is never sent back
+def user_to_dict(user):
+    return {"name": user.name, "surname": user.surname, "address": user.address, "driving_license": user.driving_license}
+
+
+class RentalServer:
+    def __init__(self, service, host="127.0.0.1", port=8080, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="rentitnow")
+        self.server = None
+        self.slots = None
+        # writers of the open connections, closed when the server stops
+        self.connections = set()
+
+    async def start(self):
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        print(f"RentItNow server listening on http://{self.host}:{self.port} (max concurrency {self.max_concurrency})")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    # run a (blocking) operation of the service in the thread pool
+    async def call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    # read the requests of a connection one after the other and answer them in the same order
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as error:
+                    await self.write_response(writer, error.status, {"error": str(error)}, keep_alive=False)
+                    break
+                except (ValueError, asyncio.LimitOverrunError):
+                    # the request line or a header is longer than the limit of the stream
+                    await self.write_response(writer, 400, {"error": "Request line or header too long"}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body, keep_alive = request
+                async with self.slots:
+                    status, payload = await self.dispatch(method, path, body)
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    # returns (method, path, headers, body, keep_alive), or None when the client closed the connection
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Invalid request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        # HTTP/1.1 connections are kept alive unless the client asks to close them, HTTP/1.0 ones only if asked
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method.upper(), unquote(urlsplit(target).path), headers, body, keep_alive
+
+    # the payload is sent as JSON, or as plain text if it is a string (metrics)
+    async def write_response(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body = payload.encode()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = json.dumps(payload).encode()
+            content_type = "application/json"
+        head = (f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    # route a request to the right handler and turn the errors of the service into HTTP errors
+    async def dispatch(self, method, path, body):
+        try:
+            parts = [part for part in path.split("/") if part]
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise HTTPError(400, "The request body must be a JSON object")
+            return await self.route(method, parts, data)
+        except HTTPError as error:
+            return error.status, {"error": str(error), **error.details}
+        except json.JSONDecodeError:
+            return 400, {"error": "Invalid JSON body"}
+        except CarNotAvailableError as error:
+            return 409, {"error": str(error), "waiting_time": error.waiting_time,
+                         "estimate": estimate_to_dict(error.estimate) if error.estimate is not None else None}
+        except InvalidInputError as error:
+            return 400, {"error": str(error)}
+        except NotFoundError as error:
+            return 404, {"error": str(error)}
+        except AlreadyExistsError as error:
+            return 409, {"error": str(error)}
+        except RentItNowError as error:
+            return 400, {"error": str(error)}
+        except Exception as error:
+            return 500, {"error": f"Internal error: {error}"}
+
+    # the optional username of a body (the user acting on a rental or a reservation)
+    def username(self, data):
+        return body_values(data, USERNAME_FIELDS, required=False).get("username")
+
+    async def route(self, method, parts, data):
+        service = self.service
+        if parts == ["health"] and method == "GET":
+            return 200, {"status": "ok"}
+        if parts == ["metrics"] and method == "GET":
+            if service.metrics is None:
+                raise HTTPError(404, "Metrics are not enabled (start the server with --metrics)")
+            return 200, service.metrics.prometheus_text()
+        if parts == ["rentals"] and method == "POST":
+            rental = await self.call(service.rent, **body_values(data, RENTAL_FIELDS))
+            return 201, rental_to_dict(rental)
+        if len(parts) == 2 and parts[0] == "rentals" and method == "GET":
+            return 200, rental_to_dict(await self.call(service.rented_car_status, parts[1]))
+        if len(parts) == 3 and parts[0] == "rentals" and parts[2] == "return" and method == "POST":
+            return 200, rental_to_dict(await self.call(service.return_car, parts[1], self.username(data)))
+        if len(parts) == 3 and parts[0] == "cars" and parts[2] == "service" and method == "POST":
+            car = await self.call(service.complete_service, parts[1])
+            return 200, await self.call(service.car_status, car.license_plate)
+        if parts == ["cars"] and method == "POST":
+            car = await self.call(service.add_car, **body_values(data, CAR_FIELDS))
+            return 201, await self.call(service.car_status, car.license_plate)
+        if len(parts) == 2 and parts[0] == "cars":
+            if method == "GET":
+                return 200, await self.call(service.car_status, parts[1])
+            if method == "PUT":
+                await self.call(service.update_car, parts[1], **body_values(data, CAR_UPDATE_FIELDS, required=False))
+                return 200, await self.call(service.car_status, parts[1])
+            if method == "DELETE":
+                await self.call(service.remove_car, parts[1])
+                return 200, {"removed": parts[1]}
+        if parts == ["users"] and method == "POST":
+            return 201, user_to_dict(await self.call(service.add_user, **body_values(data, USER_FIELDS)))
+        if len(parts) == 2 and parts[0] == "users":
+            if method == "GET":
+                return 200, user_to_dict(await self.call(service.get_user, parts[1]))
+            if method == "PUT":
+                return 200, user_to_dict(await self.call(service.update_user, parts[1], **body_values(data, USER_FIELDS, required=False)))
+            if method == "DELETE":
+                await self.call(service.remove_user, parts[1])
+                return 200, {"removed": parts[1]}
+        if parts == ["reservations"] and method == "POST":
+            return 201, reservation_to_dict(await self.call(service.make_reservation, **body_values(data, RESERVATION_FIELDS)))
+        if parts == ["reservations", "search"] and method == "POST":
+            # limit (optional): at most that many cars, the closest ones
+            values = body_values({name: value for name, value in data.items() if name != "limit"}, SEARCH_FIELDS)
+            values.update(body_values({"limit": data.get("limit")}, {"limit": int}, required=False))
+            cars = await self.call(service.free_cars, **values)
+            return 200, {"cars": [{"license_plate": car.license_plate, "car": str(car), "location": car.location} for car in cars]}
+        if len(parts) >= 2 and parts[0] == "reservations":
+            if not parts[1].isdigit():
+                raise HTTPError(404, f"Reservation {parts[1]!r} not found")
+            reservation_id = int(parts[1])
+            if len(parts) == 2 and method == "GET":
+                return 200, reservation_to_dict(await self.call(service.get_reservation, reservation_id))
+            if len(parts) == 2 and method == "DELETE":
+                return 200, reservation_to_dict(await self.call(service.cancel_reservation, reservation_id, self.username(data)))
+            if parts[2:] == ["rent"] and method == "POST":
+                return 201, rental_to_dict(await self.call(service.rent_reserved_car, reservation_id, self.username(data)))
+        if parts == ["quotes"] and method == "POST":
+            trips = data.get("trips")
+            if (set(data) != {"trips"} or not isinstance(trips, list)
+                    or not all(isinstance(trip, list) and len(trip) == 3 and all(isinstance(value, str) for value in trip)
+                               for trip in trips)):
+                raise HTTPError(400, "trips must be a list of [car_type, start_circle, end_circle]")
+            distances, costs = await self.call(service.quote_many, trips)
+            return 200, {"distances": list(map(int, distances)), "costs": list(map(int, costs))}
+        if parts == ["reports"] and method == "GET":
+            tables = await self.call(service.rental_reports)
+            return 200, {"summary": service.reports.summary(),
+                         **{name: {"header": header, "rows": rows} for name, (header, rows) in tables.items()}}
+        if parts == ["reports"] and method == "POST":
+            mode = body_values(data, {"mode": str}, required=False).get("mode", "pdf")
+            output = f"rental_report_{datetime.now().strftime('%Y-%m-%d')}"
+            return 201, {"files": await self.call(service.export_reports, output, mode)}
+        if parts[:1] == ["maintenance"] and len(parts) <= 2 and method == "GET":
+            if len(parts) == 2 and not parts[1].isdigit():
+                raise HTTPError(400, "The number of cars must be a positive integer")
+            due = await self.call(service.cars_due_for_service, int(parts[1]) if len(parts) == 2 else 20)
+            return 200, {"cars": [{"license_plate": car.license_plate, "car": str(car), "km_left": km_left,
+                                   "is_in_service": car.is_in_service, "on_rent": car.license_plate in service.rented_cars}
+                                  for car, km_left in due]}
+        if parts == ["maintenance"] and method == "POST":
+            car = await self.call(service.send_to_service, body_values(data, {"license_plate": str})["license_plate"])
+            return 200, await self.call(service.car_status, car.license_plate)
+        if parts == ["rebalancing"] and method == "GET":
+            return 200, plan_to_dict(await self.call(service.rebalancing_plan))
+        if parts == ["rebalancing"] and method == "POST":
+            plan = await self.call(service.rebalancing_plan)
+            moved = await self.call(service.apply_rebalancing, plan)
+            return 200, {**plan_to_dict(plan), "moved": [{"license_plate": license_plate, "from_circle": from_circle,
+                                                          "to_circle": to_circle} for license_plate, from_circle, to_circle in moved]}
+        if parts == ["receipts"] and method == "POST":
+            values = body_values(data, {"day": str, "mode": str}, required=False)
+            day = values.get("day")
+            mode = values.get("mode", "pdf")
+            # the day and the mode are part of the name of the output file
+            try:
+                if day is None or datetime.strptime(day, "%Y-%m-%d").strftime("%Y-%m-%d") != day:
+                    raise ValueError(day)
+            except ValueError:
+                raise HTTPError(400, "day must be a date as YYYY-MM-DD")
+            if mode not in ("pdf", "zip"):
+                raise HTTPError(400, "mode must be pdf or zip")
+            filenames = await self.call(service.generate_receipts_batch, day, f"rental_receipts_{day}.{mode}", mode)
+            return 201, {"files": filenames}
+        if parts and parts[0] in ("health", "metrics", "rentals", "cars", "users", "reservations", "quotes", "reports",
+                                  "maintenance", "rebalancing", "receipts"):
+            raise HTTPError(405, f"Method {method} not allowed on /{'/'.join(parts)}")
+        raise HTTPError(404, f"Unknown path /{'/'.join(parts)}")
+
+
+def serve(service, host="127.0.0.1", port=8080, max_concurrency=DEFAULT_MAX_CONCURRENCY, metrics_file=None,
+          profile=None):
+    server = RentalServer(service, host, port, max_concurrency)
+    profiler = SamplingProfiler().start() if profile else None
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=True)
+        # receipts still in the queue are written before exiting
+        service.close()
+        if metrics_file and service.metrics is not None:
+            service.metrics.write_prometheus(metrics_file)
+        if profiler is not None:
+            profiler.stop().write_collapsed(profile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RentItNow HTTP/JSON server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY,
+                        help="maximum number of requests processed at the same time")
+    parser.add_argument("--database", default="rentitnow.db", help="SQLite database file")
+    parser.add_argument("--event-log", help="append the rentals and the changes of cars and users to this event log")
+    parser.add_argument("--metrics", action="store_true", help="measure the operations and serve the metrics on /metrics")
+    parser.add_argument("--metrics-file", help="write the metrics to this file when the server stops (implies --metrics)")
+    parser.add_argument("--profile", help="sample the stacks of the threads and write them to this file when the server stops")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="import reportlab and start the receipt workers before serving the first request")
+    arguments = parser.parse_args()
+    event_log = EventLog(arguments.event_log, keep_rows=False) if arguments.event_log else None
+    service = RentalService(storage=SQLiteStorage(arguments.database), event_log=event_log)
+    if arguments.metrics or arguments.metrics_file:
+        instrument(service)
+    if arguments.prewarm:
+        service.prewarm()
+    serve(service, arguments.host, arguments.port, arguments.max_concurrency, arguments.metrics_file, arguments.profile)
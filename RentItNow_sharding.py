@@ -0,0 +1,338 @@
+# Sharded rental engine of RentItNow: the fleet is split between several worker processes (shards), each one with
+# its own RentalService, so the rentals of different circles run on different cores instead of sharing a single
+# Python interpreter.
+#
+# Partition: with up to 3 shards every circle belongs to one shard (circle i -> shard i % shards); with more shards
+# every depot (circle and car type) belongs to one shard, so up to 9 shards can be used.
+# The router (ShardedRentalEngine, in the main process) keeps the users and sends every rental to the shard owning
+# the start circle. When that shard has no free car, the rental goes to the owners of the other circles in hop order,
+# exactly as select_best_car walks the circles. A car stays in its shard while it is on rent; when it is returned in
+# a circle owned by another shard it is moved to that shard (cross-shard transfer).
+#
+# Requests are sent in batches (rent_many, return_many): a batch is split by shard, sent to all the shards at once and
+# the answers are collected afterwards, so the shards work in parallel.
+#
+#   with ShardedRentalEngine(shards=3) as engine:
+#       engine.add_cars([("ECO", "ABC123", "Toyota", "Yaris", "Inner Circle"), ...])
+#       engine.add_user("Federica", "Ferrari", "Via A", "ABC", "DEF")
+#       rental = engine.rent("Federica", "ECO", 2, "Inner Circle", "Outer Circle")
+#       engine.return_car(rental["license_plate"])
+# https://docs.python.org/3/library/multiprocessing.html
+import itertools
+import multiprocessing
+import threading
+from RentItNow_rental_software import (RentalService, RentItNowError, InvalidInputError, NotFoundError, AlreadyExistsError,
+                                       CarNotAvailableError, User, CIRCLES_BY_DISTANCE, MAX_PASSENGERS, car_from_row, car_row)
+from RentItNow_pricing import CIRCLES, CIRCLE_CODES, CAR_TYPE_CODES, CAR_SPEEDS, DISTANCES
+
+# errors raised in the shards are sent back by name and raised again by the router (as a RentItNowError if they
+# are not errors of the service)
+ERRORS = {error.__name__: error for error in (InvalidInputError, NotFoundError, AlreadyExistsError)}
+# a shard for each depot (circle and car type): more shards would stay empty
+MAX_SHARDS = len(CIRCLE_CODES) * len(CAR_TYPE_CODES)
+# longest trip, used for the waiting time when no shard has a free car
+MAX_TRIP = max(DISTANCES.values())
+
+
+# shard owning the cars of the given type in the given circle
+def shard_of(car_type, circle, shards):
+    if shards <= len(CIRCLES):
+        return CIRCLE_CODES[circle] % shards
+    return (CIRCLE_CODES[circle] * len(CAR_TYPE_CODES) + CAR_TYPE_CODES[car_type]) % shards
+
+
+def rental_to_dict(rental, shard):
+    return {
+        "rental_id": rental.rental_id,
+        "username": rental.username,
+        "license_plate": rental.car.license_plate,
+        "car": str(rental.car),
+        "start_circle": rental.start_circle,
+        "end_circle": rental.end_circle,
+        "distance": rental.distance,
+        "total_cost": rental.total_cost,
+        "rented_at": rental.rented_at,
+        "returned_at": rental.returned_at,
+        "shard": shard,
+    }
+
+
+# Shard: a RentalService with the cars of the circles (depots) owned by the shard. The answers of a batch are in the
+# order of its requests: a result, or ("error", name of the error, message). Any error of a request is answered,
+# so an unexpected one does not stop the shard
+def shard_worker(connection, shard, shards):
+    service = RentalService(receipts=False)
+    # the rental ids of different shards never collide
+    service.rental_ids = itertools.count(shard + 1, shards)
+
+    # rent a car of the given circle only (the router decides the order of the circles). None: no free car there
+    def rent(circle, username, car_type, num_passengers, start_circle, end_circle):
+        service.check_passengers(car_type, num_passengers)
+        accept = service.immediate_rental_filter(car_type, DISTANCES[start_circle, end_circle])
+        car = service.fleet_index.reserve(car_type, circle, accept)
+        if car is None:
+            return None
+        rental = service.pay_and_commit(username, car, start_circle, end_circle)
+        return rental_to_dict(rental, shard)
+
+    # return a car; if its new circle belongs to another shard the car is removed and its row sent back for the transfer
+    def return_car(license_plate):
+        rental = service.return_car(license_plate)
+        car = rental.car
+        owner = shard_of(car.car_type, car.location, shards)
+        if owner == shard:
+            return rental_to_dict(rental, shard), None, None
+        service.remove_car(license_plate)
+        return rental_to_dict(rental, shard), car_row(car), owner
+
+    def add_car_row(row):
+        if not service.register_car(car_from_row(row, service.car_factory)):
+            raise AlreadyExistsError(f"A car with license plate {row[1]!r} is already present")
+
+    def status():
+        available = service.fleet_index.available_total()
+        return {"shard": shard, "cars": len(service.cars), "available": available, "on_rent": len(service.rented_cars),
+                "revenue": service.reports.summary()["revenue"]}
+
+    operations = {"add_car": service.add_car, "add_car_row": add_car_row, "rent": rent, "return": return_car}
+    while True:
+        operation, requests = connection.recv()
+        if operation == "stop":
+            break
+        if operation == "status":
+            connection.send(status())
+            continue
+        function = operations[operation]
+        answers = []
+        for request in requests:
+            try:
+                result = function(*request)
+            except Exception as error:
+                answers.append(("error", type(error).__name__, str(error)))
+            else:
+                # cars are not sent back, only their license plate
+                answers.append(result.license_plate if operation == "add_car" else result)
+        connection.send(answers)
+    service.close()
+    connection.close()
+
+
+def is_error(answer):
+    return isinstance(answer, tuple) and len(answer) == 3 and answer[0] == "error"
+
+
+def to_error(answer):
+    return ERRORS.get(answer[1], RentItNowError)(answer[2])
+
+
+# answers of a shard that has stopped: an error in place of each request of the message
+def shard_failed(shard, message, error):
+    answer = ("error", "RentItNowError", f"Shard {shard} stopped: {error!r}")
+    operation, requests = message
+    return answer if requests is None else [answer] * len(requests)
+
+
+class ShardedRentalEngine:
+    def __init__(self, shards=3, context=None):
+        if not 1 <= shards <= MAX_SHARDS:
+            raise InvalidInputError(f"The number of shards must be between 1 and {MAX_SHARDS}")
+        self.shards = shards
+        context = context or multiprocessing.get_context()
+        self.connections = []
+        self.processes = []
+        for shard in range(shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=shard_worker, args=(child, shard, shards), name=f"rentitnow-shard-{shard}",
+                                      daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.users = {}
+        self.plates = set()
+        self.on_rent = {}  # license_plate -> shard of the cars on rent
+        self.transfers = 0  # cars moved from a shard to another
+        # a batch is sent to the shards and answered before the next one is sent
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def owner(self, car_type, circle):
+        return shard_of(car_type, circle, self.shards)
+
+    # send a batch of requests to each shard (all at once) and collect the answers: {shard: answers}.
+    # The answers of all the shards are always read, so the pipes are never left out of step. A shard that has
+    # stopped answers an error for each of its requests (a single error for status), so the answers of the other
+    # shards are never lost
+    def call(self, batches):
+        with self.lock:
+            answers = {}
+            sent = []
+            for shard, message in batches.items():
+                try:
+                    self.connections[shard].send(message)
+                except (OSError, EOFError) as error:
+                    answers[shard] = shard_failed(shard, message, error)
+                else:
+                    sent.append(shard)
+            for shard in sent:
+                try:
+                    answers[shard] = self.connections[shard].recv()
+                except (OSError, EOFError) as error:
+                    answers[shard] = shard_failed(shard, batches[shard], error)
+            return answers
+
+    def add_user(self, name, surname, address, credit_card, driving_license):
+        if name in self.users:
+            raise AlreadyExistsError(f"A user with name {name!r} is already present")
+        user = User(name, surname, address, credit_card, driving_license)
+        self.users[name] = user
+        return user
+
+    # add many cars: (car_type, license_plate, brand, name, location). Returns the license plates of the added cars;
+    # the errors (invalid values, license plates already present) are returned in their place
+    def add_cars(self, cars):
+        results = [None] * len(cars)
+        batches = {}
+        for position, (car_type, license_plate, brand, name, location) in enumerate(cars):
+            if license_plate in self.plates:
+                results[position] = AlreadyExistsError(f"A car with license plate {license_plate!r} is already present")
+            elif car_type not in MAX_PASSENGERS or location not in CIRCLE_CODES:
+                results[position] = InvalidInputError(f"Invalid car type {car_type!r} or circle {location!r}")
+            else:
+                self.plates.add(license_plate)
+                batches.setdefault(self.owner(car_type, location), []).append(position)
+        answers = self.call({shard: ("add_car", [cars[position] for position in positions]) for shard, positions in batches.items()})
+        for shard, positions in batches.items():
+            for position, answer in zip(positions, answers[shard]):
+                if is_error(answer):
+                    results[position] = to_error(answer)
+                    # the car has not been added: its license plate can be used again
+                    if answer[1] != AlreadyExistsError.__name__:
+                        self.plates.discard(cars[position][1])
+                else:
+                    results[position] = answer
+        return results
+
+    def add_car(self, car_type, license_plate, brand, name, location):
+        result = self.add_cars([(car_type, license_plate, brand, name, location)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # rent many cars: (username, car_type, num_passengers, start_circle, end_circle). Returns the rentals (dicts),
+    # with the errors in place of the rentals that could not be made
+    def rent_many(self, requests):
+        results = [None] * len(requests)
+        pending = []
+        for position, (username, car_type, num_passengers, start_circle, end_circle) in enumerate(requests):
+            if username not in self.users:
+                results[position] = NotFoundError(f"User {username!r} not found. Please enter an existing user")
+            elif car_type not in MAX_PASSENGERS or start_circle not in CIRCLE_CODES or end_circle not in CIRCLE_CODES:
+                results[position] = InvalidInputError(f"Invalid car type {car_type!r} or circle")
+            else:
+                pending.append(position)
+        # first the owners of the start circles, then the owners of the circles one hop away, and so on
+        for hop in range(len(CIRCLES)):
+            if not pending:
+                break
+            batches = {}
+            for position in pending:
+                username, car_type, num_passengers, start_circle, end_circle = requests[position]
+                circle = CIRCLES_BY_DISTANCE[start_circle][hop]
+                batches.setdefault(self.owner(car_type, circle), []).append((position, (circle, *requests[position])))
+            answers = self.call({shard: ("rent", [request for _, request in batch]) for shard, batch in batches.items()})
+            pending = []
+            for shard, batch in batches.items():
+                for (position, _), answer in zip(batch, answers[shard]):
+                    if answer is None:
+                        pending.append(position)
+                    elif is_error(answer):
+                        results[position] = to_error(answer)
+                    else:
+                        results[position] = answer
+                        self.on_rent[answer["license_plate"]] = shard
+            pending.sort()
+        for position in pending:
+            car_type = requests[position][1]
+            results[position] = CarNotAvailableError(car_type, MAX_TRIP / CAR_SPEEDS[car_type])
+        return results
+
+    def rent(self, username, car_type, num_passengers, start_circle, end_circle):
+        result = self.rent_many([(username, car_type, num_passengers, start_circle, end_circle)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # return many cars (license plates). The cars returned in a circle of another shard are moved to that shard.
+    # Returns the finished rentals (dicts), with the errors in place of the cars that were not on rent
+    def return_many(self, license_plates):
+        results = [None] * len(license_plates)
+        batches = {}
+        for position, license_plate in enumerate(license_plates):
+            shard = self.on_rent.get(license_plate)
+            if shard is None:
+                results[position] = NotFoundError(f"No active rental found for car {license_plate!r}")
+            else:
+                batches.setdefault(shard, []).append(position)
+        answers = self.call({shard: ("return", [(license_plates[position],) for position in positions])
+                             for shard, positions in batches.items()})
+        transfers = {}
+        for shard, positions in batches.items():
+            for position, answer in zip(positions, answers[shard]):
+                if is_error(answer):
+                    results[position] = to_error(answer)
+                    continue
+                rental, row, owner = answer
+                del self.on_rent[license_plates[position]]
+                results[position] = rental
+                if row is not None:
+                    transfers.setdefault(owner, []).append((row, shard))
+        if transfers:
+            answers = self.call({shard: ("add_car_row", [(row,) for row, _ in rows]) for shard, rows in transfers.items()})
+            # a car that could not be moved (its new shard has stopped) is given back to the shard it came from,
+            # so it is never lost
+            back = {}
+            for shard, rows in transfers.items():
+                for (row, origin), answer in zip(rows, answers[shard]):
+                    if is_error(answer):
+                        back.setdefault(origin, []).append((row,))
+                    else:
+                        self.transfers += 1
+            if back:
+                self.call({shard: ("add_car_row", rows) for shard, rows in back.items()})
+        return results
+
+    def return_car(self, license_plate):
+        result = self.return_many([license_plate])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # cars, available cars, cars on rent and revenue of each shard
+    def status(self):
+        answers = self.call({shard: ("status", None) for shard in range(self.shards)})
+        for shard in range(self.shards):
+            if is_error(answers[shard]):
+                raise to_error(answers[shard])
+        return [answers[shard] for shard in range(self.shards)]
+
+    def close(self):
+        if not self.connections:
+            return
+        for connection in self.connections:
+            try:
+                connection.send(("stop", None))
+            except OSError:
+                # the shard has already stopped
+                pass
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.processes = []
@@ -0,0 +1,246 @@
+# Fleet simulator and load benchmark of RentItNow.
+# A synthetic fleet (cars spread over the three circles and the three car types) and a set of users are created,
+# then a random mix of operations is run against the RentalService: rentals (select_best_car + rent), returns,
+# quotes (calculate_distance + calculate_trip_cost) and administrative operations on cars and users.
+# Everything is driven by a random generator with a fixed seed, so two runs with the same options perform exactly
+# the same operations. The throughput and the latency percentiles of each operation are printed and written to a
+# JSON file, so that the results of different versions can be compared.
+#
+# Usage: python RentItNow_simulator.py [--cars 100000] [--users 10000] [--operations 200000] [--seed 1]
+#                                      [--storage memory|sqlite] [--columnar] [--output simulation.json]
+#                                      [--metrics simulation.prom] [--profile simulation.stacks]
+# --metrics measures the operations inside the service (see RentItNow_metrics) and writes them in the Prometheus
+# text format, --profile samples the stacks during the run and writes them in the collapsed format of flame graphs.
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from RentItNow_rental_software import (RentalService, Car, ColumnarFleet, CarNotAvailableError, NotFoundError, CIRCLES,
+                                       MAX_PASSENGERS)
+from RentItNow_metrics import instrument, SamplingProfiler
+from RentItNow_storage import SQLiteStorage
+
+CAR_TYPES = list(MAX_PASSENGERS)
+BRANDS = ["Toyota", "Honda", "Mercedes", "Fiat", "Renault", "Volkswagen"]
+
+# share of each operation in the workload
+DEFAULT_MIX = {
+    "rent": 0.35,
+    "return": 0.30,
+    "quote": 0.20,
+    "select_best_car": 0.05,
+    "car_status": 0.03,
+    "find_user": 0.03,
+    "add_car": 0.01,
+    "update_car": 0.01,
+    "add_user": 0.01,
+    "update_user": 0.01,
+}
+
+
+# value of the given percentile (0-100) of a sorted list
+def percentile(values, percent):
+    if not values:
+        return 0
+    position = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[position]
+
+
+class Simulator:
+    def __init__(self, service, seed=1, mix=None):
+        self.service = service
+        self.rng = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.operations = list(self.mix)
+        self.weights = [self.mix[operation] for operation in self.operations]
+        self.plates = []
+        self.usernames = []
+        # license plates of the cars on rent, for the returns
+        self.active = []
+        self.latencies = {operation: [] for operation in self.operations}
+        self.outcomes = {}
+
+    def build_fleet(self, cars, users):
+        rng = self.rng
+        with self.service.storage.batch():
+            for number in range(cars):
+                plate = f"SIM{number:07d}"
+                self.service.add_car(CAR_TYPES[number % 3], plate, rng.choice(BRANDS), f"Model {number % 100}",
+                                     CIRCLES[rng.randrange(3)])
+                self.plates.append(plate)
+            for number in range(users):
+                self.add_user()
+
+    def add_user(self):
+        username = f"user{len(self.usernames):07d}"
+        self.service.add_user(username, "Surname", f"Street {len(self.usernames)}", "0000-0000", f"DL{len(self.usernames):07d}")
+        self.usernames.append(username)
+
+    def count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    # Operations: each one is timed as a whole
+    def rent(self):
+        rng = self.rng
+        car_type = rng.choice(CAR_TYPES)
+        start_circle = rng.choice(CIRCLES)
+        end_circle = rng.choice(CIRCLES)
+        num_passengers = rng.randint(1, MAX_PASSENGERS[car_type])
+        if self.service.select_best_car(car_type, num_passengers, start_circle) is None:
+            self.count("rent: no car available")
+            return
+        try:
+            rental = self.service.rent(rng.choice(self.usernames), car_type, num_passengers, start_circle, end_circle)
+        except CarNotAvailableError:
+            self.count("rent: no car available")
+        else:
+            self.active.append(rental.car.license_plate)
+
+    def return_car(self):
+        if not self.active:
+            self.count("return: no car on rent")
+            return
+        position = self.rng.randrange(len(self.active))
+        self.active[position], self.active[-1] = self.active[-1], self.active[position]
+        self.service.return_car(self.active.pop())
+
+    def quote(self):
+        rng = self.rng
+        distance = self.service.calculate_distance(rng.choice(CIRCLES), rng.choice(CIRCLES))
+        self.service.calculate_trip_cost(rng.choice(CAR_TYPES), distance)
+
+    def select_best_car(self):
+        rng = self.rng
+        self.service.select_best_car(rng.choice(CAR_TYPES), 1, rng.choice(CIRCLES))
+
+    def car_status(self):
+        self.service.car_status(self.rng.choice(self.plates))
+
+    def find_user(self):
+        self.service.find_user(self.rng.choice(self.usernames))
+
+    def add_car(self):
+        plate = f"SIM{len(self.plates):07d}"
+        self.service.add_car(self.rng.choice(CAR_TYPES), plate, self.rng.choice(BRANDS), "New model", self.rng.choice(CIRCLES))
+        self.plates.append(plate)
+
+    def update_car(self):
+        try:
+            self.service.update_car(self.rng.choice(self.plates), brand=self.rng.choice(BRANDS))
+        except NotFoundError:
+            self.count("update_car: car not found")
+
+    def update_user(self):
+        self.service.update_user(self.rng.choice(self.usernames), address=f"Street {self.rng.randrange(10**6)}")
+
+    def run(self, operations):
+        functions = {
+            "rent": self.rent, "return": self.return_car, "quote": self.quote, "select_best_car": self.select_best_car,
+            "car_status": self.car_status, "find_user": self.find_user, "add_car": self.add_car,
+            "update_car": self.update_car, "add_user": self.add_user, "update_user": self.update_user,
+        }
+        # the whole sequence of operations is drawn first, so it only depends on the seed
+        sequence = self.rng.choices(self.operations, self.weights, k=operations)
+        clock = time.perf_counter_ns
+        began = clock()
+        for operation in sequence:
+            function = functions[operation]
+            start = clock()
+            function()
+            self.latencies[operation].append(clock() - start)
+        return (clock() - began) / 1e9
+
+    # throughput and latencies (in microseconds) of each operation
+    def results(self, elapsed):
+        operations = {}
+        for operation, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            latencies.sort()
+            operations[operation] = {
+                "count": len(latencies),
+                "mean_us": sum(latencies) / len(latencies) / 1000,
+                "p50_us": percentile(latencies, 50) / 1000,
+                "p99_us": percentile(latencies, 99) / 1000,
+                "max_us": latencies[-1] / 1000,
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {"elapsed_s": elapsed, "operations_per_s": total / elapsed if elapsed else 0,
+                "operations": operations, "outcomes": self.outcomes}
+
+
+def simulate(cars=100_000, users=10_000, operations=200_000, seed=1, storage="memory", columnar=False, output=None,
+             metrics=None, profile=None):
+    directory = None
+    if storage == "sqlite":
+        directory = tempfile.TemporaryDirectory()
+        backend = SQLiteStorage(os.path.join(directory.name, "simulation.db"), synchronous="NORMAL")
+    else:
+        backend = None
+    car_factory = ColumnarFleet().new_car if columnar else Car
+    service = RentalService(storage=backend, receipts=False, car_factory=car_factory)
+    simulator = Simulator(service, seed)
+
+    began = time.perf_counter()
+    simulator.build_fleet(cars, users)
+    build_time = time.perf_counter() - began
+    print(f"fleet of {cars} cars and {users} users built in {build_time:.2f} s")
+
+    if metrics:
+        instrument(service)
+    profiler = SamplingProfiler().start() if profile else None
+    elapsed = simulator.run(operations)
+    if profiler is not None:
+        profiler.stop().write_collapsed(profile)
+        print(f"{profiler.samples} stack samples saved in {profile}")
+    if metrics:
+        service.metrics.write_prometheus(metrics)
+        print(f"metrics saved in {metrics}")
+    results = simulator.results(elapsed)
+    results["build_s"] = build_time
+    results["parameters"] = {"cars": cars, "users": users, "operations": operations, "seed": seed,
+                             "storage": storage, "columnar": columnar}
+    results["environment"] = {"python": platform.python_version(), "platform": platform.platform(),
+                              "date": datetime.now().isoformat(timespec="seconds")}
+
+    print(f"{operations} operations in {elapsed:.2f} s ({results['operations_per_s']:.0f} operations/s)")
+    print(f"{'operation':16} {'count':>8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9}")
+    for operation, values in results["operations"].items():
+        print(f"{operation:16} {values['count']:8} {values['mean_us']:9.1f} {values['p50_us']:9.1f} {values['p99_us']:9.1f}")
+    for outcome, number in results["outcomes"].items():
+        print(f"{outcome}: {number}")
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"results saved in {output}")
+
+    service.close()
+    if directory is not None:
+        directory.cleanup()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RentItNow fleet simulator and load benchmark")
+    parser.add_argument("--cars", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--operations", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--columnar", action="store_true", help="keep the fleet in a ColumnarFleet")
+    parser.add_argument("--output", default="simulation.json", help="JSON file of the results")
+    parser.add_argument("--metrics", help="measure the operations of the service and write the metrics to this file")
+    parser.add_argument("--profile", help="sample the stacks during the run and write them to this file")
+    arguments = parser.parse_args(argv)
+    simulate(arguments.cars, arguments.users, arguments.operations, arguments.seed, arguments.storage,
+             arguments.columnar, arguments.output, arguments.metrics, arguments.profile)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,364 @@
+# Storage backends used by RentItNow to keep cars, users and rentals between two runs of the program.
+# The Storage class is the interface (and the default backend, which keeps everything only in memory),
+# SQLiteStorage saves the data in a SQLite database file.
+# https://docs.python.org/3/library/sqlite3.html
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default backend: nothing is saved, the cars, users and rentals only live in the RentItNow dictionaries and lists
+class Storage:
+    # False when the data is lost at the end of the program
+    persistent = False
+
+    def save_car(self, car):
+        pass
+
+    def delete_car(self, license_plate):
+        pass
+
+    # return the row of the car with the given license plate, or None if the car is not stored
+    def load_car(self, license_plate):
+        return None
+
+    # return the rows of the cars of the given type located in the given circle
+    def load_cars(self, car_type, location):
+        return []
+
+    def save_user(self, user, old_name=None):
+        pass
+
+    def delete_user(self, name):
+        pass
+
+    # return the row of the user with the given name, or None if the user is not stored
+    def load_user(self, name):
+        return None
+
+    # save a rental and return its id (None if the storage does not assign ids)
+    def save_rental(self, username, car, start_circle, end_circle, distance, total_cost, rented_at):
+        return None
+
+    # mark a rental as finished (the car has been returned)
+    def finish_rental(self, rental_id, returned_at):
+        pass
+
+    # return the rows of the rentals of the car with the given license plate, the most recent first:
+    # (username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, returned_at, rental_id)
+    def load_rentals(self, license_plate):
+        return []
+
+    # save a reservation and return its id (None if the storage does not assign ids)
+    def save_reservation(self, username, car, start_circle, end_circle, start, end):
+        return None
+
+    def delete_reservation(self, reservation_id):
+        pass
+
+    # return the rows of all the reservations:
+    # (reservation_id, username, license_plate, car_type, start_circle, end_circle, start, end)
+    def load_reservations(self):
+        return []
+
+    # iterate over the rentals made in the given day ("YYYY-MM-DD") as receipt rows:
+    # (username, rented_at, car name, car type, start_circle, end_circle, distance, total_cost)
+    def iter_rentals(self, day):
+        return iter(())
+
+    # iterate over the rentals made after the given rental id, in order, as report rows:
+    # (car_type, license_plate, start_circle, end_circle, distance, total_cost, rented_at, rental_id)
+    def iter_rental_history(self, after=0):
+        return iter(())
+
+    # totals of the reports (see RentalReports.state) including the rentals up to last_rental_id, saved so that only
+    # the rentals made afterwards are read at startup. load_report_totals returns (last_rental_id, totals) or None
+    def save_report_totals(self, last_rental_id, totals):
+        pass
+
+    def load_report_totals(self):
+        return None
+
+    # iterate over all the stored cars, users and rentals (bulk export), as rows like load_car, load_user and load_rentals
+    def iter_cars(self):
+        return iter(())
+
+    # iterate over the stored cars (rows like load_car), the fewest km left before the service first
+    def iter_cars_by_service(self):
+        return iter(())
+
+    # number of stored cars available for rental (not on rent, not in service): {(car_type, location): count}
+    def count_available_cars(self):
+        return {}
+
+    def iter_users(self):
+        return iter(())
+
+    def iter_all_rentals(self):
+        return iter(())
+
+    # group several writes in a single transaction
+    @contextmanager
+    def batch(self):
+        yield self
+
+    def close(self):
+        pass
+
+
+# SQLite backend. The database runs in WAL mode, so that a crash during a write never corrupts the data
+# already saved, and every write (or every batch of writes) is committed in its own transaction.
+# Cars and users are loaded one by one or circle by circle when the program needs them, never all together
+class SQLiteStorage(Storage):
+    persistent = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cars (
+            license_plate TEXT PRIMARY KEY,
+            car_type TEXT NOT NULL,
+            brand TEXT,
+            name TEXT,
+            location TEXT,
+            total_distance_travelled NUMERIC NOT NULL DEFAULT 0,
+            next_service_time NUMERIC NOT NULL DEFAULT 1500,
+            availability INTEGER NOT NULL DEFAULT 1,
+            is_in_service INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS cars_by_circle ON cars (location, car_type);
+        CREATE INDEX IF NOT EXISTS cars_by_next_service ON cars (next_service_time);
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            surname TEXT,
+            address TEXT,
+            credit_card TEXT,
+            driving_license TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rentals (
+            rental_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            license_plate TEXT NOT NULL,
+            start_circle TEXT NOT NULL,
+            end_circle TEXT NOT NULL,
+            distance NUMERIC NOT NULL,
+            total_cost NUMERIC NOT NULL,
+            rented_at TEXT NOT NULL,
+            returned_at TEXT,
+            car_type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS rentals_by_plate ON rentals (license_plate, rental_id);
+        CREATE INDEX IF NOT EXISTS rentals_by_user ON rentals (username, rental_id);
+        CREATE INDEX IF NOT EXISTS rentals_by_date ON rentals (rented_at);
+        CREATE TABLE IF NOT EXISTS reservations (
+            reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            license_plate TEXT NOT NULL,
+            car_type TEXT NOT NULL,
+            start_circle TEXT NOT NULL,
+            end_circle TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS report_totals (
+            name TEXT PRIMARY KEY,
+            last_rental_id INTEGER NOT NULL,
+            totals TEXT NOT NULL
+        );
+    """
+
+    CAR_COLUMNS = "car_type, license_plate, brand, name, location, total_distance_travelled, next_service_time, availability, is_in_service"
+
+    def __init__(self, path, synchronous="FULL"):
+        self.path = path
+        # the connection can be shared between threads, the lock makes sure that only one of them writes at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={synchronous}")
+        self.connection.executescript(self.SCHEMA)
+        # databases created before the return of the cars was introduced do not have the returned_at column
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(rentals)")]
+        if "returned_at" not in columns:
+            self.connection.execute("ALTER TABLE rentals ADD COLUMN returned_at TEXT")
+        # nor the car_type column: it is filled from the cars still present (the others are reported as UNKNOWN)
+        if "car_type" not in columns:
+            with self.transaction():
+                self.connection.execute("ALTER TABLE rentals ADD COLUMN car_type TEXT")
+                self.connection.execute("UPDATE rentals SET car_type = (SELECT car_type FROM cars WHERE cars.license_plate = rentals.license_plate)")
+
+    # run a write statement: outside of a batch it is committed immediately. The id of the inserted row is returned
+    def write(self, sql, parameters=()):
+        with self.lock:
+            if self.batch_depth:
+                return self.connection.execute(sql, parameters).lastrowid
+            with self.transaction():
+                return self.connection.execute(sql, parameters).lastrowid
+
+    def read(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        else:
+            self.connection.execute("COMMIT")
+
+    # all the writes made inside the batch are committed together at the end (or rolled back in case of errors)
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.batch_depth:
+                self.batch_depth += 1
+                try:
+                    yield self
+                finally:
+                    self.batch_depth -= 1
+                return
+            with self.transaction():
+                self.batch_depth = 1
+                try:
+                    yield self
+                finally:
+                    self.batch_depth = 0
+
+    def save_car(self, car):
+        self.write(
+            f"INSERT OR REPLACE INTO cars ({self.CAR_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (car.car_type, car.license_plate, car.brand, car.name, car.location, car.total_distance_travelled,
+             car.next_service_time, int(car.availability), int(car.is_in_service)),
+        )
+
+    def delete_car(self, license_plate):
+        self.write("DELETE FROM cars WHERE license_plate = ?", (license_plate,))
+
+    def load_car(self, license_plate):
+        rows = self.read(f"SELECT {self.CAR_COLUMNS} FROM cars WHERE license_plate = ?", (license_plate,))
+        return rows[0] if rows else None
+
+    def load_cars(self, car_type, location):
+        return self.read(f"SELECT {self.CAR_COLUMNS} FROM cars WHERE location = ? AND car_type = ?", (location, car_type))
+
+    # when a user changes name the old row is replaced by the new one
+    def save_user(self, user, old_name=None):
+        with self.batch():
+            if old_name is not None and old_name != user.name:
+                self.write("DELETE FROM users WHERE name = ?", (old_name,))
+            self.write(
+                "INSERT OR REPLACE INTO users (name, surname, address, credit_card, driving_license) VALUES (?, ?, ?, ?, ?)",
+                (user.name, user.surname, user.address, user.credit_card, user.driving_license),
+            )
+
+    def delete_user(self, name):
+        self.write("DELETE FROM users WHERE name = ?", (name,))
+
+    def load_user(self, name):
+        rows = self.read("SELECT name, surname, address, credit_card, driving_license FROM users WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    # the id given by the database to the rental is returned. The car type is saved with the rental, so the reports
+    # do not change when the car is later updated or removed
+    def save_rental(self, username, car, start_circle, end_circle, distance, total_cost, rented_at):
+        return self.write(
+            "INSERT INTO rentals (username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, car_type) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (username, car.license_plate, start_circle, end_circle, distance, total_cost, rented_at, car.car_type),
+        )
+
+    def finish_rental(self, rental_id, returned_at):
+        self.write("UPDATE rentals SET returned_at = ? WHERE rental_id = ?", (returned_at, rental_id))
+
+    def load_rentals(self, license_plate):
+        return self.read(
+            "SELECT username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, returned_at, rental_id FROM rentals "
+            "WHERE license_plate = ? ORDER BY rental_id DESC",
+            (license_plate,),
+        )
+
+    # the times are saved as "YYYY-MM-DD HH:MM" strings, like the time of the rentals
+    def save_reservation(self, username, car, start_circle, end_circle, start, end):
+        return self.write(
+            "INSERT INTO reservations (username, license_plate, car_type, start_circle, end_circle, start_time, end_time) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (username, car.license_plate, car.car_type, start_circle, end_circle, start, end),
+        )
+
+    def delete_reservation(self, reservation_id):
+        self.write("DELETE FROM reservations WHERE reservation_id = ?", (reservation_id,))
+
+    def load_reservations(self):
+        return self.read(
+            "SELECT reservation_id, username, license_plate, car_type, start_circle, end_circle, start_time, end_time "
+            "FROM reservations ORDER BY start_time"
+        )
+
+    # the rows of a query are fetched a few at a time, so that thousands of rentals are never all in memory
+    def iter_query(self, sql, parameters=(), chunk_size=500):
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+    def iter_rentals(self, day, chunk_size=500):
+        return self.iter_query(
+            "SELECT rentals.username, rentals.rented_at, cars.name, COALESCE(rentals.car_type, cars.car_type), rentals.start_circle, "
+            "rentals.end_circle, rentals.distance, rentals.total_cost FROM rentals "
+            "LEFT JOIN cars ON cars.license_plate = rentals.license_plate "
+            "WHERE rentals.rented_at >= ? AND rentals.rented_at < ? ORDER BY rentals.rented_at, rentals.rental_id",
+            (day, day + "~"), chunk_size,
+        )
+
+    # the car type is the one saved with the rental (UNKNOWN for the rentals of removed cars made before it was saved)
+    def iter_rental_history(self, after=0, chunk_size=500):
+        return self.iter_query(
+            "SELECT COALESCE(car_type, 'UNKNOWN'), license_plate, start_circle, end_circle, distance, total_cost, rented_at, "
+            "rental_id FROM rentals WHERE rental_id > ? ORDER BY rental_id",
+            (after,), chunk_size,
+        )
+
+    # the totals of the reports are saved as json, with the id of the last rental they include
+    def save_report_totals(self, last_rental_id, totals):
+        self.write("INSERT OR REPLACE INTO report_totals (name, last_rental_id, totals) VALUES ('rentals', ?, ?)",
+                   (last_rental_id, json.dumps(totals, separators=(",", ":"))))
+
+    def load_report_totals(self):
+        rows = self.read("SELECT last_rental_id, totals FROM report_totals WHERE name = 'rentals'")
+        if not rows:
+            return None
+        return rows[0][0], json.loads(rows[0][1])
+
+    def iter_cars(self, chunk_size=500):
+        return self.iter_query(f"SELECT {self.CAR_COLUMNS} FROM cars ORDER BY license_plate", (), chunk_size)
+
+    # counted by the database: no car is loaded
+    def count_available_cars(self):
+        rows = self.read("SELECT car_type, location, COUNT(*) FROM cars WHERE availability = 1 AND is_in_service = 0 "
+                         "GROUP BY car_type, location")
+        return {(car_type, location): count for car_type, location, count in rows}
+
+    # read through the cars_by_next_service index: only the rows actually used are fetched
+    def iter_cars_by_service(self, chunk_size=50):
+        return self.iter_query(f"SELECT {self.CAR_COLUMNS} FROM cars ORDER BY next_service_time", (), chunk_size)
+
+    def iter_users(self, chunk_size=500):
+        return self.iter_query("SELECT name, surname, address, credit_card, driving_license FROM users ORDER BY name", (), chunk_size)
+
+    def iter_all_rentals(self, chunk_size=500):
+        return self.iter_query(
+            "SELECT username, license_plate, start_circle, end_circle, distance, total_cost, rented_at, returned_at, rental_id "
+            "FROM rentals ORDER BY rental_id",
+            (), chunk_size,
+        )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,127 @@
+# Waiting time of RentItNow when no car of the requested type is free. Instead of assuming the worst trip (20 km)
+# the estimate looks at the cars on rent: a car is free again when its trip ends (distance of the trip / speed of
+# its type after the start of the rental) and then it still has to drive from the end circle of the trip to the
+# circle of the user.
+#
+# The cars on rent are kept in one heap per (car type, end circle), ordered by the time their trip ends, so the next
+# car to come back in each circle is always at the top. An estimate looks at the top of the 3 heaps of the car type:
+# O(log n), updated at every rental and return. Returned cars are not searched in the heaps: their entries are
+# skipped when they reach the top (lazy invalidation) and the heap is rebuilt when they are too many.
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+from RentItNow_pricing import CIRCLES, CAR_SPEEDS, DISTANCES
+
+# a heap is rebuilt when it holds more than twice as many entries as cars on rent (plus this margin)
+COMPACT_MARGIN = 64
+
+
+# estimated waiting time for a car of a given type in a given circle. license_plate is the car expected to come
+# (None when no car of the type is on rent: hours is then the worst case, see RentalService.waiting_time)
+class WaitEstimate:
+    def __init__(self, car_type, start_circle, hours, license_plate=None, from_circle=None, now=None):
+        self.car_type = car_type
+        self.start_circle = start_circle
+        self.hours = hours
+        self.license_plate = license_plate
+        self.from_circle = from_circle  # end circle of the trip of the expected car
+        now = time.time() if now is None else now
+        self.available_at = datetime.fromtimestamp(now + hours * 3600)
+
+    def __str__(self):
+        if self.license_plate is None:
+            return (f"Sorry, the requested {self.car_type} car is not available. "
+                    f"The maximum waiting time is approximately {self.hours:.2f} hours")
+        return (f"Sorry, the requested {self.car_type} car is not available. The next one should reach "
+                f"{self.start_circle} in about {self.hours:.2f} hours (at {self.available_at.strftime('%H:%M')})")
+
+
+# hours needed by a car of the given type to drive from one circle to another (0 if it is already there)
+def drive_hours(car_type, from_circle, to_circle):
+    if from_circle == to_circle:
+        return 0
+    return DISTANCES[from_circle, to_circle] / CAR_SPEEDS[car_type]
+
+
+class WaitTimeEstimator:
+    def __init__(self):
+        self.heaps = {}  # (car_type, end_circle) -> [(time the trip ends, version, license_plate)]
+        self.entries = {}  # license_plate -> (car_type, end_circle, time the trip ends, version)
+        self.on_rent = {}  # (car_type, end_circle) -> number of cars on rent
+        self.versions = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # a car has been rented (started: epoch seconds of the start of the rental, default now)
+    def start(self, license_plate, car_type, start_circle, end_circle, started=None):
+        started = time.time() if started is None else started
+        # a trip inside a single circle is 5 km long too
+        ends = started + DISTANCES[start_circle, end_circle] / CAR_SPEEDS[car_type] * 3600
+        key = (car_type, end_circle)
+        with self.lock:
+            self.discard(license_plate)
+            version = next(self.versions)
+            self.entries[license_plate] = (car_type, end_circle, ends, version)
+            heapq.heappush(self.heaps.setdefault(key, []), (ends, version, license_plate))
+            self.on_rent[key] = self.on_rent.get(key, 0) + 1
+
+    # a car has been returned
+    def finish(self, license_plate):
+        with self.lock:
+            self.discard(license_plate)
+
+    # (the lock must be held)
+    def discard(self, license_plate):
+        entry = self.entries.pop(license_plate, None)
+        if entry is None:
+            return
+        key = entry[:2]
+        self.on_rent[key] -= 1
+        heap = self.heaps[key]
+        if len(heap) > 2 * self.on_rent[key] + COMPACT_MARGIN:
+            heap[:] = [item for item in heap if self.entries.get(item[2], (None,) * 4)[3] == item[1]]
+            heapq.heapify(heap)
+
+    # (time the trip ends, license_plate) of the first car on rent of the type coming back to the circle, or None
+    # (the lock must be held)
+    def first_back(self, car_type, end_circle):
+        heap = self.heaps.get((car_type, end_circle))
+        while heap:
+            ends, version, license_plate = heap[0]
+            if self.entries.get(license_plate, (None,) * 4)[3] == version:
+                return ends, license_plate
+            heapq.heappop(heap)
+        return None
+
+    # when a car of the given type should be free in the given circle: WaitEstimate, or None if no car of the type
+    # is on rent. Trips already late are expected to end now
+    def estimate(self, car_type, start_circle, now=None):
+        now = time.time() if now is None else now
+        best = None
+        with self.lock:
+            for circle in CIRCLES:
+                first = self.first_back(car_type, circle)
+                if first is None:
+                    continue
+                ends, license_plate = first
+                hours = max(ends - now, 0) / 3600 + drive_hours(car_type, circle, start_circle)
+                if best is None or hours < best[0]:
+                    best = (hours, license_plate, circle)
+        if best is None:
+            return None
+        hours, license_plate, circle = best
+        return WaitEstimate(car_type, start_circle, hours, license_plate, circle, now)
+
+    # when a given car on rent should be free in the given circle, or None if the car is not on rent
+    def estimate_car(self, license_plate, start_circle, now=None):
+        now = time.time() if now is None else now
+        entry = self.entries.get(license_plate)
+        if entry is None:
+            return None
+        car_type, end_circle, ends, version = entry
+        hours = max(ends - now, 0) / 3600 + drive_hours(car_type, end_circle, start_circle)
+        return WaitEstimate(car_type, start_circle, hours, license_plate, end_circle, now)